@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Repeatable benchmarks for sync, index building and page rendering.
+
+For each library size a synthetic library is served by fake_zotero.py and
+a fresh zqda instance (with its own HOME, so its own config and data
+directories) syncs it and renders pages through the Flask test client:
+
+    python benchmarks/bench.py --sizes 1000 10000 100000 --json results.json
+
+Reported for each size:
+  sync          _sync_items from version 0, including attachment downloads
+  index.*       _get_tags/_get_collections/_get_children: full dbm scan,
+                memoized hit, and memory-mapped snapshot (load + lookups)
+  collection    collection listing pages (_collection)
+  annotations   show_annotations for the most used tags
+  blob          attachment downloads
+with throughput, time per operation, and resident/peak memory of the
+benchmark process afterwards.
+
+With --cassette, a recorded Zotero API cassette (see zqda/cassette.py and
+`flask --app zqda sync-library --record`) is replayed instead, so that the
+same benchmarks run against the shape of a real library:
+
+    python benchmarks/bench.py --cassette production.jsonl.gz
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+LIBRARY_ID = '1234567'
+
+CONFIG = """SECRET_KEY = "benchmark"
+ZOTERO_API_URL = "{url}"
+ZOTERO_RATE_LIMIT = 1000000
+ZOTERO_RATE_BURST = 1000000
+
+[LIBRARY.{library_id}]
+title = "Synthetic library"
+description = "Generated for benchmarks"
+api_key = "benchmark"
+keys = ["benchmark"]
+allow_downloads = true
+"""
+
+
+def _rss_mb():
+    """Current resident set size, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _result(name, count, seconds, **extra):
+    r = {'name': name, 'ops': count, 'seconds': seconds,
+         'ops_per_second': count / seconds if seconds else None,
+         'ms_per_op': seconds * 1000 / count if count else None,
+         'rss_mb': _rss_mb(), 'peak_rss_mb': _peak_rss_mb()}
+    r.update(extra)
+    return r
+
+
+def _timed(fn, *args):
+    t = time.perf_counter()
+    value = fn(*args)
+    return value, time.perf_counter() - t
+
+
+def run_worker(limit, library_id=LIBRARY_ID):
+    """Run the benchmarks in this process. HOME must already point to a
+    directory containing .config/zqda/config.toml."""
+    sys.path.insert(0, ROOT)
+    import zqda
+    import zqda.core as core
+    from zqda import snapshot
+
+    app = zqda.app
+    client = app.test_client()
+    results = []
+
+    with app.app_context():
+        msg, seconds = _timed(core._sync_items, library_id)
+        n = snapshot.load(library_id).keys
+        results.append(_result('sync', len(n), seconds, message=msg))
+
+        snap = snapshot.load(library_id)
+        for name in ('tags', 'collections', 'children'):
+            scan = getattr(core, '_scan_' + name)
+            core.cache.clear()
+            _, seconds = _timed(scan, library_id)
+            results.append(_result('index.{}.scan'.format(name), 1, seconds))
+            _, seconds = _timed(scan, library_id)
+            results.append(_result('index.{}.memoized'.format(name), 1, seconds))
+
+            snapshot._loaded.clear()
+            mapping, seconds = _timed(getattr(core, '_get_' + name), library_id)
+            keys = list(mapping)[:limit]
+            t = time.perf_counter()
+            for k in keys:
+                mapping[k]
+            seconds += time.perf_counter() - t
+            results.append(_result('index.{}.snapshot'.format(name),
+                                   len(keys), seconds))
+
+        tags = core._get_tags(library_id)
+        top_tags = sorted(tags, key=tags.count, reverse=True)[:limit]
+        collections = [k for k in core._get_collections(library_id) if k != 'top'][:limit]
+        attachments = [snap.keys[i] for i in range(len(snap.keys))
+                       if snap.type_names[snap.types[i]] == 'attachment'][:limit]
+
+    def pages(name, urls):
+        size = 0
+        t = time.perf_counter()
+        for url in urls:
+            r = client.get(url)
+            assert r.status_code == 200, (url, r.status_code)
+            size += len(r.get_data())
+        seconds = time.perf_counter() - t
+        results.append(_result(name, len(urls), seconds, bytes=size))
+
+    pages('collection', ['/view/{}/{}'.format(library_id, c) for c in collections])
+    pages('annotations', ['/annotations/{}/{}'.format(library_id, t) for t in top_tags])
+    pages('blob', ['/raw/{}/{}'.format(library_id, a) for a in attachments])
+    return results
+
+
+def _cassette_library(path):
+    """Library ID of the first group request in a cassette."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            parts = json.loads(line)['url'].split('/')
+            if len(parts) > 2 and parts[1] == 'groups':
+                return parts[2]
+    raise SystemExit('no group requests in {}'.format(path))
+
+
+def run_size(items, limit, file_size, cassette=None):
+    """Start a fake Zotero server (or a cassette replay server) and a worker
+    process for one size."""
+    library_id = LIBRARY_ID
+    command = [sys.executable, os.path.join(HERE, 'fake_zotero.py'),
+               '--items', str(items), '--library-id', LIBRARY_ID,
+               '--file-size', str(file_size)]
+    if cassette:
+        library_id = _cassette_library(cassette)
+        command = [sys.executable, os.path.join(ROOT, 'zqda', 'cassette.py'),
+                   os.path.abspath(cassette)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, text=True)
+    try:
+        url = server.stdout.readline().strip()
+        with tempfile.TemporaryDirectory() as home:
+            os.makedirs(os.path.join(home, '.config', 'zqda'))
+            with open(os.path.join(home, '.config', 'zqda', 'config.toml'), 'w') as f:
+                f.write(CONFIG.format(url=url, library_id=library_id))
+            p = subprocess.run(
+                [sys.executable, __file__, '--worker', '--limit', str(limit),
+                 '--library-id', library_id],
+                env=dict(os.environ, HOME=home), capture_output=True,
+                text=True)
+            if p.returncode:
+                sys.stderr.write(p.stderr)
+                raise SystemExit('benchmark worker failed for {}'.format(
+                    cassette or '{} items'.format(items)))
+            results = json.loads(p.stdout.strip().splitlines()[-1])
+    finally:
+        server.send_signal(signal.SIGINT)
+        _, err = server.communicate()
+    api = json.loads(err.strip().splitlines()[-1]) if err.strip() else {}
+    return {'items': items, 'cassette': cassette, 'results': results, 'api': api}
+
+
+def _print(run):
+    if run['cassette']:
+        print('\n{}'.format(run['cassette']))
+    else:
+        print('\n{} items, {} API requests'.format(
+            run['items'], sum(run['api'].get('requests', {}).values())))
+    print('  {:<28} {:>8} {:>12} {:>10} {:>9} {:>9}'.format(
+        'benchmark', 'ops', 'ops/s', 'ms/op', 'rss MB', 'peak MB'))
+    for r in run['results']:
+        print('  {:<28} {:>8} {:>12.1f} {:>10.3f} {:>9.1f} {:>9.1f}'.format(
+            r['name'], r['ops'], r['ops_per_second'] or 0, r['ms_per_op'] or 0,
+            r['rss_mb'] or 0, r['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--limit', type=int, default=50,
+                        help='pages/lookups per page benchmark')
+    parser.add_argument('--file-size', type=int, default=16384)
+    parser.add_argument('--cassette', metavar='FILE',
+                        help='replay a recorded API cassette instead')
+    parser.add_argument('--json', metavar='FILE')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--library-id', default=LIBRARY_ID,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.limit, args.library_id)))
+        return
+
+    runs = []
+    for items in [0] if args.cassette else args.sizes:
+        run = run_size(items, args.limit, args.file_size, args.cassette)
+        _print(run)
+        runs.append(run)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
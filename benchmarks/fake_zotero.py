@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Local stand-in for the parts of the Zotero web API used by zqda.
+
+Serves a synthetic library (see synthlib.py) with paging (`start`/`limit`
+and `Link: rel="next"`), `since`, `format=keys`, `tag` and `itemType`
+filters, `include=bib,data`, attachment file downloads, conditional group
+requests and version headers. PATCH requests on items are applied with
+`If-Unmodified-Since-Version` checks.
+
+    python benchmarks/fake_zotero.py --items 10000 --port 8080
+
+prints the base URL on the first line of stdout; point ZOTERO_API_URL at it.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthlib  # noqa: E402
+
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 100
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        (re.compile(r'^/groups/(\d+)$'), 'group'),
+        (re.compile(r'^/groups/(\d+)/items$'), 'items'),
+        (re.compile(r'^/groups/(\d+)/items/top$'), 'items_top'),
+        (re.compile(r'^/groups/(\d+)/items/(\w+)$'), 'item'),
+        (re.compile(r'^/groups/(\d+)/items/(\w+)/file$'), 'file'),
+        (re.compile(r'^/groups/(\d+)/items/(\w+)/children$'), 'children'),
+        (re.compile(r'^/groups/(\d+)/collections$'), 'collections'),
+        (re.compile(r'^/groups/(\d+)/collections/(\w+)$'), 'collection'),
+        (re.compile(r'^/groups/(\d+)/collections/(\w+)/items$'), 'collection_items'),
+        (re.compile(r'^/groups/(\d+)/collections/(\w+)/collections$'), 'collections_sub'),
+        (re.compile(r'^/groups/(\d+)/deleted$'), 'deleted'),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def library(self):
+        return self.server.library
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        for pattern, name in self.routes:
+            m = pattern.match(url.path)
+            if m:
+                self.server.count(name)
+                if m.group(1) != self.library.library_id:
+                    return self._send(404, b'Not found', 'text/plain')
+                handler = getattr(self, '{}_{}'.format(method, name), None)
+                if handler is None:
+                    return self._send(405, b'Method not allowed', 'text/plain')
+                with self.server.lock:
+                    return handler(*m.groups()[1:])
+        self.server.count('unknown')
+        self._send(404, b'Not found', 'text/plain')
+
+    def do_GET(self):
+        self._dispatch('get')
+
+    def do_PATCH(self):
+        self._dispatch('patch')
+
+    def _send(self, status, body=b'', content_type='application/json',
+              headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified-Version', str(self.library.version))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count_bytes(len(body))
+
+    def _object(self, obj):
+        include = self.query.get('include', 'data').split(',')
+        out = {k: v for k, v in obj.items() if k != 'bib' or 'bib' in include}
+        if 'bib' in include and 'bib' not in obj:
+            out['bib'] = ''
+        return out
+
+    def _list(self, objects):
+        since = int(self.query.get('since', 0))
+        objects = [o for o in objects if o['version'] > since]
+        item_type = self.query.get('itemType')
+        if item_type:
+            types = item_type.lstrip('-').split(' || ')
+            negate = item_type.startswith('-')
+            objects = [o for o in objects
+                       if (o['data']['itemType'] in types) != negate]
+        tag = self.query.get('tag')
+        if tag:
+            objects = [o for o in objects
+                       if any(t['tag'] == tag for t in o['data'].get('tags', []))]
+
+        if self.query.get('format') == 'keys':
+            body = '\n'.join(o['key'] for o in objects) + '\n'
+            return self._send(200, body.encode('utf-8'), 'text/plain')
+        if self.query.get('format') == 'versions':
+            body = json.dumps({o['key']: o['version'] for o in objects})
+            return self._send(200, body.encode('utf-8'))
+
+        start = int(self.query.get('start', 0))
+        limit = min(int(self.query.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        page = objects[start:start + limit]
+        headers = {'Total-Results': str(len(objects))}
+        if start + limit < len(objects):
+            query = dict(self.query, start=start + limit, limit=limit)
+            headers['Link'] = '<{}{}?{}>; rel="next"'.format(
+                self.server.url, urlparse(self.path).path, urlencode(query))
+        body = json.dumps([self._object(o) for o in page]).encode('utf-8')
+        self._send(200, body, headers=headers)
+
+    def get_group(self):
+        since = self.headers.get('If-Modified-Since-Version')
+        if since is not None and int(since) >= self.library.group_version:
+            return self._send(304)
+        body = json.dumps({'id': int(self.library.library_id),
+                           'version': self.library.group_version,
+                           'data': {'name': 'Synthetic library',
+                                    'description': 'Generated for benchmarks'}})
+        self._send(200, body.encode('utf-8'))
+
+    def get_items(self):
+        self._list(self.library.items())
+
+    def get_items_top(self):
+        self._list([o for o in self.library.items()
+                    if not o['data'].get('parentItem')])
+
+    def get_item(self, key):
+        obj = self.library.objects.get(key)
+        if obj is None or obj['data']['itemType'] == 'collection':
+            return self._send(404, b'Not found', 'text/plain')
+        self._send(200, json.dumps(self._object(obj)).encode('utf-8'))
+
+    def patch_item(self, key):
+        # read the body first, so that it is not left on a kept-alive
+        # connection when the request is refused
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        obj = self.library.objects.get(key)
+        if obj is None or obj['data']['itemType'] == 'collection':
+            return self._send(404, b'Not found', 'text/plain')
+        expected = self.headers.get('If-Unmodified-Since-Version')
+        if expected is not None and int(expected) != obj['version']:
+            return self._send(412, b'Item has been modified', 'text/plain')
+        changes = json.loads(body or b'{}')
+        obj['data'].update({k: v for k, v in changes.items()
+                            if k not in ('key', 'version')})
+        self.library.bump([key])
+        self._send(204)
+
+    def get_file(self, key):
+        obj = self.library.objects.get(key)
+        if obj is None or obj['data']['itemType'] != 'attachment':
+            return self._send(404, b'Not found', 'text/plain')
+        self._send(200, self.library.file(key), obj['data']['contentType'])
+
+    def get_children(self, key):
+        self._list([o for o in self.library.items()
+                    if o['data'].get('parentItem') == key])
+
+    def get_collections(self):
+        self._list(self.library.collections())
+
+    def get_collection(self, key):
+        obj = self.library.objects.get(key)
+        if obj is None or obj['data']['itemType'] != 'collection':
+            return self._send(404, b'Not found', 'text/plain')
+        self._send(200, json.dumps(obj).encode('utf-8'))
+
+    def get_collection_items(self, key):
+        self._list([o for o in self.library.items()
+                    if key in o['data'].get('collections', [])])
+
+    def get_collections_sub(self, key):
+        self._list([o for o in self.library.collections()
+                    if o['data'].get('parentCollection') == key])
+
+    def get_deleted(self):
+        self._send(200, json.dumps({'collections': [], 'items': [],
+                                    'searches': [], 'tags': []}).encode('utf-8'))
+
+
+class FakeZotero(ThreadingHTTPServer):
+    """Threaded HTTP server for a synthetic library. Counts requests per
+    route and bytes sent."""
+
+    daemon_threads = True
+
+    def __init__(self, library, host='127.0.0.1', port=0):
+        super().__init__((host, port), Handler)
+        self.library = library
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_sent = 0
+        self.url = 'http://{}:{}'.format(*self.server_address[:2])
+
+    def count(self, route):
+        self.requests[route] += 1
+
+    def count_bytes(self, n):
+        self.bytes_sent += n
+
+    def start(self):
+        """Serve from a daemon thread; returns the base URL."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--library-id', default='1234567')
+    parser.add_argument('--file-size', type=int, default=16384)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    library = synthlib.generate(args.items, file_size=args.file_size,
+                                library_id=args.library_id, seed=args.seed)
+    server = FakeZotero(library, port=args.port)
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps({'requests': dict(server.requests),
+                          'bytes_sent': server.bytes_sent}),
+              file=sys.stderr, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Measure the cold import time of the zqda package.
+
+Runs `python -X importtime -c "import zqda"` in a fresh interpreter several
+times and reports the best result, which is what a CGI request pays before
+any route code runs. Exits with status 1 if the import exceeds the time
+budget or if any of the modules that should only be loaded on demand are
+imported, so the script can be used as a CI check:
+
+    python benchmarks/import_time.py --json import_time.json
+
+The budget is BUDGET_MS unless given with --budget-ms (0 disables it).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Modules that must not be imported by `import zqda` alone.
+LAZY_MODULES = ('bs4', 'markdown', 'json2table', 'pyzotero', 'slugify',
+                'flask_caching', 'toml')
+
+# Time budget of `import zqda`, in milliseconds. Lower it when imports get
+# faster, so that regressions are caught.
+BUDGET_MS = 250
+
+PROBE = ('import sys, zqda; '
+         'print(",".join(m for m in {!r} if m in sys.modules))').format(
+             LAZY_MODULES)
+
+
+def _run_once():
+    """Return (cumulative microseconds per module, eagerly imported lazy
+    modules) for a single interpreter start."""
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                       capture_output=True, text=True, check=True,
+                       cwd=os.path.dirname(os.path.dirname(
+                           os.path.abspath(__file__))))
+    timings = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = int(cumulative_us)
+    eager = [m for m in p.stdout.strip().split(',') if m]
+    return timings, eager
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of interpreter starts (best is kept)')
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS,
+                        help='fail if `import zqda` takes longer than this '
+                        '(default: %(default)s, 0 for no limit)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest modules to list')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the results to FILE for tracking')
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.runs):
+        timings, eager = _run_once()
+        if best is None or timings['zqda'] < best[0]['zqda']:
+            best = (timings, eager)
+    timings, eager = best
+
+    total_ms = timings['zqda'] / 1000
+    print('import zqda: {:.1f} ms (best of {})'.format(total_ms, args.runs))
+    for name, us in sorted(timings.items(), key=lambda v: -v[1])[1:args.top + 1]:
+        print('  {:>8.1f} ms  {}'.format(us / 1000, name))
+
+    failed = False
+    if eager:
+        print('FAIL: imported eagerly: {}'.format(', '.join(eager)))
+        failed = True
+    if args.budget_ms and total_ms > args.budget_ms:
+        print('FAIL: over budget of {:.1f} ms'.format(args.budget_ms))
+        failed = True
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'import_ms': total_ms,
+                       'budget_ms': args.budget_ms,
+                       'eager_modules': eager,
+                       'modules_ms': {k: v / 1000 for k, v in timings.items()}},
+                      f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
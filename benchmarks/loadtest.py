@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+"""Load test the web application with concurrent clients.
+
+The application is served by a threaded WSGI server in a separate process,
+on top of a synthetic library (served by fake_zotero.py and synced into a
+fresh HOME) or of an existing synced HOME (--home). A number of clients,
+each with its own keep-alive connection, then send either a synthetic mix
+of requests (item pages, collection pages, tag lists, annotation reports,
+attachment downloads, library views; weights set with --mix) or the GET
+requests of a web server access log (--access-log, Common or Combined Log
+Format, replayed in order and repeated as needed):
+
+    python benchmarks/loadtest.py --items 10000 --concurrency 8 --duration 30
+    python benchmarks/loadtest.py --home /srv/zqda --access-log access.log
+
+Reported for each kind of request (or, for access logs, each Flask
+endpoint): requests, errors, throughput and p50/p95/p99 latency; for the
+server: peak and final resident set size, and item database opens, item
+lookups (_get_item) and Zotero API requests per request, from its metrics.
+A warm-up phase (--warmup seconds) fills caches before measuring. The
+synthetic mix is drawn from a seeded random generator, so runs with the
+same options send the same requests and are comparable. With --baseline,
+the results are compared to an earlier --json file and the script exits
+with status 1 if the p95 latency of any kind of request grew by more than
+--tolerance (or throughput dropped by as much):
+
+    python benchmarks/loadtest.py --json before.json
+    python benchmarks/loadtest.py --baseline before.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from bench import CONFIG, LIBRARY_ID, HERE, ROOT
+
+MIX = 'html=40,collection=15,tag_list=15,annotations=10,blob=10,library_view=5,json=5'
+LOG_LINE = re.compile(r'"(?P<method>[A-Z]+) (?P<path>\S+)(?: HTTP/[\d.]+)?" '
+                      r'(?P<status>\d{3})')
+
+
+# Server
+
+def serve(port, metrics_dir):
+    """Run the application in this process (HOME must already point to a
+    directory containing .config/zqda/config.toml). Prints the URL of the
+    server on stdout once it accepts connections."""
+    sys.path.insert(0, ROOT)
+    import zqda
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    zqda.app.config['METRICS_DIR'] = metrics_dir
+    zqda.app.config['METRICS_FLUSH_INTERVAL'] = 1
+
+    @zqda.app.after_request
+    def _endpoint_header(response):
+        # lets the client group access log requests by endpoint
+        from flask import request
+        response.headers['X-Endpoint'] = request.endpoint or 'none'
+        return response
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', port, zqda.app, threaded=True,
+                         request_handler=QuietHandler)
+    print('http://127.0.0.1:{}'.format(server.server_port), flush=True)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _proc_status(pid):
+    """VmRSS and VmHWM (peak) of a process in MB, or None where /proc is
+    not available."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            status = dict(line.split(':', 1) for line in f)
+        return (int(status['VmRSS'].split()[0]) / 1024,
+                int(status['VmHWM'].split()[0]) / 1024)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _server_metrics(url, metrics_dir):
+    """Aggregated counters of the server, after making it flush them."""
+    _get(url, '/metrics')
+    try:
+        with open(os.path.join(metrics_dir, 'metrics.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _by_endpoint(stored, name):
+    counts = {}
+    for labels, value in stored.get(name, {}).items():
+        m = re.search(r'endpoint="([^"]*)"', labels)
+        if m:
+            counts[m.group(1)] = counts.get(m.group(1), 0) + value
+    return counts
+
+
+def _delta(after, before):
+    return {k: v - before.get(k, 0) for k, v in after.items()
+            if v - before.get(k, 0)}
+
+
+def _api_requests(stored):
+    return sum(stored.get('zqda_zotero_api_requests_total', {}).values())
+
+
+# Requests
+
+def _get(url, path, headers=None):
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=120)
+    try:
+        conn.request('GET', path, headers=headers or {})
+        r = conn.getresponse()
+        return r.status, r.read()
+    finally:
+        conn.close()
+
+
+def _parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def synthetic_paths(url, library_id, mix, seed):
+    """An endless iterator of (kind, path) for the synthetic mix, drawn
+    from the items, collections and tags of the library."""
+    status, body = _get(url, '/json/{}?fields=key,itemType,contentType,'
+                        'linkMode'.format(library_id))
+    items = [json.loads(line) for line in body.decode('utf-8').splitlines()
+             if line.strip()]
+    keys = {'html': [], 'collection': [], 'blob': []}
+    for item in items:
+        if item.get('itemType') == 'collection':
+            keys['collection'].append(item['key'])
+        elif item.get('itemType') not in ('annotation', 'note'):
+            keys['html'].append(item['key'])
+        if item.get('itemType') == 'attachment' and \
+                item.get('linkMode') != 'linked_url':
+            keys['blob'].append(item['key'])
+    status, body = _get(url, '/tag_search/{}?limit=500'.format(library_id))
+    tags = [t['tag'] for t in json.loads(body)['tags']]
+    status, body = _get(url, '/annotations/{}'.format(library_id))
+    reports = sorted(set(re.findall(
+        r'href="(/annotations/{}/[^"]+)"'.format(library_id),
+        body.decode('utf-8'))))
+
+    quote = urllib.parse.quote
+    candidates = {
+        'html': ['/view/{}/{}'.format(library_id, k) for k in keys['html']],
+        'collection': ['/view/{}/{}'.format(library_id, k)
+                       for k in keys['collection']],
+        'tag_list': ['/tags/{}/{}'.format(library_id, quote(t, safe=''))
+                     for t in tags],
+        'annotations': reports,
+        'blob': ['/raw/{}/{}'.format(library_id, k) for k in keys['blob']],
+        'library_view': ['/view/{}'.format(library_id)],
+        'json': ['/json/{}/{}'.format(library_id, k) for k in keys['html']],
+    }
+    for kind in list(mix):
+        if kind not in candidates:
+            raise SystemExit('unknown request kind {!r} (known: {})'.format(
+                kind, ', '.join(candidates)))
+        if not candidates[kind]:
+            print('no {} requests in this library'.format(kind),
+                  file=sys.stderr)
+            del mix[kind]
+    return _draw(candidates, mix, seed)
+
+
+def _draw(candidates, mix, seed):
+    kinds = sorted(mix)
+    weights = [mix[k] for k in kinds]
+    rng = random.Random(seed)
+    while True:
+        kind = rng.choices(kinds, weights)[0]
+        yield kind, rng.choice(candidates[kind])
+
+
+def log_paths(path):
+    """An endless generator of (None, path) for the GET requests of an
+    access log; the kind of each request is the endpoint reported by the
+    server."""
+    paths = []
+    with open(path, errors='replace') as f:
+        for line in f:
+            m = LOG_LINE.search(line)
+            if m and m.group('method') == 'GET':
+                paths.append(m.group('path'))
+    if not paths:
+        raise SystemExit('no GET requests found in {}'.format(path))
+    return ((None, p) for p in itertools.cycle(paths))
+
+
+class Client(threading.Thread):
+    """Sends requests from a shared source over one keep-alive connection
+    until `stop` is set, recording (kind, seconds, status, bytes)."""
+
+    def __init__(self, url, source, lock, stop, headers):
+        super().__init__(daemon=True)
+        parts = urllib.parse.urlsplit(url)
+        self.address = (parts.hostname, parts.port)
+        self.source = source
+        self.lock = lock
+        self.stop = stop
+        self.headers = headers
+        self.results = []
+        self.started = None  # when measuring started
+
+    def run(self):
+        conn = http.client.HTTPConnection(*self.address, timeout=120)
+        while not self.stop.is_set():
+            with self.lock:
+                try:
+                    kind, path = next(self.source)
+                except StopIteration:
+                    return
+            t = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=self.headers)
+                r = conn.getresponse()
+                body = r.read()
+                status = r.status
+                kind = kind or r.getheader('X-Endpoint', 'none')
+                size = len(body)
+                if r.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(*self.address, timeout=120)
+                status = 'error'
+                kind = kind or 'none'
+                size = 0
+            if self.started is not None and t >= self.started:
+                self.results.append((kind, time.perf_counter() - t, status,
+                                     size))
+        conn.close()
+
+
+def _limited(source, n):
+    return itertools.islice(source, n) if n else source
+
+
+def run_load(url, source, concurrency, duration, requests, warmup, headers,
+             on_start=None):
+    """Send requests with `concurrency` clients: `warmup` seconds without
+    recording, then `duration` seconds or `requests` requests. `on_start`
+    is called when measuring starts. Returns the recorded results and the
+    measured time."""
+    lock = threading.Lock()
+    stop = threading.Event()
+    clients = [Client(url, source, lock, stop, headers)
+               for _ in range(concurrency)]
+    for c in clients:
+        c.start()
+    time.sleep(warmup)
+    with lock:
+        if on_start is not None:
+            on_start()
+        if requests:
+            source = _limited(source, requests)
+            for c in clients:
+                c.source = source
+        t = time.perf_counter()
+        for c in clients:
+            c.started = t
+    if requests:
+        for c in clients:
+            c.join()
+    else:
+        time.sleep(duration)
+        stop.set()
+        for c in clients:
+            c.join()
+    seconds = time.perf_counter() - t
+    return [r for c in clients for r in c.results], seconds
+
+
+# Reports
+
+def _percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+                  if p < 100 else -1]
+
+
+def summarize(results, seconds):
+    kinds = {}
+    for kind, latency, status, size in results:
+        kinds.setdefault(kind, []).append((latency, status, size))
+    report = {}
+    for kind, rs in sorted(kinds.items()):
+        latencies = sorted(r[0] * 1000 for r in rs)
+        report[kind] = {
+            'requests': len(rs),
+            'errors': sum(1 for r in rs if r[1] == 'error' or r[1] >= 500),
+            'requests_per_second': len(rs) / seconds,
+            'p50_ms': _percentile(latencies, 50),
+            'p95_ms': _percentile(latencies, 95),
+            'p99_ms': _percentile(latencies, 99),
+            'max_ms': latencies[-1],
+            'bytes_per_request': sum(r[2] for r in rs) / len(rs),
+        }
+    return report
+
+
+def print_report(result):
+    print('{:<14} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+        'request', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'KB/req'))
+    for kind, r in result['requests'].items():
+        print('{:<14} {:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} '
+              '{:>10.1f}'.format(kind, r['requests'], r['errors'],
+                                 r['requests_per_second'], r['p50_ms'],
+                                 r['p95_ms'], r['p99_ms'],
+                                 r['bytes_per_request'] / 1024))
+    print('total: {} requests in {:.1f} s, {:.1f} req/s with {} clients'.format(
+        result['total_requests'], result['seconds'],
+        result['requests_per_second'], result['concurrency']))
+    server = result['server']
+    if server.get('rss_mb') is not None:
+        print('server: {:.1f} MB resident, {:.1f} MB peak'.format(
+            server['rss_mb'], server['peak_rss_mb']))
+    if server['endpoints']:
+        print('{:<26} {:>8} {:>12} {:>14}'.format(
+            'endpoint', 'requests', 'dbm opens/req', 'get_item/req'))
+        for endpoint, e in sorted(server['endpoints'].items()):
+            print('{:<26} {:>8} {:>12.2f} {:>14.2f}'.format(
+                endpoint, e['requests'], e['dbm_opens_per_request'],
+                e['get_item_calls_per_request']))
+    print('Zotero API requests: {}'.format(server['api_requests']))
+
+
+def compare(result, baseline, tolerance):
+    """Print the change of p95 latency and throughput from a baseline and
+    return the names of the kinds of requests that got slower by more than
+    `tolerance`."""
+    regressions = []
+    print('{:<14} {:>12} {:>12} {:>8}'.format(
+        'request', 'base p95 ms', 'p95 ms', 'change'))
+    for kind, r in result['requests'].items():
+        base = baseline['requests'].get(kind)
+        if base is None or not base['p95_ms']:
+            continue
+        change = r['p95_ms'] / base['p95_ms'] - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(kind)
+            flag = ' slower'
+        print('{:<14} {:>12.1f} {:>12.1f} {:>+7.0%}{}'.format(
+            kind, base['p95_ms'], r['p95_ms'], change, flag))
+    change = result['requests_per_second'] / \
+        baseline['requests_per_second'] - 1
+    print('throughput: {:.1f} -> {:.1f} req/s ({:+.0%})'.format(
+        baseline['requests_per_second'], result['requests_per_second'],
+        change))
+    if change < -tolerance:
+        regressions.append('throughput')
+    return regressions
+
+
+# Setup
+
+def _write_config(home, url, library_id):
+    os.makedirs(os.path.join(home, '.config', 'zqda'))
+    with open(os.path.join(home, '.config', 'zqda', 'config.toml'), 'w') as f:
+        f.write(CONFIG.format(url=url, library_id=library_id))
+
+
+def _start(args, env):
+    p = subprocess.Popen(args, env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, text=True)
+    url = p.stdout.readline().strip()
+    if not url:
+        p.wait()
+        raise SystemExit('{} did not start'.format(os.path.basename(args[1])))
+    return p, url
+
+
+def _stop(p):
+    if p is not None and p.poll() is None:
+        p.send_signal(signal.SIGINT)
+        p.communicate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=10000,
+                        help='size of the synthetic library')
+    parser.add_argument('--file-size', type=int, default=16384)
+    parser.add_argument('--home', metavar='DIR',
+                        help='serve an existing HOME (configured and synced) '
+                        'instead of a synthetic library')
+    parser.add_argument('--library-id', default=LIBRARY_ID,
+                        help='library of the synthetic mix')
+    parser.add_argument('--access-log', metavar='FILE',
+                        help='replay the GET requests of an access log '
+                        'instead of the synthetic mix')
+    parser.add_argument('--mix', default=MIX,
+                        help='weights of the kinds of requests of the '
+                        'synthetic mix (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to measure (default: %(default)s)')
+    parser.add_argument('--requests', type=int,
+                        help='measure this many requests instead')
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='seconds of requests before measuring')
+    parser.add_argument('--bypass-cache', action='store_true',
+                        help='send a cookie with each request, so pages '
+                        'are rendered instead of served from the page cache')
+    parser.add_argument('--json', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare to the --json output of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed p95 latency growth and throughput loss '
+                        'relative to the baseline (default: %(default)s)')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--metrics-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.metrics_dir)
+        return
+
+    tmp = tempfile.mkdtemp(prefix='zqda-loadtest-')
+    fake = server = None
+    try:
+        if args.home:
+            home = os.path.abspath(args.home)
+        else:
+            fake, api_url = _start(
+                [sys.executable, os.path.join(HERE, 'fake_zotero.py'),
+                 '--items', str(args.items), '--library-id', args.library_id,
+                 '--file-size', str(args.file_size)], os.environ)
+            home = os.path.join(tmp, 'home')
+            _write_config(home, api_url, args.library_id)
+            print('syncing {} items...'.format(args.items), file=sys.stderr)
+            subprocess.run([sys.executable, '-m', 'flask', '--app', 'zqda',
+                            'sync-library'], cwd=ROOT, check=True,
+                           env=dict(os.environ, HOME=home),
+                           stdout=subprocess.DEVNULL)
+        metrics_dir = os.path.join(tmp, 'metrics')
+        os.makedirs(metrics_dir)
+        server, url = _start(
+            [sys.executable, os.path.abspath(__file__), '--serve',
+             '--metrics-dir', metrics_dir], dict(os.environ, HOME=home))
+
+        if args.access_log:
+            source = log_paths(args.access_log)
+        else:
+            source = synthetic_paths(url, args.library_id,
+                                     _parse_mix(args.mix), args.seed)
+        headers = {'Cookie': 'loadtest=1'} if args.bypass_cache else {}
+
+        # the warm-up phase is not counted in the server metrics either
+        before = {}
+        results, seconds = run_load(
+            url, source, args.concurrency, args.duration, args.requests,
+            args.warmup, headers,
+            lambda: before.update(_server_metrics(url, metrics_dir)))
+        after = _server_metrics(url, metrics_dir)
+        memory = _proc_status(server.pid)
+    finally:
+        _stop(server)
+        _stop(fake)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    requests = _by_endpoint(after, 'zqda_http_requests_total')
+    requests = _delta(requests, _by_endpoint(before, 'zqda_http_requests_total'))
+    requests.pop('metrics', None)
+    opens = _delta(_by_endpoint(after, 'zqda_dbm_opens_total'),
+                   _by_endpoint(before, 'zqda_dbm_opens_total'))
+    lookups = _delta(_by_endpoint(after, 'zqda_get_item_calls_total'),
+                     _by_endpoint(before, 'zqda_get_item_calls_total'))
+    result = {
+        'options': {k: v for k, v in vars(args).items()
+                    if k not in ('serve', 'port', 'metrics_dir', 'json',
+                                 'baseline')},
+        'concurrency': args.concurrency,
+        'seconds': seconds,
+        'total_requests': len(results),
+        'requests_per_second': len(results) / seconds,
+        'requests': summarize(results, seconds),
+        'server': {
+            'rss_mb': memory and memory[0],
+            'peak_rss_mb': memory and memory[1],
+            'api_requests': _api_requests(after) - _api_requests(before),
+            'endpoints': {
+                endpoint: {
+                    'requests': n,
+                    'dbm_opens_per_request': opens.get(endpoint, 0) / n,
+                    'get_item_calls_per_request': lookups.get(endpoint, 0) / n,
+                } for endpoint, n in requests.items()},
+        },
+    }
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print('regressions: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
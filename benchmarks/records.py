@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Compare the size and decode time of legacy JSON item records with the
+compact record format in zqda.records.
+
+By default a synthetic library (see synthlib.py) is used.
+Pass --db to measure the records of an existing items_<library_id>.db file
+instead (legacy records are converted in memory; the file is not modified):
+
+    python benchmarks/records.py --items 10000
+    python benchmarks/records.py --db ~/.local/share/zqda/items_1234567.db
+"""
+import argparse
+import dbm
+import json
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import synthlib  # noqa: E402
+from zqda import records  # noqa: E402
+
+
+def _time(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--db', help='path of an existing item database')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.db:
+        with dbm.open(args.db, 'r') as db:
+            items = [records.decode_item(db[k]) for k in db.keys()]
+    else:
+        items = list(synthlib.generate(args.items).objects.values())
+
+    legacy = [json.dumps(i, ensure_ascii=False).encode('utf-8') for i in items]
+    compact = [records.encode(i) for i in items]
+
+    results = [
+        ('size (bytes)', sum(map(len, legacy)), sum(map(len, compact))),
+        ("decode 'data' (ms)",
+         _time(lambda: [json.loads(r).get('data') for r in legacy], args.repeat) * 1000,
+         _time(lambda: [records.decode(r, 'data') for r in compact], args.repeat) * 1000),
+        ("decode 'bib' (ms)",
+         _time(lambda: [json.loads(r).get('bib') for r in legacy], args.repeat) * 1000,
+         _time(lambda: [records.decode(r, 'bib') for r in compact], args.repeat) * 1000),
+    ]
+    print('{} records'.format(len(items)))
+    print('{:<20} {:>14} {:>14} {:>8}'.format('', 'json', 'compact', 'ratio'))
+    for name, before, after in results:
+        print('{:<20} {:>14.1f} {:>14.1f} {:>8.2f}'.format(
+            name, before, after, after / before if before else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Measure the peak memory of an initial sync for several library sizes.
+
+For each size a synthetic library is served by fake_zotero.py and a fresh
+zqda process syncs it from version 0, attachments included. The peak
+resident set size of the process is reported before the sync (after the
+imports) and after it; the difference is what the sync itself needed.
+Sync fetches, stores and discards one page of changes at a time, so the
+difference should stay roughly flat as the library grows. Exits with
+status 1 if it grows by more than --max-growth-mb between the smallest
+and the largest size, so the script can be used as a CI check:
+
+    python benchmarks/sync_memory.py --sizes 1000 10000 50000 --json sync_memory.json
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import CONFIG, LIBRARY_ID, ROOT, HERE, _peak_rss_mb
+
+
+def run_worker(library_id=LIBRARY_ID):
+    """Sync in this process. HOME must already point to a directory
+    containing .config/zqda/config.toml."""
+    sys.path.insert(0, ROOT)
+    import zqda
+    import zqda.core as core
+
+    with zqda.app.app_context():
+        before = _peak_rss_mb()
+        t = time.perf_counter()
+        message = core._sync_items(library_id)
+        seconds = time.perf_counter() - t
+    after = _peak_rss_mb()
+    return {'message': message, 'seconds': seconds,
+            'peak_rss_before_mb': before, 'peak_rss_after_mb': after,
+            'sync_mb': after - before}
+
+
+def run_size(items, file_size):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, 'fake_zotero.py'),
+         '--items', str(items), '--library-id', LIBRARY_ID,
+         '--file-size', str(file_size)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        url = server.stdout.readline().strip()
+        with tempfile.TemporaryDirectory() as home:
+            os.makedirs(os.path.join(home, '.config', 'zqda'))
+            with open(os.path.join(home, '.config', 'zqda', 'config.toml'), 'w') as f:
+                f.write(CONFIG.format(url=url, library_id=LIBRARY_ID))
+            p = subprocess.run([sys.executable, __file__, '--worker'],
+                               env=dict(os.environ, HOME=home),
+                               capture_output=True, text=True)
+            if p.returncode:
+                sys.stderr.write(p.stderr)
+                raise SystemExit('sync failed for {} items'.format(items))
+            result = json.loads(p.stdout.strip().splitlines()[-1])
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.communicate()
+    result['items'] = items
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--file-size', type=int, default=16384)
+    parser.add_argument('--max-growth-mb', type=float, default=32,
+                        help='allowed growth of the sync memory between '
+                        'the smallest and the largest size')
+    parser.add_argument('--json', metavar='FILE')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker()))
+        return
+
+    print('{:>8} {:>10} {:>12} {:>12} {:>10}'.format(
+        'items', 'seconds', 'before MB', 'peak MB', 'sync MB'))
+    runs = []
+    for items in sorted(args.sizes):
+        r = run_size(items, args.file_size)
+        print('{:>8} {:>10.1f} {:>12.1f} {:>12.1f} {:>10.1f}'.format(
+            items, r['seconds'], r['peak_rss_before_mb'],
+            r['peak_rss_after_mb'], r['sync_mb']))
+        runs.append(r)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+    growth = runs[-1]['sync_mb'] - runs[0]['sync_mb']
+    print('growth: {:.1f} MB (max {:.1f} MB)'.format(growth, args.max_growth_mb))
+    if growth > args.max_growth_mb:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Synthetic Zotero group libraries for benchmarks.
+
+A library consists of collections (some nested), top-level documents filed
+in one or more collections, a PDF attachment for most documents, child
+notes, and annotations on the attachments. Tags are drawn from a fixed
+vocabulary, either uniformly or with a Zipf distribution, which is closer
+to real coding schemes: a few broad codes are applied very often and most
+codes rarely.
+
+Objects are shaped like the JSON returned by the Zotero web API, so they
+can be served by fake_zotero.py or written straight into an item database.
+"""
+import hashlib
+import itertools
+import random
+
+WORDS = ('the of and to in a is that for it as was with be by on not this '
+         'are or from at which but have an they were her there been one all '
+         'their has would when if no will more can out who time into only '
+         'some could them other then its than like first these also two may '
+         'after new years most over such through where before well should '
+         'much being those people made many between even each very our back '
+         'used state under now make both good great work same').split()
+
+KEY_CHARS = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+
+
+class Library(object):
+    """A generated library: `objects` maps keys to API objects, in version
+    order. Attachment file contents are generated on demand by `file`."""
+
+    def __init__(self, library_id, objects, file_size):
+        self.library_id = library_id
+        self.objects = objects
+        self.file_size = file_size
+        self.version = max([o['version'] for o in objects.values()] or [0])
+        self.group_version = 1
+
+    def file(self, key):
+        """Return the deterministic file contents of an attachment."""
+        return _file_bytes(key, self.file_size)
+
+    def items(self):
+        return [o for o in self.objects.values()
+                if o['data']['itemType'] != 'collection']
+
+    def collections(self):
+        return [o for o in self.objects.values()
+                if o['data']['itemType'] == 'collection']
+
+    def bump(self, keys):
+        """Mark objects as modified, as if they had been edited remotely."""
+        for key in keys:
+            self.version += 1
+            obj = self.objects[key]
+            obj['version'] = obj['data']['version'] = self.version
+
+
+def _file_bytes(key, size):
+    header = b'%PDF-1.4\n% synthetic attachment ' + key.encode('ascii') + b'\n'
+    block = hashlib.sha256(key.encode('ascii')).digest()
+    body = block * ((size - len(header)) // len(block) + 1)
+    return (header + body)[:max(size, len(header))]
+
+
+def _text(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def generate(items=1000, collections=None, annotations=0.75, tags=None,
+             tag_distribution='zipf', tags_per_annotation=2, file_size=16384,
+             library_id='1234567', seed=0):
+    """Generate a library with roughly `items` objects in total.
+
+    `collections` defaults to one per 100 items. `annotations` is the share
+    of all objects that are annotations; the remainder is split between
+    documents, their PDF attachments and notes. `tags` is the size of the
+    tag vocabulary (default: about 4 per 100 items); `tag_distribution` is
+    'zipf' or 'uniform'.
+    """
+    rng = random.Random(seed)
+    used = set()
+
+    def new_key():
+        while True:
+            key = ''.join(rng.choice(KEY_CHARS) for _ in range(8))
+            if key not in used:
+                used.add(key)
+                return key
+
+    n_collections = collections if collections is not None else max(1, items // 100)
+    n_annotations = int(items * annotations)
+    rest = max(0, items - n_collections - n_annotations)
+    n_documents = max(1, rest * 4 // 9)
+    n_attachments = n_documents
+    n_notes = max(0, rest - n_documents - n_attachments)
+
+    vocabulary = ['code {} {}'.format(i, _text(rng, 1))
+                  for i in range(tags or max(10, items // 25))]
+    if tag_distribution == 'zipf':
+        weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    else:
+        weights = [1.0] * len(vocabulary)
+    cumulative = list(itertools.accumulate(weights))
+
+    def pick_tags(n):
+        return [{'tag': t} for t in
+                sorted(set(rng.choices(vocabulary, cum_weights=cumulative, k=n)))]
+
+    version = itertools.count(1)
+    objects = {}
+
+    def add(data, bib=None):
+        data['version'] = next(version)
+        data.setdefault('tags', [])
+        data.setdefault('relations', {})
+        data['dateAdded'] = data['dateModified'] = '2023-01-01T00:00:00Z'
+        obj = {'key': data['key'], 'version': data['version'],
+               'library': {'type': 'group', 'id': int(library_id),
+                           'name': 'Synthetic library', 'links': {}},
+               'links': {'self': {'href': 'https://api.zotero.org/groups/{}/items/{}'.format(
+                   library_id, data['key']), 'type': 'application/json'}},
+               'meta': {'numChildren': 0},
+               'data': data}
+        if bib is not None:
+            obj['bib'] = bib
+        objects[data['key']] = obj
+        return data
+
+    collection_keys = []
+    for i in range(n_collections):
+        parent = False
+        if collection_keys and rng.random() < 0.2:
+            parent = rng.choice(collection_keys)
+        collection_keys.append(add({'key': new_key(), 'itemType': 'collection',
+                                    'name': 'Collection {} {}'.format(i, _text(rng, 2)),
+                                    'parentCollection': parent})['key'])
+
+    documents = []
+    for i in range(n_documents):
+        title = _text(rng, 8).capitalize()
+        author = _text(rng, 1).capitalize()
+        documents.append(add({
+            'key': new_key(), 'itemType': 'journalArticle', 'title': title,
+            'creators': [{'creatorType': 'author', 'firstName': 'A.',
+                          'lastName': author}],
+            'abstractNote': _text(rng, rng.randint(0, 150)),
+            'date': str(rng.randint(1950, 2023)),
+            'collections': rng.sample(collection_keys,
+                                      k=min(len(collection_keys), rng.randint(1, 2))),
+            'tags': pick_tags(rng.randint(0, 2)),
+        }, bib='<div class="csl-bib-body"><div class="csl-entry">{}. {}.</div></div>'.format(
+            author, title))['key'])
+
+    attachments = []
+    for i in range(n_attachments):
+        key = new_key()
+        attachments.append(add({
+            'key': key, 'itemType': 'attachment', 'parentItem': documents[i],
+            'linkMode': 'imported_file', 'title': 'Full Text PDF',
+            'contentType': 'application/pdf', 'filename': 'document {}.pdf'.format(i),
+            'md5': hashlib.md5(_file_bytes(key, file_size)).hexdigest(),
+            'mtime': 1672531200000,
+        })['key'])
+
+    for i in range(n_notes):
+        add({'key': new_key(), 'itemType': 'note',
+             'parentItem': rng.choice(documents),
+             'note': '<h1>Note {}</h1><p>{}</p>'.format(i, _text(rng, rng.randint(20, 300)))})
+
+    for i in range(n_annotations):
+        page = rng.randint(0, 30)
+        add({'key': new_key(), 'itemType': 'annotation',
+             'parentItem': rng.choice(attachments),
+             'annotationType': 'highlight',
+             'annotationText': _text(rng, rng.randint(10, 80)),
+             'annotationComment': _text(rng, rng.randint(0, 20)),
+             'annotationColor': '#ffd400',
+             'annotationPageLabel': str(page + 1),
+             'annotationSortIndex': '{:05d}|{:06d}|{:05d}'.format(
+                 page, rng.randint(0, 999999), rng.randint(0, 99999)),
+             'annotationPosition': '{{"pageIndex":{},"rects":[[108.0,520.3,504.1,532.2]]}}'.format(page),
+             'tags': pick_tags(rng.randint(1, tags_per_annotation * 2 - 1))})
+
+    return Library(library_id, objects, file_size)
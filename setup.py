@@ -14,6 +14,9 @@ setup(
         'Flask-Caching',
         # 'python-slugify'
     ],
+    extras_require={
+        'images': ['Pillow', 'PyMuPDF'],
+    },
 )
 
 # https://github.com/mardix/flask-recaptcha
@@ -1,5 +1,5 @@
 import os
-import toml
+import marshal
 from flask import Flask, abort
 
 app = Flask(__name__)
@@ -20,26 +20,97 @@ app.config.from_mapping(
     EXPORT=True,
     CACHE_DEFAULT_TIMEOUT=31536000,
     CACHE_TYPE='FileSystemCache',
-    CACHE_DIR=os.path.join(app.data_path, 'cache')
+    CACHE_DIR=os.path.join(app.data_path, 'cache'),
+    ZOTERO_API_URL='https://api.zotero.org',
+    ZOTERO_RATE_LIMIT=10,  # requests per second, per process
+    ZOTERO_RATE_BURST=20,
+    ZOTERO_RETRIES=4,
+    ZOTERO_RECORD=None,  # cassette file for recording API traffic
+    METRICS_DIR=None,  # shared directory for /metrics; None disables metrics
+    METRICS_FLUSH_INTERVAL=5,  # seconds
+    ADMIN_KEYS=[],  # passkeys for all libraries and for request profiling
+    PROFILE_INTERVAL=0.001,  # seconds between samples of profiled requests
+    SLOW_REQUEST_THRESHOLD=None,  # seconds; None disables the slow request log
+    SLOW_REQUEST_INTERVAL=0.01,
+    WARM_CACHE=False,  # render the main pages into the cache after a sync
+    WARM_TOP_N=20,  # number of most viewed pages to render
+    STATIC_EXPORT_DIR=None,  # update a static export of the site after syncs
+    ATTACHMENT_QUOTA=None,  # bytes of attachment files to keep; None is no limit
+    ATTACHMENT_PREFETCH_N=0,  # most requested attachments to download after syncs
+    REPLICA_DIR=None,  # update a snapshot for read replicas after syncs
+    COMPRESS_MIN_SIZE=1024,  # bytes; None disables response compression
+    THUMBNAIL_WIDTHS=[160, 320, 640, 1280],  # pixels; allowed thumbnail widths
+    DERIVATIVE_WORKERS=2,  # threads generating thumbnails for rendered pages
     )
 
-try:
-    os.makedirs(app.config_path)
-    os.makedirs(app.data_path)
-except OSError:
-    pass
+for path in (app.config_path, app.data_path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        pass
+
+
+
+def _load_config(cfg):
+    """Load the TOML configuration file. The parsed mapping is kept in a
+    marshal file in the data directory and reused while the size and
+    modification time of `cfg` are unchanged, so that the TOML parser is
+    not imported on every CGI request. Configurations that marshal can't
+    store (TOML datetimes) are marked as such, and parsed every time."""
+    st = os.stat(cfg)
+    stamp = (st.st_mtime_ns, st.st_size)
+    snapshot = os.path.join(app.data_path, 'config.marshal')
+    try:
+        with open(snapshot, 'rb') as f:
+            cached_stamp, t = marshal.load(f)
+        if tuple(cached_stamp) == stamp:
+            if t is not None:
+                return t
+            import toml  # known not to be marshalable
+            return toml.load(cfg)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    import toml
+    t = toml.load(cfg)
+    try:
+        data = marshal.dumps((stamp, t))
+    except ValueError:  # TOML datetimes
+        data = marshal.dumps((stamp, None))
+    tmp = '{}.{}'.format(snapshot, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, snapshot)
+    except OSError:  # unwritable directory
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return t
+
 
 cfg = os.path.join(app.config_path, 'config.toml')
 # app.config.from_file() available in flask > 2.0
 try:
-    t = toml.load(cfg)
+    t = _load_config(cfg)
 except FileNotFoundError:
     abort(500, 'No configuration available')
 app.config.from_mapping(t)
 
 
 # These imports must come at the bottom of the file
+import zqda.metrics
 import zqda.core
+import zqda.profiler
+import zqda.assets
+import zqda.derivatives
+import zqda.export
+import zqda.replica
+import zqda.integrity
+import zqda.annotation_export
 import zqda.annotation_viewer
+import zqda.federated
+import zqda.tag_search
 import zqda.tag_grouper
 import zqda.tag_renamer
@@ -0,0 +1,299 @@
+import csv
+import html
+import io
+import json
+import re
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+import click
+from flask import Response, abort, request, stream_with_context
+
+from zqda import app
+from zqda import records
+import zqda.core
+
+# Bulk export of annotations.
+#
+# Annotations are generated one attachment at a time: the annotations of
+# an attachment are read from the item database, sorted by their position
+# in the document and written out before the next attachment is read, so
+# memory use does not grow with the size of the export and the first rows
+# are sent immediately.
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'md': 'text/markdown',
+    'qde': 'application/xml',  # REFI-QDA project file
+}
+
+CHUNK_SIZE = 32768
+
+FIELDS = ('key', 'document', 'attachment', 'citation', 'page', 'color',
+          'type', 'text', 'comment', 'tags')
+
+
+def _text(markup):
+    """Plain text of an HTML fragment such as a formatted citation."""
+    return html.unescape(re.sub(r'<[^>]+>', '', markup or '')).strip()
+
+
+def _str(key):
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+def _collection_members(library_id, collection):
+    """Keys of the items in a collection and its subcollections."""
+    collections = zqda.core._get_collections(library_id)
+    seen = set()
+    pending = [collection]
+    while pending:
+        c = pending.pop()
+        if c in seen:
+            continue
+        seen.add(c)
+        for key in collections.get(c, []):
+            key = _str(key)
+            if key in collections:  # a subcollection
+                pending.append(key)
+            else:
+                yield key
+
+
+def _parents(library_id, collection=None, document=None):
+    """Keys of the items whose children may be annotations."""
+    children = zqda.core._get_children(library_id)
+    if document:
+        documents = [document]
+    elif collection:
+        documents = _collection_members(library_id, collection)
+    else:
+        yield from children
+        return
+    for key in documents:
+        yield key  # may itself be an attachment
+        yield from children.get(key, [])
+
+
+def annotations(library_id, tag=None, collection=None, document=None):
+    """Generate the annotations of a library as dicts with the keys in
+    FIELDS, optionally only those with a tag, in a collection (including
+    subcollections) or on a document (or attachment)."""
+    item_cache = zqda.core._item_cache(library_id)
+    if not zqda.core._exists(item_cache):
+        return
+    children = zqda.core._get_children(library_id)
+    tagged = None
+    if tag is not None:
+        tagged = set(zqda.core._get_tags(library_id).get(tag, []))
+        if not tagged:
+            return
+
+    with zqda.core._open_db(item_cache) as db:
+        def get(key, field='data'):
+            try:
+                return records.decode(db[key], field)
+            except KeyError:
+                return None
+
+        seen = set()
+        for parent in _parents(library_id, collection, document):
+            if parent in seen:
+                continue
+            seen.add(parent)
+            keys = [_str(k) for k in children.get(parent, [])]
+            if tagged is not None:
+                keys = [k for k in keys if k in tagged]
+            group = [d for d in map(get, keys)
+                     if d and d.get('itemType') == 'annotation']
+            if not group:
+                continue
+            group.sort(key=lambda d: d.get('annotationSortIndex', ''))
+            attachment = get(parent) or {}
+            document_key = attachment.get('parentItem', '')
+            citation = _text(get(document_key, 'bib')) if document_key else ''
+            if not citation:
+                citation = attachment.get('title', '')
+            for d in group:
+                yield {
+                    'key': d['key'],
+                    'document': document_key,
+                    'attachment': parent,
+                    'citation': citation,
+                    'page': d.get('annotationPageLabel', ''),
+                    'color': d.get('annotationColor', ''),
+                    'type': d.get('annotationType', ''),
+                    'text': d.get('annotationText', ''),
+                    'comment': d.get('annotationComment', ''),
+                    'tags': [t['tag'] for t in d.get('tags', [])],
+                    'position': d.get('annotationPosition'),
+                    'filename': attachment.get('filename', ''),
+                }
+
+
+def to_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow([row[f] if f != 'tags' else '; '.join(row[f])
+                         for f in FIELDS])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def to_jsonl(rows):
+    for row in rows:
+        yield json.dumps({f: row[f] for f in FIELDS}, ensure_ascii=False) + '\n'
+
+
+def to_markdown(rows):
+    attachment = None
+    for row in rows:
+        if row['attachment'] != attachment:
+            attachment = row['attachment']
+            yield '\n## {}\n\n'.format(row['citation'] or attachment)
+        out = ['> {}'.format(line) for line in
+               (row['text'] or '').splitlines() or ['']]
+        out.append('')
+        if row['comment']:
+            out.append(row['comment'])
+            out.append('')
+        details = ['p. {}'.format(row['page'])] if row['page'] else []
+        details.extend('`{}`'.format(t) for t in row['tags'])
+        if details:
+            out.append('*{}*'.format(', '.join(details)))
+            out.append('')
+        yield '\n'.join(out) + '\n'
+
+
+def _guid(name):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name)).upper()
+
+
+def _selection_box(position):
+    """Page index and bounding box of an annotation position."""
+    try:
+        position = json.loads(position)
+        rects = position['rects']
+        return (position.get('pageIndex', 0),
+                min(r[0] for r in rects), min(r[1] for r in rects),
+                max(r[2] for r in rects), max(r[3] for r in rects))
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+
+
+def to_refi_qda(rows, library_id, codes):
+    """REFI-QDA project (project.qde) with the tags as codes and the
+    annotations as coded PDF selections. Tags that are not in `codes` are
+    left out of the codings, so that every coding refers to a code."""
+    codes = set(codes)
+    base = 'https://zotero.org/groups/{}/'.format(library_id)
+    title = zqda.core._get_library_data(library_id)['title']
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<Project xmlns="urn:QDA-XML:project:1.0" name={} origin="zqda">\n'
+           '<CodeBook><Codes>\n').format(quoteattr(title))
+    for code in sorted(codes):
+        yield '<Code guid="{}" name={} isCodable="true"/>\n'.format(
+            _guid(base + 'tags/' + code), quoteattr(code))
+    yield '</Codes></CodeBook>\n<Sources>\n'
+    attachment = None
+    for row in rows:
+        if row['attachment'] != attachment:
+            if attachment is not None:
+                yield '</PDFSource>\n'
+            attachment = row['attachment']
+            yield '<PDFSource guid="{}" name={} path={}>\n'.format(
+                _guid(base + 'items/' + attachment),
+                quoteattr(row['citation'] or attachment),
+                quoteattr('relative:///' + (row['filename'] or attachment)))
+        box = _selection_box(row['position'])
+        if box is None:
+            continue
+        page, x1, y1, x2, y2 = box
+        out = ['<PDFSelection guid="{}" name={} page="{}" firstX="{}" '
+               'firstY="{}" secondX="{}" secondY="{}">'.format(
+                   _guid(base + 'items/' + row['key']),
+                   quoteattr(row['text'] or ''), page,
+                   int(x1), int(y1), int(x2), int(y2))]
+        if row['comment']:
+            out.append('<Description>{}</Description>'.format(
+                escape(row['comment'])))
+        for tag in row['tags']:
+            if tag not in codes:
+                continue
+            out.append('<Coding guid="{}"><CodeRef targetGUID="{}"/></Coding>'.format(
+                _guid(base + 'items/{}/tags/{}'.format(row['key'], tag)),
+                _guid(base + 'tags/' + tag)))
+        out.append('</PDFSelection>\n')
+        yield ''.join(out)
+    if attachment is not None:
+        yield '</PDFSource>\n'
+    yield '</Sources>\n</Project>\n'
+
+
+def _buffered(chunks, size=CHUNK_SIZE):
+    """Join small chunks into chunks of about `size` characters, so that
+    a response is not sent in one write per row."""
+    buf = []
+    n = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            yield ''.join(buf)
+            buf = []
+            n = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def export(library_id, fmt, tag=None, collection=None, document=None):
+    """Generate an annotation export in one of FORMATS as text chunks."""
+    rows = annotations(library_id, tag, collection, document)
+    if fmt == 'csv':
+        chunks = to_csv(rows)
+    elif fmt == 'jsonl':
+        chunks = to_jsonl(rows)
+    elif fmt == 'md':
+        chunks = to_markdown(rows)
+    else:
+        codes = [tag] if tag else list(zqda.core._get_tags(library_id))
+        chunks = to_refi_qda(rows, library_id, codes)
+    return _buffered(chunks)
+
+
+@app.route('/export/<library_id>/annotations.<fmt>')
+def export_annotations(library_id, fmt):
+    """Download the annotations of a library as CSV, JSON lines (jsonl),
+    Markdown (md) or a REFI-QDA project file (qde). The optional URL
+    parameters `tag`, `collection` and `document` restrict the export to
+    annotations with a tag, in a collection, or on a document."""
+    if library_id not in app.config['LIBRARY'] or fmt not in FORMATS:
+        abort(404)
+    args = request.args
+    chunks = export(library_id, fmt, args.get('tag'), args.get('collection'),
+                    args.get('document'))
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[fmt])
+    filename = 'annotations-{}.{}'.format(library_id, fmt)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename="{}"'.format(filename)
+    return response
+
+
+@app.cli.command('export-annotations')
+@click.argument('library_id')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+              default='csv')
+@click.option('--tag', default=None)
+@click.option('--collection', default=None)
+@click.option('--document', default=None)
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-')
+def export_annotations_command(library_id, fmt, tag, collection, document,
+                               output):
+    """Export the annotations of a library to a file (default: stdout)."""
+    for chunk in export(library_id, fmt, tag, collection, document):
+        output.write(chunk)
@@ -1,38 +1,176 @@
+import html
+import os
+import re
+import threading
+
 from zqda import app
-from flask import render_template, url_for
-from markupsafe import Markup
-from pyzotero import zotero
+from zqda import records
+from zqda import snapshot
+from flask import render_template, url_for, abort
+from markupsafe import Markup, escape
+from zqda.assets import asset_url
 import zqda.core
 
+# Annotation reports.
+#
+# The annotations of a tag are listed grouped by the document they belong
+# to (the parent item of the annotated attachment), a page of documents at
+# a time; the annotations of a document are loaded when its group is
+# opened, from a page of their own (which is also what browsers without
+# JavaScript and static exports get). Within a document, annotations are
+# ordered by their position (annotationSortIndex).
+#
+# The grouping is precomputed at the end of each sync for every tag of the
+# library: the documents with their citations and the ordered keys of
+# their annotations, stored in data_path/annotations_<library>.pickle. It
+# is rebuilt (on first use) whenever the snapshot of the library has been
+# rebuilt, which happens whenever tags or parents change.
+
+DOCUMENTS_PER_PAGE = 25
+
+_summaries = {}
+_lock = threading.Lock()
+
+
+def _summary_path(library_id):
+    return os.path.join(app.data_path, 'annotations_{}.pickle'.format(library_id))
+
+
+def _stamp(library_id):
+    try:
+        st = os.stat(snapshot.snapshot_path(library_id))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _title_text(title):
+    return html.unescape(re.sub(r'<[^>]+>', '', title or '')).strip()
+
+
+def build_summaries(library_id):
+    """Group the annotations of a library by tag and document, in a single
+    pass over the item database, and store the result. Returns
+    {tag: {'annotations': n, 'documents': [{'key', 'title', 'annotations':
+    [annotation keys]}]}}."""
+    stamp = _stamp(library_id)
+    item_cache = zqda.core._item_cache(library_id)
+    if not zqda.core._exists(item_cache):
+        return {}
+    annotations = {}  # tag -> [(attachment, sort index, key)]
+    parents = {}  # attachment -> parent item
+    with zqda.core._open_db(item_cache) as db:
+        for k in db.keys():
+            data = records.decode(db[k])
+            if data['itemType'] == 'attachment':
+                parents[data['key']] = data.get('parentItem')
+            elif data['itemType'] == 'annotation':
+                entry = (data.get('parentItem'),
+                         data.get('annotationSortIndex', ''), data['key'])
+                for tag in data.get('tags', []):
+                    annotations.setdefault(tag['tag'], []).append(entry)
+
+        titles = {}
+
+        def title(document):
+            if document not in titles:
+                try:
+                    raw = db[document]
+                except KeyError:
+                    titles[document] = 'No title'
+                    return titles[document]
+                data = records.decode(raw)
+                titles[document] = records.decode(raw, 'bib') or \
+                    data.get('title') or data.get('filename') or 'No title'
+            return titles[document]
+
+        summaries = {}
+        for tag, entries in annotations.items():
+            documents = {}
+            for attachment, sort_index, key in entries:
+                document = parents.get(attachment) or attachment
+                documents.setdefault(document, []).append((sort_index, key))
+            groups = [{'key': document, 'title': title(document),
+                       'annotations': [key for _, key in sorted(keys)]}
+                      for document, keys in documents.items() if document]
+            groups.sort(key=lambda g: _title_text(g['title']).casefold())
+            summaries[tag] = {'annotations': len(entries), 'documents': groups}
+
+    zqda.core._write_pickle(_summary_path(library_id),
+                            {'stamp': stamp, 'tags': summaries})
+    with _lock:
+        _summaries[library_id] = (stamp, summaries)
+    return summaries
+
+
+def _stored(library_id, stamp):
+    """The summaries of a library if they were built for the snapshot with
+    `stamp`, from memory or from disk; None otherwise."""
+    with _lock:
+        cached = _summaries.get(library_id)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    stored = zqda.core._read_pickle(_summary_path(library_id))
+    if stored is not None and stored['stamp'] == stamp:
+        with _lock:
+            _summaries[library_id] = (stamp, stored['tags'])
+        return stored['tags']
+    return None
+
 
-def _get_parent_title(library_id, parentItem):
-    """Retrieve the bibliographic citation for the parent item of a PDF
-    attachment containing an annotation."""
-    parent_item = zqda.core._get_item(
-        library_id, parentItem)  # the PDF attachment
-    if not parent_item:
-        return 'No title'
-    grandparent_item = zqda.core._get_item(library_id,
-                                           parent_item['parentItem'], data='bib')  # main item
-    title = grandparent_item
-    return title
+def summaries(library_id):
+    """The annotation summaries of a library (see build_summaries), from
+    memory, from disk, or rebuilt if the snapshot has changed."""
+    tags = _stored(library_id, _stamp(library_id))
+    if tags is None:
+        tags = build_summaries(library_id)
+    return tags
+
+
+def update_summaries(library_id):
+    """Rebuild the summaries of a library if its snapshot has changed since
+    they were built. Returns the new summaries, or None if they were
+    current."""
+    if _stored(library_id, _stamp(library_id)) is not None:
+        return None
+    return build_summaries(library_id)
+
+
+def report_urls(library_id, tag):
+    """URLs of the pages of the annotation report of a tag after the
+    first one, and of its document groups (for static exports)."""
+    summary = summaries(library_id).get(tag)
+    if summary is None:
+        return []
+    n = len(summary['documents'])
+    urls = [url_for('show_annotations_page', library_id=library_id, tag=tag,
+                    page=page)
+            for page in range(2, (n - 1) // DOCUMENTS_PER_PAGE + 2)]
+    urls.extend(url_for('show_annotation_group', library_id=library_id,
+                        tag=tag, document=d['key'])
+                for d in summary['documents'])
+    return urls
 
 
 @app.route('/annotations/<library_id>')
+@zqda.core.cache.page()
 def show_annotations_tag_select(library_id):
     """Show a list of tags associated with annotations in the selected
-    group library."""
+    group library, with the number of annotations and documents."""
     title = 'Annotation viewer'
     help = 'Please select a tag.'
     out = []
-    tags = zqda.core._get_tags(library_id)
+    tags = summaries(library_id)
     out.append('<ul>')
 
     for tag in sorted(tags):
         # escaped = urllib.parse.quote(tag)
         link = url_for('show_annotations', library_id=library_id,
                        tag=tag)
-        out.append('<li><a href="{}">{}</a></li>'.format(link, tag))
+        out.append('<li><a href="{}">{}</a> <span class="text-muted">'
+                   '({} annotations in {} documents)</span></li>'.format(
+                       link, escape(tag), tags[tag]['annotations'],
+                       len(tags[tag]['documents'])))
     out.append('</ul>')
 
     return render_template('base.html',
@@ -44,51 +182,121 @@ def show_annotations_tag_select(library_id):
                            )
 
 
+def _pagination(library_id, tag, page, pages):
+    if pages < 2:
+        return ''
+    out = ['<nav><ul class="pagination flex-wrap">']
+    for n in range(1, pages + 1):
+        if n == 1:
+            link = url_for('show_annotations', library_id=library_id, tag=tag)
+        else:
+            link = url_for('show_annotations_page', library_id=library_id,
+                           tag=tag, page=n)
+        out.append('<li class="page-item{}"><a class="page-link" href="{}">'
+                   '{}</a></li>'.format(' active' if n == page else '',
+                                        link, n))
+    out.append('</ul></nav>')
+    return ''.join(out)
+
+
 @app.route('/annotations/<library_id>/<tag>')
-def show_annotations(library_id, tag):
+@app.route('/annotations/<library_id>/<tag>/page/<int:page>',
+           endpoint='show_annotations_page')
+@zqda.core.cache.page()
+def show_annotations(library_id, tag, page=1):
     """Show the annotations associated with a single tag in a Zotero group
-    library. Each annotation is presented as applicable with the highlighted 
-    text passage from the PDF, editor comments, and a list of tags applied
-    to the annotation."""
+    library, grouped by document, 25 documents per page. The annotations
+    of a document are loaded when its group is opened."""
+    summary = summaries(library_id).get(tag)
+    if summary is None:
+        abort(404)
+    documents = summary['documents']
+    pages = max((len(documents) - 1) // DOCUMENTS_PER_PAGE + 1, 1)
+    if not 1 <= page <= pages:
+        abort(404)
+
+    out = ['<p class="text-muted">{} annotations in {} documents</p>'.format(
+        summary['annotations'], len(documents))]
+    start = (page - 1) * DOCUMENTS_PER_PAGE
+    for document in documents[start:start + DOCUMENTS_PER_PAGE]:
+        zqda.core._depends_on(document['key'])
+        link = url_for('show_annotation_group', library_id=library_id,
+                       tag=tag, document=document['key'])
+        out.append('<details class="annotation-group mb-3" data-url="{}">'
+                   '<summary><div class="b d-inline-block">{}</div> '
+                   '<a class="badge bg-primary text-decoration-none" '
+                   'href="{}">{}</a></summary>'
+                   '<div class="annotation-list ms-4"></div>'
+                   '</details>'.format(link, document['title'], link,
+                                       len(document['annotations'])))
+    out.append(_pagination(library_id, tag, page, pages))
+    out.append('<script src="{}"></script>'.format(
+        asset_url('annotation_groups.js')))
+    return render_template('base.html',
+                           library_id=library_id,
+                           content=Markup(' '.join(out)),
+                           title='Annotations - {}'.format(tag),
+                           logged_in=zqda.core._check_key(library_id)
+                           )
+
+
+def _annotation_html(library_id, i):
+    from zqda.derivatives import annotation_image_url
     out = []
-    api_key = app.config['LIBRARY'][library_id]['api_key']
-    zot = zotero.Zotero(library_id, 'group', api_key)
-    items = zot.items(tag=tag,
-                      itemType='annotation',
-                      format='keys')
-    items = items.decode('utf-8').splitlines()
-
-    # We still get an empty value.
-    # if len(items) == 0:
-    #     return render_template('base.html', content="No results!")
-
-    out.append('<ol>')
-
-    for item_key in items:
-        if item_key == '':
-            continue
-        i = zqda.core._get_item(library_id, item_key)
-        if not i:
-            continue
-        zotero_link = 'zotero://open-pdf/groups/{}/items/{}?page={}&annotation={}'.format(
-            library_id,
-            i['parentItem'],
-            i['annotationPageLabel'],
-            i['key']
-        )
-        title = _get_parent_title(library_id, i['parentItem'])
-        zotero_link = '<a href="{z}">{title}</a>'.format(
-            z=zotero_link, title=title)
-        out.append('<li>')
-        out.append('<p class="b">{}</p>'.format(zotero_link))
-        out.append('<p>{}</p>'.format(i.get('annotationText', 'No text')))
-        out.append('<p><em>{}</em></p>'.format(i.get('annotationComment', '')))
-        item_tags = ['<a class="btn btn-primary btn-sm" href="{}">{}</a>'.format(url_for(
-            'show_annotations', library_id=library_id, tag=v['tag']), v['tag']) for v in i['tags']]
-        out.append(
-            '<p>{}</p>'.format(' '.join(item_tags)))
-        out.append('</li>')
-    out.append('</ol>')
+    zotero_link = 'zotero://open-pdf/groups/{}/items/{}?page={}&annotation={}'.format(
+        library_id,
+        i['parentItem'],
+        i.get('annotationPageLabel', ''),
+        i['key']
+    )
+    out.append('<li>')
+    out.append('<p class="b"><a href="{}">Page {}</a></p>'.format(
+        zotero_link, escape(i.get('annotationPageLabel', ''))))
+    image = annotation_image_url(library_id, i['key'], i, 640)
+    if image:
+        out.append('<p><img src="{}" class="img-fluid border" loading="lazy"></p>'.format(image))
+    out.append('<p>{}</p>'.format(i.get('annotationText', 'No text')))
+    out.append('<p><em>{}</em></p>'.format(i.get('annotationComment', '')))
+    item_tags = ['<a class="btn btn-primary btn-sm" href="{}">{}</a>'.format(url_for(
+        'show_annotations', library_id=library_id, tag=v['tag']), v['tag']) for v in i['tags']]
+    out.append(
+        '<p>{}</p>'.format(' '.join(item_tags)))
+    out.append('</li>')
+    return ''.join(out)
+
+
+@app.route('/annotations/<library_id>/<tag>/document/<document>')
+@zqda.core.cache.page()
+def show_annotation_group(library_id, tag, document):
+    """Show the annotations associated with a tag in one document, in the
+    order in which they appear in the document. Each annotation is
+    presented as applicable with the highlighted text passage from the
+    PDF, editor comments, and a list of tags applied to the annotation."""
+    summary = summaries(library_id).get(tag)
+    if summary is None:
+        abort(404)
+    group = None
+    for d in summary['documents']:
+        if d['key'] == document:
+            group = d
+            break
+    if group is None:
+        abort(404)
+
+    zqda.core._depends_on(document)
+    out = ['<p class="b">{}</p>'.format(group['title']),
+           '<div class="annotation-list"><ol>']
+    with zqda.core._open_db(zqda.core._item_cache(library_id)) as db:
+        for item_key in group['annotations']:
+            try:
+                i = records.decode(db[item_key])
+            except KeyError:
+                continue
+            zqda.core._depends_on(item_key)
+            out.append(_annotation_html(library_id, i))
+    out.append('</ol></div>')
+    out.append('<p><a href="{}">All documents</a></p>'.format(
+        url_for('show_annotations', library_id=library_id, tag=tag)))
     return render_template('base.html',
                            library_id=library_id,
                            content=Markup(' '.join(out)),
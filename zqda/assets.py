@@ -0,0 +1,257 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import zlib
+
+import click
+from flask import request, url_for, send_from_directory
+
+from zqda import app
+
+# Static assets and response compression.
+#
+# `flask --app zqda build-assets` writes a minified copy of each stylesheet
+# and script in zqda/static to zqda/static/dist under a name containing a
+# hash of its content (styles.css -> styles.3f2a9c1d.css), together with
+# gzip (and, if the brotli module is installed, brotli) compressed versions
+# and a manifest.json mapping the original names to the built ones.
+# Templates refer to assets through asset_url(), which returns the built
+# file if there is a manifest entry and the original file otherwise.
+# Built files never change, so they are served with far-future, immutable
+# caching headers, and the precompressed version is sent to clients that
+# accept it.
+#
+# Dynamic text responses (HTML, JSON, ...) larger than COMPRESS_MIN_SIZE
+# bytes are compressed when the client accepts it. Streamed responses
+# (exports) are gzip-compressed chunk by chunk. Files (attachments, static
+# files) are sent as they are, so that they keep their Content-Length and
+# range requests work; most of them are compressed already.
+
+DIST = 'dist'
+ASSET_EXTENSIONS = ('.css', '.js')
+# besides text/*
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/xml',
+                'application/javascript', 'image/svg+xml')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_manifest = {'mtime': None, 'files': {}}
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _dist_dir():
+    return os.path.join(app.static_folder, DIST)
+
+
+def minify_css(text):
+    """Remove comments (except /*! license comments) and redundant
+    whitespace from a stylesheet."""
+    try:
+        import rcssmin
+    except ImportError:
+        pass
+    else:
+        return rcssmin.cssmin(text, keep_bang_comments=True)
+    out = []
+    # strings and comments are matched first, so that they are kept as
+    # they are (strings) or dropped as a whole (comments)
+    for m in re.finditer(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')'
+                         r'|(/\*!.*?\*/)|/\*.*?\*/|([^"\'/]+|/)', text, re.S):
+        string, license, code = m.groups()
+        if string or license:
+            out.append(string or license + '\n')
+        elif code:
+            code = re.sub(r'\s+', ' ', code)
+            out.append(re.sub(r' ?([{};,]) ?', r'\1', code))
+    return ''.join(out).replace(';}', '}').strip() + '\n'
+
+
+def minify_js(text):
+    """Minify a script with rjsmin if it is installed. Without it, scripts
+    are left as they are: removing whitespace from JavaScript safely needs
+    a tokenizer."""
+    try:
+        import rjsmin
+    except ImportError:
+        return text
+    return rjsmin.jsmin(text, keep_bang_comments=True)
+
+
+def _write(path, data):
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build():
+    """Build the fingerprinted and precompressed assets. Returns the
+    manifest ({original name: built name})."""
+    dist = _dist_dir()
+    os.makedirs(dist, exist_ok=True)
+    brotli = _brotli()
+    manifest = {}
+    for name in sorted(os.listdir(app.static_folder)):
+        base, ext = os.path.splitext(name)
+        if ext not in ASSET_EXTENSIONS:
+            continue
+        with open(os.path.join(app.static_folder, name), 'r',
+                  encoding='utf-8') as f:
+            text = f.read()
+        text = minify_css(text) if ext == '.css' else minify_js(text)
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        built = '{}.{}{}'.format(base, digest, ext)
+        path = os.path.join(dist, built)
+        _write(path, data)
+        _write(path + '.gz', gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            _write(path + '.br', brotli.compress(data))
+        manifest[name] = built
+
+    # remove the files of previous builds
+    keep = set(manifest.values())
+    for name in os.listdir(dist):
+        if name != 'manifest.json' and re.sub(r'\.(gz|br)$', '', name) not in keep:
+            os.remove(os.path.join(dist, name))
+    _write(os.path.join(dist, 'manifest.json'),
+           json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def _built_files():
+    """The manifest of the last build, reloaded when it changes."""
+    path = os.path.join(_dist_dir(), 'manifest.json')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    if _manifest['mtime'] != mtime:
+        try:
+            with open(path, 'r') as f:
+                _manifest['files'] = json.load(f)
+        except (OSError, ValueError):
+            _manifest['files'] = {}
+        _manifest['mtime'] = mtime
+    return _manifest['files']
+
+
+@app.template_global()
+def asset_url(filename):
+    """URL of a static file, using the built version if there is one."""
+    built = _built_files().get(filename)
+    if built is not None:
+        filename = '{}/{}'.format(DIST, built)
+    return url_for('static', filename=filename)
+
+
+def _encoding():
+    """Best content coding accepted by the client that we can produce."""
+    accepted = request.accept_encodings
+    if accepted['br'] and _brotli() is not None:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def static(filename):
+    """Serve a static file. Built assets are served precompressed, if the
+    client accepts it, and with immutable caching headers."""
+    if not filename.startswith(DIST + '/'):
+        return app.send_static_file(filename)
+    path = os.path.join(app.static_folder, filename)
+    encoding = _encoding()
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding)
+    if suffix and os.path.exists(path + suffix):
+        response = send_from_directory(app.static_folder, filename + suffix,
+                                       mimetype=_mimetype(filename),
+                                       max_age=31536000)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(app.static_folder, filename,
+                                       max_age=31536000)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _mimetype(filename):
+    return {'.css': 'text/css',
+            '.js': 'text/javascript'}.get(os.path.splitext(filename)[1])
+
+
+app.view_functions['static'] = static
+
+
+def _gzip_stream(response):
+    """Compress a streamed response chunk by chunk. Each chunk is flushed,
+    so the client still receives the data as it is generated."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    try:
+        for chunk in response.iter_encoded():
+            if chunk:
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        response.close()
+
+
+def _compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or
+                               mimetype in COMPRESSIBLE)
+
+
+@app.after_request
+def _compress(response):
+    min_size = app.config.get('COMPRESS_MIN_SIZE')
+    if min_size is None or response.direct_passthrough or \
+            response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            'Accept-Ranges' in response.headers or \
+            not _compressible(response.mimetype):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        if not request.accept_encodings['gzip']:
+            return response
+        stream = app.response_class(_gzip_stream(response),
+                                    status=response.status,
+                                    headers=response.headers)
+        stream.headers['Content-Encoding'] = 'gzip'
+        stream.headers.pop('Content-Length', None)
+        return stream
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    if encoding == 'br':
+        data = _brotli().compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, GZIP_LEVEL)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Minify, fingerprint and precompress the static assets into
+    zqda/static/dist."""
+    for name, built in sorted(build().items()):
+        click.echo('{} -> {}/{} ({} bytes)'.format(
+            name, DIST, built,
+            os.path.getsize(os.path.join(_dist_dir(), built))))
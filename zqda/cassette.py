@@ -0,0 +1,199 @@
+import argparse
+import base64
+import gzip
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# Record/replay of Zotero API traffic.
+#
+# A cassette is a gzip-compressed JSON-lines file with one entry per request:
+# the method, path and query, request headers (without credentials), the
+# response status, headers and body, the time since recording started and
+# the time the request took. Each entry is written as a separate gzip
+# member, so a cassette stays readable if the recording process is killed.
+#
+# ReplayServer serves a cassette over HTTP. Requests are matched on method,
+# path and sorted query string, and repeated requests are answered in the
+# order they were recorded, so a replayed sync sees exactly what the
+# recorded sync saw. Responses are delayed by the recorded request time
+# divided by `speed` (0 disables delays).
+
+SKIP_REQUEST_HEADERS = ('authorization', 'zotero-api-key')
+SKIP_RESPONSE_HEADERS = ('content-encoding', 'content-length',
+                         'transfer-encoding', 'connection')
+
+
+def _request_key(method, url):
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return '{} {}?{}'.format(method.upper(), parts.path, query)
+
+
+def _path(url):
+    parts = urlsplit(str(url))
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+class Recorder(object):
+    """Append request/response pairs to a cassette file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, request, response, elapsed):
+        try:
+            body = response.content
+        except Exception:  # streamed body that has not been read
+            body = b''
+        try:
+            sent = request.content or b''
+        except Exception:
+            sent = b''
+        entry = {
+            'at': round(time.time() - self.started - elapsed, 6),
+            'elapsed': round(elapsed, 6),
+            'method': request.method,
+            'url': _path(request.url),
+            'request_headers': {k: v for k, v in request.headers.items()
+                                if k.lower() not in SKIP_REQUEST_HEADERS},
+            'request_size': len(sent),
+            'status': response.status_code,
+            'headers': {k: v for k, v in response.headers.items()
+                        if k.lower() not in SKIP_RESPONSE_HEADERS},
+            'size': len(body),
+            'body': base64.b64encode(body).decode('ascii'),
+        }
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        with self.lock:
+            with gzip.open(self.path, 'ab') as f:
+                f.write(line)
+
+
+def load(path):
+    """Read all entries of a cassette."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def route(url):
+    """API route of a URL without library and object keys, e.g.
+    /groups/<id>/items/<key>/file -> items/file."""
+    path = urlsplit(str(url)).path.split('/')
+    i = path.index('groups') if 'groups' in path else 0
+    return '/'.join(p for j, p in enumerate(path[i + 2:]) if j != 1) or 'group'
+
+
+def summary(entries):
+    """Return request count, bytes and total recorded time per route."""
+    routes = defaultdict(lambda: {'requests': 0, 'bytes': 0, 'seconds': 0.0})
+    for e in entries:
+        r = routes['{} {}'.format(e['method'], route(e['url']))]
+        r['requests'] += 1
+        r['bytes'] += e['size']
+        r['seconds'] += e['elapsed']
+    return dict(routes)
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _replay(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        entry = self.server.next_response(self.command, self.path)
+        if entry is None:
+            body = 'No recorded response for {} {}'.format(
+                self.command, self.path).encode('utf-8')
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.server.speed:
+            time.sleep(entry['elapsed'] / self.server.speed)
+        body = base64.b64decode(entry['body'])
+        self.send_response(entry['status'])
+        for k, v in entry['headers'].items():
+            if k.lower() == 'link':
+                # point pagination links at the replay server
+                v = v.replace(self.server.recorded_origin(v), self.server.url)
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _replay
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """HTTP server that answers requests from a cassette."""
+
+    daemon_threads = True
+
+    def __init__(self, entries, host='127.0.0.1', port=0, speed=0):
+        super().__init__((host, port), _ReplayHandler)
+        self.speed = speed
+        self.url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.lock = threading.Lock()
+        self.responses = defaultdict(deque)
+        for e in entries:
+            self.responses[_request_key(e['method'], e['url'])].append(e)
+        self.unmatched = 0
+
+    @staticmethod
+    def recorded_origin(link):
+        parts = urlsplit(link.strip('<').split('>')[0])
+        return '{}://{}'.format(parts.scheme, parts.netloc)
+
+    def next_response(self, method, url):
+        with self.lock:
+            queue = self.responses.get(_request_key(method, url))
+            if not queue:
+                self.unmatched += 1
+                return None
+            # keep the last response for requests repeated more often
+            # than they were recorded
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def start(self):
+        """Serve from a daemon thread; returns the base URL."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay or summarize a recorded Zotero API cassette.')
+    parser.add_argument('cassette')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed; 1 is real time, 0 is no delay')
+    parser.add_argument('--summary', action='store_true',
+                        help='print per-route totals and exit')
+    args = parser.parse_args()
+
+    entries = load(args.cassette)
+    if args.summary:
+        print(json.dumps(summary(entries), indent=2, sort_keys=True))
+        return
+    server = ReplayServer(entries, port=args.port, speed=args.speed)
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+
+from pyzotero import zotero
+
+from zqda import app
+from zqda import metrics
+from zqda.cassette import route
+
+# HTTP session shared by all Z instances in this process, so that requests
+# reuse pooled keep-alive connections instead of opening a new TLS
+# connection for every client.
+_session = None
+_session_lock = threading.Lock()
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Writes are only retried when rate limited (429, not processed by the
+# server): after a timeout or 5xx response they may have been applied, and
+# a retried POST would create duplicates, a retried conditional PATCH fail
+# with a spurious 412.
+RETRY_METHODS = ('GET', 'HEAD')
+
+_stats_lock = threading.Lock()
+_stats = {
+    'requests': 0,
+    'retries': 0,
+    'errors': 0,
+    'bytes_sent': 0,
+    'bytes_received': 0,
+    'wait_seconds': 0.0,
+}
+
+
+def get_stats():
+    """Return a copy of the Zotero API request counters for this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(**kwargs):
+    with _stats_lock:
+        for k, v in kwargs.items():
+            _stats[k] += v
+
+
+# Cassette recorder for Zotero API traffic (see zqda.cassette), enabled by
+# the ZOTERO_RECORD setting or the `recording` context manager.
+_recorder = None
+
+
+def _get_recorder():
+    global _recorder
+    path = app.config.get('ZOTERO_RECORD')
+    if _recorder is None and path:
+        from zqda.cassette import Recorder
+        _recorder = Recorder(os.path.expanduser(path))
+    return _recorder
+
+
+@contextlib.contextmanager
+def recording(path):
+    """Record all Zotero API requests made inside the block to the
+    cassette file at `path`."""
+    global _recorder
+    from zqda.cassette import Recorder
+    previous, _recorder = _recorder, Recorder(path)
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
+
+
+class _Limiter(object):
+    """Token bucket shared by all Zotero clients in the process. Each request
+    takes a token; tokens are refilled at `rate` per second up to `burst`.
+    A Backoff or Retry-After header from the server pauses every client
+    until it has expired."""
+
+    def __init__(self):
+        self.tokens = None
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        rate = float(app.config['ZOTERO_RATE_LIMIT'])
+        burst = float(app.config['ZOTERO_RATE_BURST'])
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens is None:
+                        self.tokens = burst
+                    self.tokens = min(burst, self.tokens +
+                                      (now - self.updated) * rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / rate
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            _count(wait_seconds=waited)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+_limiter = _Limiter()
+
+
+def _header_seconds(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def _transport_error(session):
+    """Base class for network errors of the HTTP library used by pyzotero."""
+    return sys.modules[type(session).__module__.partition('.')[0]].TransportError
+
+
+class Z(zotero.Zotero):
+    """Local version of pyzotero Zotero class with additional functions"""
+
+    def __init__(self, library_id, library_type, api_key=None, **kwargs):
+        global _session
+        with _session_lock:
+            kwargs.setdefault('client', _session)
+            super().__init__(library_id, library_type, api_key, **kwargs)
+            if _session is None:
+                _session = self.client
+        if not self.local:
+            self.endpoint = app.config['ZOTERO_API_URL'].rstrip('/')
+
+    def __del__(self):
+        # pyzotero closes its client here; ours is shared with other instances
+        pass
+
+    def _send(self, method, url, **kwargs):
+        """Send a request through the shared session, subject to the
+        process-wide rate limiter. Rate-limited requests, and failed reads,
+        are retried with exponential backoff and full jitter."""
+        retries = app.config['ZOTERO_RETRIES']
+        idempotent = method.upper() in RETRY_METHODS
+        error = _transport_error(self.client)
+        attempt = 0
+        while True:
+            _limiter.acquire()
+            recorder = _get_recorder()
+            started = time.perf_counter()
+            t = metrics.start()
+            try:
+                r = super()._send(method, url, **kwargs)
+            except error:
+                _count(requests=1, errors=1)
+                metrics.inc('zqda_zotero_api_requests_total', method=method,
+                            route=route(url), status='error')
+                if attempt >= retries or not idempotent:
+                    raise
+                r = None
+            else:
+                _count(requests=1, bytes_sent=_content_length(r.request),
+                       bytes_received=_content_length(r))
+                if recorder is not None:
+                    recorder.record(r.request, r,
+                                    time.perf_counter() - started)
+                if t is not None:
+                    _observe(method, url, r, t)
+                backoff = _header_seconds(r.headers, 'Backoff')
+                if backoff:
+                    _limiter.pause(backoff)
+                if r.status_code not in RETRY_STATUS or attempt >= retries or \
+                        (r.status_code != 429 and not idempotent):
+                    return r
+                _count(errors=1)
+
+            delay = None
+            if r is not None:
+                delay = _header_seconds(r.headers, 'Retry-After')
+            if delay:
+                _limiter.pause(delay)
+            else:
+                time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+            attempt += 1
+            _count(retries=1)
+
+    def group(self, **kwargs):
+        """Get group data. This is not currently supported in pyzotero."""
+        query_string = "/groups/{u}"
+        return self._build_query(query_string)
+
+    def group_data(self, since=None):
+        """Retrieve the group metadata as a dict. If `since` is given, the
+        request is conditional and None is returned when the group has not
+        been modified since that version."""
+        headers = {}
+        if since is not None:
+            headers['If-Modified-Since-Version'] = str(since)
+        url = zotero.build_url(
+            self.endpoint, '/groups/{}'.format(self.library_id))
+        r = self._send('GET', url, headers=headers)
+        if r.status_code == 304:
+            return None
+        self._post_check(r)
+        return r.json()
+
+    def patch_item(self, item_key, version, fields):
+        """Update some fields of an item with a single PATCH request, on
+        condition that the item has not been modified since `version`.
+        Returns the response: 204 if the item was updated (the new item
+        version is in the Last-Modified-Version header), 412 if it has been
+        modified in the meantime."""
+        url = zotero.build_url(self.endpoint, '/{}/{}/items/{}'.format(
+            self.library_type, self.library_id, item_key))
+        headers = {'If-Unmodified-Since-Version': str(version)}
+        return self._send('PATCH', url, headers=headers, json=fields)
+
+    @contextlib.contextmanager
+    def stream_file(self, item_key):
+        """Request the file of an attachment item without reading the body.
+        Yields the response; iterate over `iter_bytes()` to read it."""
+        url = zotero.build_url(self.endpoint, '/{}/{}/items/{}/file'.format(
+            self.library_type, self.library_id, item_key))
+        _limiter.acquire()
+        t = metrics.start()
+        with self.client.stream('GET', url, headers=self.default_headers(),
+                                follow_redirects=True) as r:
+            try:
+                yield r
+            finally:
+                _count(requests=1, bytes_received=r.num_bytes_downloaded)
+                if t is not None:
+                    metrics.observe('zqda_zotero_api_request_duration_seconds',
+                                    t, method='GET', route='items/file')
+                    metrics.inc('zqda_zotero_api_requests_total',
+                                method='GET', route='items/file',
+                                status=r.status_code)
+                    metrics.inc('zqda_zotero_api_bytes_received_total',
+                                r.num_bytes_downloaded, method='GET',
+                                route='items/file')
+
+
+def _observe(method, url, r, started):
+    labels = {'method': method, 'route': route(url)}
+    metrics.observe('zqda_zotero_api_request_duration_seconds', started,
+                    **labels)
+    metrics.inc('zqda_zotero_api_requests_total', status=r.status_code,
+                **labels)
+    metrics.inc('zqda_zotero_api_bytes_sent_total',
+                _content_length(r.request), **labels)
+    metrics.inc('zqda_zotero_api_bytes_received_total',
+                _content_length(r), **labels)
+
+
+def _content_length(message):
+    """Size in bytes of a request or response body that has been read."""
+    try:
+        return len(message.content)
+    except Exception:  # streaming body
+        return int(message.headers.get('Content-Length', 0))
+
+
+def library_client(library_id):
+    """Return a Zotero client for a configured group library. All clients
+    share one pooled HTTP session and rate limiter."""
+    api_key = app.config['LIBRARY'][library_id]['api_key']
+    return Z(library_id, 'group', api_key)
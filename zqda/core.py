@@ -1,41 +1,284 @@
-import toml
 import os
+import contextlib
 import dbm
+import fcntl
+import functools
+import glob
+import hashlib
 import operator
+import pickle
 import re
 import json
+import mimetypes
+import shutil
+import threading
+import time
+import urllib.parse
 
+import click
 from flask import render_template, redirect, url_for, abort, request, make_response, flash, json, send_file
+from flask import g, has_app_context, stream_with_context
 from markupsafe import Markup, escape
-from pyzotero import zotero, zotero_errors
-import json2table
 from werkzeug.utils import import_string
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import HTTPException
-from bs4 import BeautifulSoup
-from flask_caching import Cache
-import markdown
-from slugify import slugify
 
 from zqda import app
+from zqda import metrics
+from zqda import records
+from zqda import snapshot
+
+# Heavy third-party modules (pyzotero, bs4, markdown, json2table, slugify,
+# Flask-Caching) are imported inside the functions that use them. Under CGI
+# the whole application is imported for every request, so module-level
+# imports are paid even by routes that never touch them.
+
+
+class _LazyCache(object):
+    """Stand-in for the Flask-Caching object that only imports and
+    initializes the extension on first use."""
+
+    _cache = None
+
+    def _get(self):
+        if self._cache is None:
+            from flask_caching import Cache
+            _LazyCache._cache = Cache(app)
+        return self._cache
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def memoize(self, *args, **kwargs):
+        """Equivalent to `Cache.memoize`, but the wrapped function is only
+        memoized when it is first called."""
+        def decorator(f):
+            memoized = []
+
+            @functools.wraps(f)
+            def wrapper(*fargs, **fkwargs):
+                if not memoized:
+                    memoized.append(self._get().memoize(*args, **kwargs)(f))
+                return memoized[0](*fargs, **fkwargs)
+            return wrapper
+        return decorator
+
+    def single_flight(self):
+        """Memoize a function, letting only one thread or process at a time
+        compute a missing value. Callers are coordinated with file locks in
+        data_path/locks (not in the cache directory itself, which is
+        emptied by `cache.clear()`). While a value is being computed, other
+        callers get the previous value from data_path/stale if there is one
+        (stale-while-revalidate), or wait for the result."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args):
+                key = 'single_flight:{}:{}'.format(
+                    f.__name__, ':'.join(map(str, args)))
+                value = self.get(key)
+                if value is not None:
+                    metrics.inc('zqda_single_flight_total',
+                                function=f.__name__, outcome='hit')
+                    return value
+                name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+                lock_path = os.path.join(app.data_path, 'locks', name)
+                stale_path = os.path.join(app.data_path, 'stale', name)
+                for path in (lock_path, stale_path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(lock_path, 'a') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        value = _read_pickle(stale_path)
+                        if value is not None:
+                            metrics.inc('zqda_single_flight_total',
+                                        function=f.__name__, outcome='stale')
+                            return value
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    # the value may have been stored while we were waiting
+                    value = self.get(key)
+                    if value is not None:
+                        metrics.inc('zqda_single_flight_total',
+                                    function=f.__name__, outcome='wait')
+                        return value
+                    metrics.inc('zqda_single_flight_total',
+                                function=f.__name__, outcome='build')
+                    value = f(*args)
+                    self.set(key, value)
+                    _write_pickle(stale_path, value)
+                    return value
+            return wrapper
+        return decorator
+
+    def page(self):
+        """Cache the pages rendered by a library view for visitors without
+        cookies (pages differ for logged-in users, and flashed messages are
+        kept in a cookie). Cached pages are keyed by the library's page
+        generation, so `_invalidate_pages` discards them without clearing
+        the whole cache. Page views are counted for cache warming."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(**kwargs):
+                library_id = kwargs['library_id']
+                if app.config['WARM_CACHE']:
+                    _count_access(request.path)
+                if request.cookies or '_item_deps' in g:
+                    return f(**kwargs)
+                generation = self.get('pages:' + library_id)
+                if generation is None:
+                    generation = time.time_ns()
+                    self.set('pages:' + library_id, generation)
+                key = 'page:{}:{}:{}'.format(library_id, generation,
+                                             request.full_path)
+                page = self.get(key)
+                if page is not None:
+                    metrics.inc('zqda_page_cache_total', outcome='hit')
+                    body, mimetype = page
+                    return app.response_class(body, mimetype=mimetype)
+                metrics.inc('zqda_page_cache_total', outcome='miss')
+                response = make_response(f(**kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.set(key, (response.get_data(), response.mimetype))
+                return response
+            return wrapper
+        return decorator
+
+
+def _invalidate_pages(library_id):
+    """Discard the cached pages of a library."""
+    cache.set('pages:' + library_id, time.time_ns())
+
+
+# the access log is merged into access.json when it grows beyond this size,
+# so that it stays small even if libraries are rarely synced
+ACCESS_LOG_MAX_BYTES = 1 << 20
+
+
+def _count_access(path):
+    """Append a page view to the access log used to choose pages for cache
+    warming. A single small append is atomic, so no locking is needed."""
+    fd = os.open(os.path.join(app.data_path, 'access.log'),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, path.encode('utf-8') + b'\n')
+        full = os.fstat(fd).st_size > ACCESS_LOG_MAX_BYTES
+    finally:
+        os.close(fd)
+    if full:
+        _access_counts()
+
+
+def _access_counts():
+    """Page view counts, from the access log merged into access.json.
+    Older counts are halved at each merge, so recently viewed pages rank
+    higher."""
+    jsn = os.path.join(app.data_path, 'access.json')
+    log = os.path.join(app.data_path, 'access.log')
+    with open(jsn + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # one merge at a time
+        counts = {}
+        if os.path.exists(jsn):
+            with open(jsn, 'r') as f:
+                counts = {k: v / 2 for k, v in json.load(f).items()}
+        tmp = '{}.{}'.format(log, os.getpid())
+        try:
+            os.rename(log, tmp)  # new views go to a new log
+        except FileNotFoundError:
+            return counts
+        with open(tmp, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                path = line.rstrip('\n')
+                counts[path] = counts.get(path, 0) + 1
+        counts = {k: v for k, v in counts.items() if v >= 0.5}
+        _write_json(jsn, counts)
+        os.remove(tmp)
+    return counts
+
+
+def _warm_cache(library_id, counts=None):
+    """Rebuild the index structures of a library and render its most
+    important pages into the page cache: the library root, tag lists,
+    top-level collections, and the WARM_TOP_N most viewed pages (from
+    `counts`, see _access_counts)."""
+    t = time.perf_counter()
+    _get_tags(library_id)
+    collections = _get_collections(library_id)
+    _get_children(library_id)
+
+    # URLs can be built outside of a request (sync-library command)
+    with app.test_request_context():
+        urls = [url_for('library_view', library_id=library_id),
+                url_for('show_tags', library_id=library_id),
+                url_for('show_annotations_tag_select', library_id=library_id)]
+        for key in collections.get('top', []):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            urls.append(url_for('html', library_id=library_id, item_key=key))
+    if counts is None:
+        counts = _access_counts()
+    prefix = tuple(p + library_id + '/'
+                   for p in ('/view/', '/tags/', '/annotations/'))
+    popular = sorted((p for p in counts if p.startswith(prefix)),
+                     key=counts.get, reverse=True)
+    urls.extend(p for p in popular[:app.config['WARM_TOP_N']] if p not in urls)
+
+    client = app.test_client()
+    warmed = 0
+    for url in urls:
+        # a new application context, so that the hooks of these requests
+        # do not share `g` with the current request
+        with app.app_context():
+            if client.get(url).status_code == 200:
+                warmed += 1
+    return 'Warmed {} pages in {:.1f} s.'.format(
+        warmed, time.perf_counter() - t)
+
+
+def _read_pickle(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_pickle(path, value):
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+cache = _LazyCache()
 
-cache = Cache(app)
 
-class Z(zotero.Zotero):
-    """Local version of pyzotero Zotero class with additional functions"""
+@contextlib.contextmanager
+def _sync_lock(library_id, shared=False):
+    """Hold the lock that keeps the stored data of a library consistent:
+    changes (syncs) hold it exclusively, readers that need a consistent
+    copy (replica snapshots) hold it shared."""
+    path = os.path.join(app.data_path, 'locks', 'sync-{}'.format(library_id))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
 
-    def group(self, **kwargs):
-        """Get group data. This is not currently supported in pyzotero."""
-        query_string = "/groups/{u}"
-        return self._build_query(query_string)
+
+def _sync_locked(f):
+    """Run a function of a library (the first argument) under its sync
+    lock."""
+    @functools.wraps(f)
+    def wrapper(library_id, *args, **kwargs):
+        with _sync_lock(library_id):
+            return f(library_id, *args, **kwargs)
+    return wrapper
 
 
 @app.errorhandler(HTTPException)
 def handle_exception(e):
-    response = e.get_response()
     return render_template('base.html', 
                             content=e.description, 
-                            title=e.name)
+                            title=e.name), e.code
 
 
 @app.route('/login/<library_id>')
@@ -87,59 +330,133 @@ def set_key():
 
 
 def _check_key(library_id, key=None):
-    """Check the user cookies for a valid access key."""
+    """Check the user cookies for a valid access key. Administrator keys are
+    valid for every library."""
 
     if not key:
         key = request.cookies.get('key')
     if not key:
         return False
     valid_keys = app.config['LIBRARY'][library_id].get('keys', [])
-    if len(valid_keys) == 0:
-        return False
     for k in valid_keys:
         if check_password_hash(key, k):
             return True
+    return _is_admin(key)
+
+
+def _is_admin(key=None):
+    """Check the user cookies for a valid administrator key (ADMIN_KEYS)."""
+    if not key:
+        key = request.cookies.get('key')
+    if not key:
+        return False
+    for k in app.config.get('ADMIN_KEYS', []):
+        if check_password_hash(key, k):
+            return True
     return False
 
-def _sync_library_data(library_id, api_key):
-    """Retrieve the remote metadata for the group library."""
+
+def _write_json(path, data):
+    """Write `data` to a JSON file, replacing the old file atomically so that
+    concurrent readers never see a partial file."""
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _library_data_path(library_id):
+    return os.path.join(app.data_path, 'library_{}.json'.format(library_id))
+
+
+def _get_library_data(library_id):
+    """Retrieve the metadata for a group library: the title and description
+    stored on the last sync, or the values in the configuration file if the
+    library has not been synchronized yet."""
+    cfg = app.config['LIBRARY'][library_id]
+    data = {'title': cfg.get('title', library_id),
+            'description': cfg.get('description', '')}
+    try:
+        with open(_library_data_path(library_id), 'r') as f:
+            data.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return data
+
+
+def _sync_library_data(library_id):
+    """Retrieve the remote metadata for the group library. The request is
+    conditional on the group version, so the stored data is only rewritten
+    when the group name or description has changed."""
     # this is not wrapped by pyzotero
     # https://api.zotero.org/groups/{library_id}/
     # data['name'], data['description']
-    zot = Z(library_id, 'group', api_key)
+    from pyzotero import zotero_errors
+    from zqda.client import library_client
+    jsn = _library_data_path(library_id)
+    stored = {}
+    if os.path.exists(jsn):
+        with open(jsn, 'r') as f:
+            stored = json.load(f)
+    zot = library_client(library_id)
     try:
-        r = zot._retrieve_data(zot.group()).json()
+        r = zot.group_data(since=stored.get('version', None))
     except zotero_errors.UserNotAuthorised as e:
         print(e)
         return None
+    if not r:  # not modified
+        return
     data = r.get('data', None)
     if not data:
         return
-    cfg = os.path.join(app.config_path, 'config.toml')
-    t = toml.load(cfg)
-    t['LIBRARY'][library_id]['title'] = data['name']
-    t['LIBRARY'][library_id]['description'] = data.get('description', ' ')
-    with open(cfg, 'w') as f:
-        toml.dump(t, f)
-    app.config.from_mapping(t)
+    _write_json(jsn, {'version': r.get('version', 0),
+                      'title': data['name'],
+                      'description': data.get('description', ' ')})
     return
 
     
+SYNC_PAGE_SIZE = 100  # the largest page the Zotero API returns
+
+
+def _sync_checkpoint(library_id):
+    return os.path.join(app.data_path, 'sync_{}.json'.format(library_id))
+
+
+def _sync_pages(zot, method, start, **kwargs):
+    """Yield (start, page) for the pages of a paginated API request,
+    beginning at offset `start`."""
+    page = getattr(zot, method)(limit=SYNC_PAGE_SIZE, start=start, **kwargs)
+    while page:
+        yield start, page
+        start += len(page)
+        if not zot.links or not zot.links.get('next'):
+            return
+        page = zot.follow()
+
+
 # e.g., to resync from a specific version
+@_sync_locked
 def _sync_items(library_id):
     """Synchronize all items in a single group library. Store item data
     for updated items in the file "items_LIBRARY-ID.db" within the application
     data directory. The latest local version number for each library is stored 
-    in the file "versions.json" in the application data directory.
+    in the file "versions.json" in the application data directory. The
+    library snapshot ("snapshot_LIBRARY-ID.bin") is rebuilt after each update.
+
+    Changes are fetched, stored and discarded one page at a time, so memory
+    use does not grow with the size of the changeset. After each page, the
+    position is saved in "sync_LIBRARY-ID.json"; an interrupted sync to the
+    same remote version resumes from there.
     """
+    from zqda.client import library_client
+    t = metrics.start()
     local_ver = 0
-    api_key = app.config['LIBRARY'][library_id]['api_key']
-    zot = zotero.Zotero(library_id, 'group', api_key)
+    zot = library_client(library_id)
  
     remote_ver = zot.last_modified_version()
 
     # return "so far so good..."
-    _sync_library_data(library_id, api_key)
+    _sync_library_data(library_id)
 
 
     jsn = os.path.join(app.data_path, 'versions.json')
@@ -149,50 +466,69 @@ def _sync_items(library_id):
             data = json.load(f)
             local_ver = data.get(library_id, 0)
     if not remote_ver > local_ver:
+        if snapshot.load(library_id) is None:
+            snapshot.build(library_id, local_ver)
         return "No changes."
 
-    items = zot.everything(zot.items(since=local_ver, include='bib,data'))
-    # deleted_items = []
-    # map(deleted_items.extend, zot.everything(zot.deleted(since=local_ver)))
-    collections = zot.everything(zot.collections(since=local_ver))
-
-    
-    for c in collections:
-        c['data']['itemType'] = 'collection'
-        c['data']['items'] = zot.collection_items(c['data']['key'])
-        collection_items = zot.collection_items(c['data']['key'])
-        subcollections = zot.collections_sub(c['data']['key'])
-        for sub in subcollections:
-            sub['data']['itemType'] = 'collection'
-        c['data']['items'] = collection_items + subcollections
-
-    items = items + collections #+ library_data
-
-    item_cache = os.path.join(app.data_path, 'items_{}.db'.format(library_id))
-    with dbm.open(item_cache, 'c') as db:
-        for item in items:
-            db[item['key']] = json.dumps(item, ensure_ascii=False)
-            if item['data']['itemType'] == 'attachment':
-                a = _load_attachment(zot, item)
-        # for item in deleted_items:
-        #     try:
-        #         del db[item['key']]
-        #     except: # could be a tag, saved search, etc.
-        #         continue 
+    checkpoint_path = _sync_checkpoint(library_id)
+    checkpoint = {'since': local_ver, 'target': remote_ver,
+                  'phase': 'items', 'start': 0, 'count': 0}
+    try:
+        with open(checkpoint_path, 'r') as f:
+            saved = json.load(f)
+        if saved['since'] == local_ver and saved['target'] == remote_ver \
+                and saved['phase'] in ('items', 'collections'):
+            checkpoint = saved
+    except (OSError, ValueError, KeyError):
+        pass
 
+    item_cache = _item_cache(library_id)
+    lazy = _lazy_attachments(library_id)
+    phases = ['items', 'collections']
+    resume = checkpoint['phase']
+    for phase in phases[phases.index(resume):]:
+        start = checkpoint['start'] if phase == resume else 0
+        kwargs = {'include': 'bib,data'} if phase == 'items' else {}
+        for start, page in _sync_pages(zot, phase, start, since=local_ver,
+                                       **kwargs):
+            with _open_db(item_cache, 'c') as db:
+                for item in page:
+                    if phase == 'collections':
+                        item['data']['itemType'] = 'collection'
+                    db[item['key']] = records.encode(item)
+            if not lazy:
+                for item in page:
+                    if item['data']['itemType'] == 'attachment':
+                        _load_attachment(zot, item)
+            checkpoint.update(phase=phase, start=start + len(page),
+                              count=checkpoint['count'] + len(page))
+            _write_json(checkpoint_path, checkpoint)
+        # deleted items are not removed (zot.deleted(since=local_ver))
+
+    count = checkpoint['count']
+    snapshot.build(library_id, remote_ver)
     data[library_id] = remote_ver
-    with open(jsn, 'w') as f:
-        json.dump(data, f, ensure_ascii=False)
+    _write_json(jsn, data)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    _invalidate_pages(library_id)
 
-    return "Updated {} items.".format(len(items))
+    seconds = metrics.observe('zqda_sync_duration_seconds', t,
+                              library=library_id)
+    if seconds:
+        metrics.inc('zqda_sync_items_total', count, library=library_id)
+        metrics.set_gauge('zqda_sync_items_per_second', count / seconds,
+                          library=library_id)
+    return "Updated {} items.".format(count)
 
 
+@_sync_locked
 def _sync_item(library_id, item_key, item_type='item'):
     """Force (re-)sync of a specific item."""
-    api_key = app.config['LIBRARY'][library_id]['api_key']
-    zot = zotero.Zotero(library_id, 'group', api_key)
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
+    from pyzotero import zotero_errors
+    from zqda.client import library_client
+    zot = library_client(library_id)
+    item_cache = _item_cache(library_id)
     data = _get_item(library_id, item_key)
     if data and data.get('itemType', '') == 'collection':
         item_type = 'collection'
@@ -200,12 +536,6 @@ def _sync_item(library_id, item_key, item_type='item'):
         try:
             item = zot.collection(item_key)
             item['data']['itemType'] = 'collection'
-            collection_items = zot.collection_items(item['data']['key'])
-            subcollections = zot.collections_sub(item['data']['key'])
-            for c in subcollections:
-                c['data']['itemType'] = 'collection'
-            item['data']['items'] = collection_items + subcollections
-            
         except zotero_errors.ResourceNotFound:
             abort(404)
 
@@ -215,36 +545,67 @@ def _sync_item(library_id, item_key, item_type='item'):
         except zotero_errors.ResourceNotFound:
             abort(404)
 
-    with dbm.open(item_cache, 'c') as db:
-        db[item['key']] = json.dumps(item)
+    with _open_db(item_cache, 'c') as db:
+        db[item['key']] = records.encode(item)
+    _invalidate_pages(library_id)
     
-    if item['data']['itemType'] == 'attachment':
+    if item['data']['itemType'] == 'attachment' and \
+            not _lazy_attachments(library_id):
         _load_attachment(zot, item)
 
     return "Updated!"
 
 
-@cache.memoize()
+def _item_cache(library_id):
+    """Path of the item database for a library. Depending on the dbm
+    backend, the file(s) on disk may have additional extensions."""
+    return os.path.join(app.data_path, 'items_{}.db'.format(library_id))
+
+
+def _exists(item_cache):
+    """Check whether a dbm database exists, for any dbm backend."""
+    return dbm.whichdb(item_cache) is not None
+
+
+def _open_db(item_cache, flag='r'):
+    """Open an item database. Opens are counted and timed in the metrics."""
+    t = metrics.start()
+    db = dbm.open(item_cache, flag)
+    metrics.dbm_opened(t)
+    return db
+
+
 def _get_collections(library_id):
     """Retrieve collections from the stored item metadata for a library.
     Although the Zotero API can return a list of collections, this may be
-    faster. 
+    faster. The memory-mapped library snapshot is used if there is one.
     """
+    snap = snapshot.load(library_id)
+    if snap is not None:
+        metrics.inc('zqda_index_lookups_total', index='collections', source='snapshot')
+        return snap.collections
+    metrics.inc('zqda_index_lookups_total', index='collections', source='memoize')
+    return _scan_collections(library_id)
+
+
+@cache.single_flight()
+def _scan_collections(library_id):
+    """Build the collections mapping by reading every stored item."""
+    metrics.inc('zqda_index_memoize_misses_total', index='collections')
     collections = {'top':[]}
 
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
+    item_cache = _item_cache(library_id)
 
-    if not os.path.exists(item_cache):
+    if not _exists(item_cache):
         return collections
 
-    with dbm.open(item_cache, 'r') as db:
+    with _open_db(item_cache) as db:
         for key in db.keys():
-            i = json.loads(db[key])
-            item_collections = i['data'].get('collections', []) 
-            if i['data'].get('parentCollection', None):
-                item_collections.append(i['data']['parentCollection'])
-            if len(item_collections) == 0 and not i['data'].get('parentItem', None) and i['data']['itemType'] == 'collection':
+            data = records.decode(db[key])
+            item_collections = data.get('collections', []) 
+            if data.get('parentCollection', None):
+                item_collections.append(data['parentCollection'])
+            if len(item_collections) == 0 and not data.get('parentItem', None) and data['itemType'] == 'collection':
                 item_collections.append('top')
 
             for c in item_collections:
@@ -256,88 +617,99 @@ def _get_collections(library_id):
 
 
 def _load_attachment(zot, item):
-    if item['data'].get('linkMode') in ('linked_file', 'linked_url'):
+    """Download the file of an attachment item, unless it is stored
+    already. The file is written to disk as it arrives."""
+    if item['data'].get('linkMode') in ('linked_file', 'linked_url') or \
+            not item['data'].get('filename'):
         return
     key = item['data']['key']
-    dir = os.path.join(app.data_path, key)
-    # This will actually be a zip file if it ends with .html
-    filename = _sanitize(item['data']['filename'])
-    # filename = item['data']['filename']
-    mimetype = item['data']['contentType']
-    if mimetype == 'text/html':
-        mimetype = 'application/zip'
-        filename = key + '.zip'
-    filepath = os.path.join(dir, filename)
-    try:
-        filepath = filepath.encode('utf-8')
-    except AttributeError: # already decoded
-        pass
-    if os.path.exists(filepath):
-        return None
-    if not os.path.exists(dir):
-        os.makedirs(dir)
+    # This will actually be a zip file if it is an HTML snapshot
+    if os.path.exists(_attachment_path(key, item['data'])):
+        return
     try:
-        blob = zot.file(key)
-    except:
-        return None
-    with open(filepath, 'wb') as f:
-        f.write(blob)
+        for chunk in _download_attachment(
+                zot, key, _attachment_target(key, item['data'])):
+            pass
+    except Exception:
+        return
 
 
-@cache.memoize()
 def _get_tags(library_id):
     """Retrieve tags from the stored item metadata for a library.
     Although the Zotero API can return a list of tags, if there is a large
     number of them in the library it is much faster to open the stored database
-    entry for each item and retrieve the tags list from there. 
+    entry for each item and retrieve the tags list from there. The
+    memory-mapped library snapshot is used if there is one.
     """
+    snap = snapshot.load(library_id)
+    if snap is not None:
+        metrics.inc('zqda_index_lookups_total', index='tags', source='snapshot')
+        return snap.tags
+    metrics.inc('zqda_index_lookups_total', index='tags', source='memoize')
+    return _scan_tags(library_id)
+
+
+@cache.single_flight()
+def _scan_tags(library_id):
+    """Build the tags mapping by reading every stored item."""
+    metrics.inc('zqda_index_memoize_misses_total', index='tags')
     tags = {}
 
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
+    item_cache = _item_cache(library_id)
 
-    if not os.path.exists(item_cache):
+    if not _exists(item_cache):
         return tags
 
-    with dbm.open(item_cache, 'r') as db:
+    with _open_db(item_cache) as db:
         for key in db.keys():
-            i = json.loads(db[key])
+            data = records.decode(db[key])
             # ignore unfiled items
-            if len(i['data'].get('collections', [])) == 0 and not i['data'].get('parentItem', None):
+            if len(data.get('collections', [])) == 0 and not data.get('parentItem', None):
                 continue
-            item_tags = i['data'].get('tags', None)
+            item_tags = data.get('tags', None)
             if not item_tags:
                 continue
             for tag in item_tags:
                 tag = tag['tag']
                 if not tag in tags:
                     tags[tag] = list()
-                tags[tag].append(i['data']['key'])
+                tags[tag].append(data['key'])
 
     return tags
 
 
-@cache.memoize()
 def _get_children(library_id):
     """Update the list of children for each item based on parentItem.
+    The memory-mapped library snapshot is used if there is one.
     """
+    snap = snapshot.load(library_id)
+    if snap is not None:
+        metrics.inc('zqda_index_lookups_total', index='children', source='snapshot')
+        return snap.children
+    metrics.inc('zqda_index_lookups_total', index='children', source='memoize')
+    return _scan_children(library_id)
+
+
+@cache.single_flight()
+def _scan_children(library_id):
+    """Build the children mapping by reading every stored item."""
+    metrics.inc('zqda_index_memoize_misses_total', index='children')
     relations = {}
 
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
+    item_cache = _item_cache(library_id)
 
-    if not os.path.exists(item_cache):
+    if not _exists(item_cache):
         return relations
 
-    with dbm.open(item_cache, 'r') as db:
+    with _open_db(item_cache) as db:
         for key in db.keys():
-            i = json.loads(db[key])
-            parentItem = i['data'].get('parentItem', None)
+            data = records.decode(db[key])
+            parentItem = data.get('parentItem', None)
             if not parentItem:
                 continue
             if not parentItem in relations:
                 relations[parentItem] = list()
-            relations[parentItem].append(i['data']['key'])
+            relations[parentItem].append(data['key'])
 
     return relations
 
@@ -345,32 +717,125 @@ def _get_children(library_id):
 def _get_items(library_id):
     """Retrieve the item metadata from the database associated with a group
     library."""
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
-    if not os.path.exists(item_cache):
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
         return []
-    with dbm.open(item_cache, 'r') as db:
-        items = [json.loads(db[key]) for key in db.keys()]
+    with _open_db(item_cache) as db:
+        items = [records.decode_item(db[key]) for key in db.keys()]
     return items
 
 def _sanitize(filename):
+    from slugify import slugify
     base, ext = os.path.splitext(filename)
     base = slugify(base)
     return base + ext
 
+def _db_size(item_cache):
+    return sum(os.path.getsize(f) for f in glob.glob(item_cache + '*'))
+
+
+@app.cli.command('build-snapshot')
+@click.argument('library_ids', nargs=-1)
+def build_snapshot(library_ids):
+    """Rebuild the memory-mapped tag/collection/children snapshot from the
+    stored items. Rebuilds all configured libraries if none are given."""
+    versions = {}
+    jsn = os.path.join(app.data_path, 'versions.json')
+    if os.path.exists(jsn):
+        with open(jsn, 'r') as f:
+            versions = json.load(f)
+    for library_id in library_ids or app.config['LIBRARY']:
+        path = snapshot.build(library_id, versions.get(library_id, 0))
+        click.echo('{}: {}'.format(library_id, path or 'no item database'))
+
+
+@app.cli.command('sync-library')
+@click.argument('library_ids', nargs=-1)
+@click.option('--record', metavar='CASSETTE',
+              help='Record the Zotero API traffic to a cassette file.')
+@click.option('--replay', metavar='CASSETTE',
+              help='Answer Zotero API requests from a recorded cassette.')
+@click.option('--speed', default=0.0,
+              help='Replay speed: 1 is real time, 0 (default) is no delay.')
+def sync_library(library_ids, record, replay, speed):
+    """Synchronize libraries from the command line and report timings.
+    Syncs all configured libraries if none are given. A replayed sync only
+    reproduces the recorded one when it starts from the same local state,
+    so use a separate data directory (HOME) for replays."""
+    from zqda import cassette
+    from zqda.client import get_stats, recording
+
+    ctx = contextlib.nullcontext()
+    if record:
+        ctx = recording(record)
+    if replay:
+        server = cassette.ReplayServer(cassette.load(replay), speed=speed)
+        app.config['ZOTERO_API_URL'] = server.start()
+    with ctx:
+        for library_id in library_ids or app.config['LIBRARY']:
+            t = time.perf_counter()
+            msg = _sync_items(library_id)
+            click.echo('{}: {} ({:.2f} s)'.format(
+                library_id, msg, time.perf_counter() - t))
+    for library_id, msg in _after_sync(library_ids or app.config['LIBRARY']):
+        click.echo('{}: {}'.format(library_id, msg))
+    click.echo('Zotero API: {requests} requests, {retries} retries, '
+               '{bytes_received} bytes received.'.format(**get_stats()))
+    if replay and server.unmatched:
+        click.echo('{} requests had no recorded response.'.format(
+            server.unmatched))
+
+
+@app.cli.command('migrate-items')
+@click.argument('library_ids', nargs=-1)
+def migrate_items(library_ids):
+    """Rewrite stored item records in the compact record format. The
+    database is copied to a new file, so run this while no sync is in
+    progress. Migrates all configured libraries if none are given."""
+    for library_id in library_ids or app.config['LIBRARY']:
+        item_cache = _item_cache(library_id)
+        if not _exists(item_cache):
+            continue
+        size = _db_size(item_cache)
+        tmp = item_cache + '.migrate'
+        converted = 0
+        with dbm.open(item_cache, 'r') as db, dbm.open(tmp, 'n') as new:
+            for key in db.keys():
+                raw = db[key]
+                if records.is_legacy(raw):
+                    raw = records.encode(json.loads(raw))
+                    converted += 1
+                new[key] = raw
+        for f in glob.glob(tmp + '*'):
+            os.replace(f, item_cache + f[len(tmp):])
+        click.echo('{}: converted {} records, {} -> {} bytes'.format(
+            library_id, converted, size, _db_size(item_cache)))
+
+
 def _get_item(library_id, item_key, data='data'):
     """Retrieve the metadata for a single item from the database associated 
     with a group library."""
-    item_cache = os.path.join(
-        app.data_path, 'items_{}.db'.format(library_id))
-    if not os.path.exists(item_cache):
+    t = metrics.start()
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
         return None
-    with dbm.open(item_cache, 'r') as db:
+    with _open_db(item_cache) as db:
         try:
-            i = json.loads(db[item_key])
+            raw = db[item_key]
         except KeyError:
-            return None
-    return i.get(data, None) 
+            raw = None
+    metrics.item_loaded(t)
+    _depends_on(item_key)
+    return records.decode(raw, data) if raw is not None else None
+
+
+def _depends_on(item_key):
+    """Record that the page being rendered shows an item, while a static
+    export (zqda.export) tracks page dependencies."""
+    if has_app_context() and '_item_deps' in g:
+        if isinstance(item_key, bytes):
+            item_key = item_key.decode('utf-8')
+        g._item_deps.add(item_key)
 
 
 def _translate_zotero_uri(uri):
@@ -385,6 +850,7 @@ def _translate_zotero_uri(uri):
 
 def _process_citations(txt):
     # <span class="citation" data-citation="{"citationItems":[{"uris":["http://zotero.org/groups/4711671/items/GXPF7VK9"]},{"uris":["http://zotero.org/groups/4711671/items/UJ8WGSFR"]}],"properties":{}}"> <span class="citation-item">...</span>...</span>
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(txt, 'html.parser')
     citations = soup.find_all('span', 'citation')
     for c in citations:
@@ -402,6 +868,168 @@ def _process_citations(txt):
     return str(soup)
 
 
+def _attachment_target(item_key, item):
+    """Path where the file of an attachment item is stored on download."""
+    filename = _sanitize(item['filename'])
+    if item['contentType'] == 'text/html':
+        filename = item_key + '.zip'
+    return os.path.join(app.data_path, item_key, filename)
+
+
+def _attachment_path(item_key, item):
+    """Path of the stored file of an attachment item."""
+    filepath = _attachment_target(item_key, item)
+
+    # Compatibility with non-slugified filenames
+    if not os.path.exists(filepath):
+        filepath = os.path.join(app.data_path, item_key, item['filename'])
+    return filepath
+
+
+def _lazy_attachments(library_id):
+    """Whether the attachment files of a library are only downloaded when
+    they are first requested (LIBRARY.<id>.lazy_attachments)."""
+    return app.config['LIBRARY'][library_id].get('lazy_attachments', False)
+
+
+def _download_attachment(zot, item_key, target):
+    """Download the file of an attachment item to `target`, yielding the
+    chunks as they arrive. The file only appears under its name once it is
+    complete. Raises FileNotFoundError if Zotero has no file."""
+    stack = contextlib.ExitStack()
+    r = stack.enter_context(zot.stream_file(item_key))
+    if r.status_code != 200:
+        stack.close()
+        raise FileNotFoundError(item_key)
+    return _Download(stack, _write_chunks(stack, r, target))
+
+
+class _Download:
+    """The chunks of a download. Closing it releases the connection to
+    Zotero even if no chunk was read, e.g. when a client disconnects
+    before a streamed response starts (closing a generator that never
+    started does not run its cleanup)."""
+
+    def __init__(self, stack, chunks):
+        self._stack = stack
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self._chunks
+
+    def close(self):
+        self._chunks.close()
+        self._stack.close()
+
+
+def _write_chunks(stack, r, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = '{}.{}.{}'.format(target, os.getpid(), threading.get_ident())
+    size = 0
+    try:
+        with stack, open(tmp, 'wb') as f:
+            for chunk in r.iter_bytes(65536):
+                f.write(chunk)
+                size += len(chunk)
+                yield chunk
+        os.replace(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _count_download(size)
+
+
+# Disk space used by attachment files: (time of the last count, bytes), as
+# counted by the last _evict_attachments pass of this process plus the
+# downloads of this process since then. Counting means a scan of all
+# attachment directories, so it is only repeated when the quota may have
+# been exceeded or, to notice downloads of other processes, after
+# ATTACHMENT_SCAN_INTERVAL seconds.
+ATTACHMENT_SCAN_INTERVAL = 300
+_attachment_usage = [None, 0]
+_attachment_usage_lock = threading.Lock()
+
+
+def _count_download(size):
+    quota = app.config.get('ATTACHMENT_QUOTA')
+    if not quota:
+        return
+    with _attachment_usage_lock:
+        _attachment_usage[1] += size
+        due = _attachment_usage[1] > quota or _attachment_usage[0] is None or \
+            time.monotonic() - _attachment_usage[0] > ATTACHMENT_SCAN_INTERVAL
+    if due:
+        _evict_attachments()
+
+
+def _attachment_dirs():
+    """(last use, size, path) of each stored attachment directory. Files
+    are touched when they are downloaded, so the last use is the latest
+    modification time of the files in the directory."""
+    for entry in os.scandir(app.data_path):
+        if not entry.is_dir() or not re.match(r'^[A-Z0-9]{8}$', entry.name):
+            continue
+        size = 0
+        last = 0
+        for f in os.scandir(entry.path):
+            if f.is_file():
+                st = f.stat()
+                size += st.st_size
+                last = max(last, st.st_mtime)
+        yield last, size, entry.path
+
+
+def _evict_attachments():
+    """Keep the stored attachment files within ATTACHMENT_QUOTA bytes: when
+    the quota is exceeded, the least recently used attachment directories
+    are removed until 90% of the quota is used. Removed files are
+    downloaded again when they are requested."""
+    quota = app.config.get('ATTACHMENT_QUOTA')
+    if not quota:
+        return 0
+    dirs = sorted(_attachment_dirs())
+    total = sum(size for last, size, path in dirs)
+    removed = 0
+    if total > quota:
+        for last, size, path in dirs:
+            if total <= quota * 0.9:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+    with _attachment_usage_lock:
+        _attachment_usage[:] = [time.monotonic(), total]
+    return removed
+
+
+def _prefetch_attachments(library_id, counts):
+    """Download the missing files of the ATTACHMENT_PREFETCH_N most
+    requested attachments of a library."""
+    from zqda.client import library_client
+    n = app.config.get('ATTACHMENT_PREFETCH_N', 0)
+    prefix = '/raw/{}/'.format(library_id)
+    popular = sorted((p for p in counts if p.startswith(prefix)),
+                     key=counts.get, reverse=True)[:n]
+    zot = None
+    fetched = 0
+    for path in popular:
+        item_key = path[len(prefix):]
+        item = _get_item(library_id, item_key)
+        if not item or item.get('itemType') != 'attachment' or \
+                item.get('linkMode') in ('linked_file', 'linked_url') or \
+                os.path.exists(_attachment_path(item_key, item)):
+            continue
+        zot = zot or library_client(library_id)
+        try:
+            for chunk in _download_attachment(
+                    zot, item_key, _attachment_target(item_key, item)):
+                pass
+        except FileNotFoundError:
+            continue
+        fetched += 1
+    return 'Prefetched {} attachments.'.format(fetched)
+
+
 @app.route('/raw/<library_id>/<item_key>')
 def blob(library_id, item_key):
     """Download a binary attachment. This may be an item
@@ -412,25 +1040,36 @@ def blob(library_id, item_key):
     if not item or item['itemType'] != 'attachment':
         abort(404)
 
-    filename = _sanitize(item['filename'])
-    mimetype = item['contentType']
-    if mimetype == 'text/html':
-        mimetype = 'application/zip'
-        filename = item_key + '.zip'
-
-    dir = os.path.join(app.data_path, item_key)
-    filepath = os.path.join(dir, filename)
-
-    # Compatibility with non-slugified filenames
-    if not os.path.exists(filepath):
-        filepath = os.path.join(dir, item['filename'])
+    filepath = _attachment_path(item_key, item)
 
     if not app.config['LIBRARY'][library_id].get('allow_downloads', False):
         # always allow images embedded in notes
         if item['linkMode'] != 'embedded_image' and _check_key(library_id) is False:
             abort(401)
 
-    response = make_response(send_file(filepath))
+    if app.config['WARM_CACHE'] or app.config['ATTACHMENT_PREFETCH_N']:
+        _count_access(request.path)
+
+    if os.path.exists(filepath):
+        if app.config['ATTACHMENT_QUOTA']:
+            os.utime(filepath)  # last use, for eviction
+        response = make_response(send_file(filepath))
+    elif item.get('linkMode') in ('linked_file', 'linked_url'):
+        abort(404)
+    else:
+        # not downloaded yet (lazy_attachments) or evicted: stream the
+        # file from Zotero while storing it
+        from zqda.client import library_client
+        target = _attachment_target(item_key, item)
+        try:
+            chunks = _download_attachment(library_client(library_id),
+                                          item_key, target)
+        except FileNotFoundError:
+            abort(404)
+        mimetype = mimetypes.guess_type(target)[0] or 'application/octet-stream'
+        # sent as it arrives, without compression (see assets._compress)
+        response = app.response_class(chunks, mimetype=mimetype,
+                                      direct_passthrough=True)
     
     if not app.config['LIBRARY'][library_id].get('robots_index', False):
         # set robots tag
@@ -440,6 +1079,7 @@ def blob(library_id, item_key):
 
 def _dict2table(library_id, data):
     """Convert a dictionary to tabular form."""
+    import json2table
 
     data = {k:v for k,v in data.items() if v != '' and v != []}
     for k, v in data.items():
@@ -514,9 +1154,15 @@ def _embed_pdf(library_id, item_key, data):
 
 
 def _embed_img(library_id, item_key, data):
-    content = '<img src="{}" class="img-fluid">'.format(
-        url_for('blob', library_id=library_id, item_key=item_key)
-    )
+    from zqda.derivatives import thumbnail_url, thumbnail_srcset
+    url = url_for('blob', library_id=library_id, item_key=item_key)
+    srcset = thumbnail_srcset(library_id, item_key, data)
+    if srcset:
+        # link the reduced image to the original
+        content = '<a href="{}"><img src="{}" srcset="{}" sizes="100vw" class="img-fluid"></a>'.format(
+            url, thumbnail_url(library_id, item_key, data, 1280), srcset)
+    else:
+        content = '<img src="{}" class="img-fluid">'.format(url)
     metadata = _dict2table(library_id, data)
     return content + _hr() + metadata
 
@@ -537,14 +1183,17 @@ def _embed_audio(library_id, item_key, data):
     return content + _hr() + metadata
 
 def _embed_note_image(library_id, data):
-    content = data['annotationPosition']
-    
+    from zqda.derivatives import annotation_image_url
+    url = annotation_image_url(library_id, data['key'], data, 1280)
     metadata = _dict2table(library_id, data)
-    return metadata
-    #return content + _hr() + metadata
+    if not url:
+        return metadata
+    content = '<img src="{}" class="img-fluid border">'.format(url)
+    return content + _hr() + metadata
 
 
 def _embed_note(library_id, data):
+    from bs4 import BeautifulSoup
     content = data['note']
     m = re.search(r'<h1>(.*?)</h1>', data['note'])
     if m: 
@@ -564,14 +1213,16 @@ def _embed_note(library_id, data):
 
 
 @app.route('/view/<library_id>')
+@cache.page()
 def library_view(library_id):
     """View an html representation of the library. The list includes top-level
     collections but NOT top-level items, as the latter may include items
     that have been trashed or deleted. (Such items are still accessible in
     other views.)"""
 
-    description = app.config['LIBRARY'][library_id]['description']
-    title = app.config['LIBRARY'][library_id]['title']
+    library_data = _get_library_data(library_id)
+    description = library_data['description']
+    title = library_data['title']
     collections = _get_collections(library_id)
     items = collections['top']
     links = []
@@ -604,6 +1255,7 @@ def _download_authorized(library_id, data):
     return False
 
 @app.route('/view/<library_id>/<item_key>')
+@cache.page()
 def html(library_id, item_key):
     """View an html representation of a library item. For most items this
     will be a table showing item metadata; for a note the full content will
@@ -617,8 +1269,9 @@ def html(library_id, item_key):
     title = data.get('title', '[untitled]')
     if data.get('note', None):
         content, title = _embed_note(library_id, data)
-    # elif data['itemType'] == 'annotation':
-    #     content = _embed_note_image(library_id, data)
+    elif data['itemType'] == 'annotation' and \
+            data.get('annotationType') == 'image':
+        content = _embed_note_image(library_id, data)
     elif data['itemType'] == 'collection':
         content, title = _collection(library_id, item_key, data)
     
@@ -655,9 +1308,160 @@ def render_json(library_id, item_key):
     data = _get_item(library_id, item_key)
     return data
 
+
+def _library_version(library_id):
+    """Library version of the last sync, from versions.json."""
+    jsn = os.path.join(app.data_path, 'versions.json')
+    try:
+        with open(jsn, 'r') as f:
+            return json.load(f).get(library_id, 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _split(value):
+    return [v for v in re.split(r'[\s,]+', value or '') if v]
+
+
+def _batch_keys(library_id, args):
+    """Item keys selected by the itemKey, tag and collection parameters of a
+    batch request, or None if none of them is given (all items)."""
+    selected = None
+    keys = request.get_json(silent=True) if request.method == 'POST' else None
+    if isinstance(keys, dict):
+        keys = keys.get('itemKey')
+    if keys is None and args.get('itemKey') is not None:
+        keys = _split(args.get('itemKey'))
+    if keys is not None:
+        selected = [str(k) for k in keys]
+    for name, index in (('tag', _get_tags), ('collection', _get_collections)):
+        if args.get(name) is None:
+            continue
+        members = [k.decode('utf-8') if isinstance(k, bytes) else k
+                   for k in index(library_id).get(args.get(name), [])]
+        if selected is None:
+            selected = sorted(set(members))
+        else:
+            members = set(members)
+            selected = [k for k in selected if k in members]
+    return selected
+
+
+def _batch_lines(item_cache, keys, item_type, since, fields, snap):
+    """Generate NDJSON lines for the selected items, reading them all from
+    one open database."""
+    with _open_db(item_cache) as db:
+        if keys is None:
+            keys = sorted(k.decode('utf-8') for k in db.keys())
+        buf = []
+        size = 0
+        for key in keys:
+            if item_type and snap is not None and \
+                    snap.item_type(key) not in (None, item_type):
+                continue
+            try:
+                raw = db[key]
+            except KeyError:
+                continue
+            if since is not None and records.decode(raw, 'version') <= since:
+                continue
+            data = records.decode(raw)
+            if item_type and data.get('itemType') != item_type:
+                continue
+            if fields:
+                item = {f: data[f] for f in fields if f in data}
+                if 'bib' in fields:
+                    item['bib'] = records.decode(raw, 'bib')
+            else:
+                item = data
+            line = json.dumps(item, ensure_ascii=False) + '\n'
+            buf.append(line)
+            size += len(line)
+            if size >= 32768:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+
+@app.route('/json/<library_id>', methods=['GET', 'POST'])
+def render_json_batch(library_id):
+    """Stream many library items as newline-delimited JSON, one item per
+    line. Items can be selected with `itemKey` (comma-separated keys, or a
+    JSON list of keys in a POST body), `tag`, `collection`, `itemType` and
+    `since` (items changed after a library version). `fields` limits the
+    output to some fields (`bib` is the formatted citation). The
+    Last-Modified-Version header holds the version to use as `since` for
+    the next request."""
+    if library_id not in app.config['LIBRARY']:
+        abort(404)
+    args = request.values
+    since = args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400)
+    version = _library_version(library_id)
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
+        abort(404)
+    keys = _batch_keys(library_id, args)
+    lines = _batch_lines(item_cache, keys, args.get('itemType'), since,
+                         _split(args.get('fields')), snapshot.load(library_id))
+    response = app.response_class(stream_with_context(lines),
+                                  mimetype='application/x-ndjson')
+    response.headers['Last-Modified-Version'] = str(version)
+    return response
+
+def _store_fields(library_id, item_key, fields, version):
+    """Apply a successful write of some item fields to the stored record,
+    instead of fetching the item again. If the fields change the indexes
+    (tags, collections, parent), the snapshot is rebuilt."""
+    item_cache = _item_cache(library_id)
+    with _sync_lock(library_id), _open_db(item_cache, 'c') as db:
+        item = records.decode_item(db[item_key])
+        item['data'].update(fields)
+        item['data']['version'] = version
+        item['version'] = version
+        db[item_key] = records.encode(item)
+    if set(fields) & {'tags', 'collections', 'parentItem'}:
+        snapshot.build(library_id, _library_version(library_id))
+        cache.clear()
+    _invalidate_pages(library_id)
+
+
+def _annotation_conflict(library_id, item_key, zot, mine):
+    """Form for resolving an edit conflict: the comment on the server, the
+    submitted comment and a field for the merged text, to be submitted
+    against the current server version. The stored record is updated with
+    the server version."""
+    theirs = zot.item(item_key)
+    item_cache = _item_cache(library_id)
+    with _sync_lock(library_id), _open_db(item_cache, 'c') as db:
+        stored = records.decode_item(db[item_key])
+        theirs['bib'] = stored.get('bib')
+        db[item_key] = records.encode(theirs)
+    _invalidate_pages(library_id)
+    comment = theirs['data'].get('annotationComment', '')
+    return theirs['version'], [
+        '<div class="alert alert-warning">This annotation has been changed '
+        'by someone else since you opened it. Merge your changes with the '
+        'current version and submit again.</div>',
+        '<h2 class="h5">Current version</h2>',
+        '<pre class="border p-2">{}</pre>'.format(escape(comment)),
+        '<h2 class="h5">Your version</h2>',
+        '<pre class="border p-2">{}</pre>'.format(escape(mine)),
+    ]
+
+
 @app.route('/annotate/<library_id>/<item_key>', methods=['GET', 'POST'])
 def annotation_form(library_id, item_key):
-    """Create or edit an existing annotation"""
+    """Create or edit an existing annotation. The edit is sent to Zotero
+    conditional on the version the form was opened with; if the annotation
+    has been changed since, a form for merging the two versions is
+    shown."""
     # if _check_key(library_id) is False:
     #     abort(401, 'Unauthorized')
 
@@ -669,24 +1473,37 @@ def annotation_form(library_id, item_key):
     out = []
     
     annotationComment = data['annotationComment']
+    version = _get_item(library_id, item_key, 'version')
     
     if request.method == 'POST':
+        from zqda.client import library_client
         args = request.values
-        zot = zotero.Zotero(library_id, 'group', app.config['LIBRARY'][library_id]['api_key'])
-        item = zot.item(item_key)
+        zot = library_client(library_id)
         annotationComment = args['annotationComment']
-        item['data']['annotationComment'] = annotationComment
-        zot.update_item(item)
-        _sync_item(library_id, item_key, item_type='annotation')
-        flash("Annotation updated")
+        base = args.get('version', version)
+        fields = {'annotationComment': annotationComment}
+        r = zot.patch_item(item_key, base, fields)
+        if r.status_code == 412:
+            version, conflict = _annotation_conflict(
+                library_id, item_key, zot, annotationComment)
+            out.extend(conflict)
+        elif r.status_code in (200, 204):
+            version = int(r.headers.get('Last-Modified-Version', base))
+            _store_fields(library_id, item_key, fields, version)
+            flash("Annotation updated")
+        else:
+            flash('The annotation could not be updated ({} {}).'.format(
+                r.status_code, r.text))
 
     out.append('<form action="{}" id="zform" method="post">'.format(
     url_for('annotation_form', library_id=library_id, item_key=item_key)))
     out.append('<div class="form-group mb-4">')
     out.append(
-        '<p><textarea class="form-control" name="annotationComment" rows="4">{}</textarea></p>'.format(annotationComment))
+        '<p><textarea class="form-control" name="annotationComment" rows="4">{}</textarea></p>'.format(escape(annotationComment)))
     out.append(
         '<input type="hidden" name="library_id" value="{}">'.format(library_id))
+    out.append(
+        '<input type="hidden" name="version" value="{}">'.format(version))
     out.append(
         '<input type="submit" value="Submit" class="btn btn-primary mb-2" />')
     out.append('<a href="{}" class="btn btn-primary mb-2">Return</a>'.format(url_for('html', library_id=library_id, item_key=item_key)))
@@ -700,6 +1517,48 @@ def annotation_form(library_id, item_key):
                            title='Annotate',
                            logged_in=_check_key(library_id)
                            )
+def _after_sync(library_ids):
+    """Work done after syncing libraries: clear the cache, precompute the
+    annotation report summaries of changed libraries, then (depending on the configuration)
+    warm the cache, prefetch and evict attachments, and update the static
+    export and the replica snapshot. Returns a list of (library id,
+    message) pairs."""
+    from zqda.annotation_viewer import update_summaries
+    cache.clear()
+    out = []
+    for library_id in library_ids:
+        t = time.perf_counter()
+        tags = update_summaries(library_id)  # if the snapshot changed
+        if tags is not None:
+            out.append((library_id, 'Summarized {} annotation tags in {:.1f} s.'.format(
+                len(tags), time.perf_counter() - t)))
+    counts = None
+    if app.config['WARM_CACHE'] or app.config['ATTACHMENT_PREFETCH_N']:
+        counts = _access_counts()
+    if app.config['WARM_CACHE']:
+        for library_id in library_ids:
+            out.append((library_id, _warm_cache(library_id, counts)))
+    if app.config['ATTACHMENT_PREFETCH_N']:
+        for library_id in library_ids:
+            if _lazy_attachments(library_id):
+                out.append((library_id,
+                            _prefetch_attachments(library_id, counts)))
+    if app.config['ATTACHMENT_QUOTA']:
+        out.append(('attachments', 'Evicted {} directories.'.format(
+            _evict_attachments())))
+    if app.config['STATIC_EXPORT_DIR']:
+        from zqda.export import export_library
+        for library_id in library_ids:
+            out.append((library_id, export_library(
+                library_id, app.config['STATIC_EXPORT_DIR'])))
+    if app.config['REPLICA_DIR']:
+        from zqda.replica import export_snapshot
+        for library_id in library_ids:
+            out.append((library_id, export_snapshot(
+                library_id, app.config['REPLICA_DIR'])))
+    return out
+
+
 @app.route('/sync')
 def sync():
     """Synchronize data with the zotero.org server. Retrieves the metadata
@@ -710,7 +1569,11 @@ def sync():
         out.append('Synchronizing {}...'.format(library_id))
         r = _sync_items(library_id)
         out.append(r)
-    cache.clear()
+    for library_id, msg in _after_sync(libraries):
+        out.append('{}: {}'.format(library_id, msg))
+    from zqda.client import get_stats
+    out.append('Zotero API: {requests} requests, {retries} retries, '
+               '{bytes_received} bytes received.'.format(**get_stats()))
     return render_template('base.html',
                            content=Markup('<br>'.join(out)),
                            title='Library synchronization')
@@ -722,12 +1585,13 @@ def delete_item(library_id, item_key):
     if _check_key(library_id) is False:
         abort(401)
 
-    item_cache = os.path.join(app.data_path, 'items_{}.db'.format(library_id))
-    with dbm.open(item_cache, 'c') as db:
+    item_cache = _item_cache(library_id)
+    with _sync_lock(library_id), _open_db(item_cache, 'c') as db:
         try:
             del(db[item_key])
         except Exception as e:
             flash(e)
+    _invalidate_pages(library_id)
 
     return redirect(url_for('html', library_id=library_id, item_key=item_key))
 
@@ -747,12 +1611,14 @@ def index():
     redirect to the application help page."""
     if not app.config.get('EXPORT', True):
         return redirect(url_for('help'))
+    import markdown
 
-    libraries = app.config['LIBRARY'].items()
+    libraries = app.config['LIBRARY']
     links = []
     icon = '<i class="bi bi-folder h2 text-primary"></i>'
 
-    for library, data in libraries:
+    for library in libraries:
+        data = _get_library_data(library)
         url = url_for('library_view', library_id=library)
         links.append('<tr><td style="width:2em"><div>{}</div></td><td>{}<p class="mt-3">{}</p></td></tr>'.format(
             icon, _a(url, data['title']), data['description']))
@@ -761,6 +1627,9 @@ def index():
                 '<table class="table">' + 
                 ''.join(sorted(links)) +
                 '</table>')
+    if len(libraries) > 1:
+        content += '<p>{}</p>'.format(
+            _a(url_for('federated_tags'), 'Compare tags across libraries'))
 
     return render_template('base.html',
                            content=Markup(content),
@@ -771,6 +1640,7 @@ def _a(link, title):
     return '<a class="text-break" href="{}">{}</a>'.format(link, title)
 
 def _link(library_id, item_key):
+    from bs4 import BeautifulSoup
     item_data = _get_item(library_id, item_key)
     if not item_data:
         return ''
@@ -799,6 +1669,20 @@ def _link(library_id, item_key):
     if description_trunc != description:
         description = description_trunc + '...'
 
+    # small previews of images and image annotations
+    from zqda.derivatives import thumbnail_url, annotation_image_url
+    key = item_key.decode('utf-8')
+    preview = None
+    if item_data.get('contentType', '').startswith('image') and \
+            _download_authorized(library_id, item_data):
+        preview = thumbnail_url(library_id, key, item_data)
+    elif item_data.get('itemType', '') == 'annotation' and \
+            _download_authorized(library_id, parentItem):
+        preview = annotation_image_url(library_id, key, item_data, 320)
+    if preview:
+        description = '<img src="{}" class="img-thumbnail d-block mb-2" loading="lazy" style="max-width:160px">{}'.format(
+            preview, description)
+
     # Add the itemType and title in a comment for sorting
     return '<!-- {} {} --><tr><td style="width:2em"><div>{}</div></td><td>{}<p class="mt-3">{}</p></td></tr>'.format(
         item_data.get('itemType', 'document'), 
@@ -823,7 +1707,7 @@ def _collection(library_id, collection_id, collection_data):
         title = parent_data['name']
     else:
         link = url_for('library_view', library_id=library_id)
-        title = app.config['LIBRARY'][library_id]['title']
+        title = _get_library_data(library_id)['title']
 
     links.append('<!-- _up --><tr><td style="width:2em">{}</td><td>{}</td></tr>'.format(
         icon, _a(link, title)))
@@ -836,9 +1720,10 @@ def _collection(library_id, collection_id, collection_data):
 
 
 @app.route('/tags/<library_id>')
+@cache.page()
 def show_tags(library_id):
     """Show a list of tags in the selected group library."""
-    title = 'Tags: {}'.format(app.config['LIBRARY'][library_id]['title'])
+    title = 'Tags: {}'.format(_get_library_data(library_id)['title'])
     links = []
     tags = _get_tags(library_id)
     icon = '<i class="bi bi-tag h2 text-primary"></i>'
@@ -862,6 +1747,7 @@ def show_tags(library_id):
 
 
 @app.route('/tags/<library_id>/<tag_name>')
+@cache.page()
 def tag_list(library_id, tag_name):
     """View a list of resources in the library associated with `tag_name`.
     """
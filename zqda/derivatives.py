@@ -0,0 +1,369 @@
+import concurrent.futures
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+from flask import g, has_request_context, request, url_for, abort, send_file
+from werkzeug.exceptions import UnsupportedMediaType
+
+from zqda import app
+from zqda import metrics
+from zqda.core import (_get_item, _attachment_path, _download_authorized,
+                       _load_attachment)
+
+# Image derivatives.
+#
+# Images are not sent at full size to pages that only need a preview:
+# /thumb/<library_id>/<item_key>?w=<width> returns a resized copy of an
+# image attachment (or the first page of a PDF), and
+# /annotation_image/<library_id>/<item_key>?w=<width> the region of the
+# PDF page marked by an image annotation. Derivatives are generated on
+# first request (or in a background pool when a page that shows them is
+# rendered) and stored in data_path/derivatives, named after the MD5 of
+# the attachment file, the annotated region and the width, so they are
+# never stale: URLs carry the MD5 (`v`) and are served with immutable
+# caching headers. Widths are limited to THUMBNAIL_WIDTHS.
+#
+# Resizing needs Pillow, PDF rendering needs PyMuPDF; both are optional.
+# Without them, thumbnail_url() and annotation_image_url() return None and
+# pages show the original files (or no preview), as before. They also
+# return None for files that could not be rendered (corrupt, encrypted or
+# mislabeled), which are remembered by an empty <md5>.failed file;
+# requests for their derivatives get a 415 response. Pages rendered for a
+# static export (see zqda.export) link the original files, as the export
+# has no derivatives.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+JPEG_QUALITY = 80
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+def _pil():
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    return Image, ImageOps
+
+
+def _pymupdf():
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf  # PyMuPDF < 1.24
+        except ImportError:
+            return None
+    return pymupdf
+
+
+def _width(width=None):
+    """The allowed width closest to (and not smaller than) `width`."""
+    widths = sorted(app.config['THUMBNAIL_WIDTHS'])
+    if width is None:
+        return widths[0]
+    for w in widths:
+        if w >= width:
+            return w
+    return widths[-1]
+
+
+def _md5(item_key, item):
+    """MD5 of an attachment file, as reported by Zotero or, failing that,
+    derived from the size and time of the stored file."""
+    if item.get('md5'):
+        return item['md5']
+    st = os.stat(_attachment_path(item_key, item))
+    return hashlib.md5('{}:{}:{}'.format(
+        item_key, st.st_size, st.st_mtime_ns).encode('utf-8')).hexdigest()
+
+
+def _path(name):
+    return os.path.join(app.data_path, 'derivatives', name[:2], name)
+
+
+def _source(library_id, item_key, item):
+    """Path of the stored file of an attachment, downloading it first if
+    needed (lazy libraries, evicted files)."""
+    path = _attachment_path(item_key, item)
+    if not os.path.exists(path):
+        from zqda.client import library_client
+        _load_attachment(library_client(library_id),
+                         {'data': dict(item, key=item_key)})
+        path = _attachment_path(item_key, item)
+        if not os.path.exists(path):
+            abort(404)
+    return path
+
+
+def _exporting():
+    return has_request_context() and g.get('_static_export', False)
+
+
+def _thumbnail_kind(item):
+    if item.get('itemType') != 'attachment' or \
+            item.get('linkMode') == 'linked_url':
+        return None
+    content_type = item.get('contentType', '')
+    if content_type.startswith('image/') and content_type != 'image/svg+xml' \
+            and _pil() is not None:
+        return 'image'
+    if content_type == 'application/pdf' and _pymupdf() is not None:
+        return 'pdf'
+    return None
+
+
+def _position(item):
+    """Page index and rectangles of an image annotation, or None."""
+    if item.get('itemType') != 'annotation' or \
+            item.get('annotationType') != 'image':
+        return None
+    try:
+        position = json.loads(item['annotationPosition'])
+        return position['pageIndex'], position['rects']
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _failed_path(md5):
+    return _path('{}.failed'.format(md5))
+
+
+def _render_image(path, source, width, fmt):
+    Image, ImageOps = _pil()
+    try:
+        with Image.open(source) as image:
+            image.draft('RGB', (width, width * 2))  # fast JPEG downscaling
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, width * 2))
+            if fmt == 'png':
+                image.save(path, 'PNG', optimize=True)
+            else:
+                image.convert('RGB').save(path, 'JPEG', quality=JPEG_QUALITY,
+                                          optimize=True, progressive=True)
+    except (OSError, Image.DecompressionBombError):
+        # includes UnidentifiedImageError and truncated files
+        abort(415)
+
+
+def _render_pdf(path, source, width, page_index=0, rects=None):
+    """Render a page of a PDF to JPEG, or the region of it covered by
+    `rects` (PDF coordinates, as in Zotero annotation positions) to PNG."""
+    pymupdf = _pymupdf()
+    try:
+        doc = pymupdf.open(source, filetype='pdf')
+    except (RuntimeError, ValueError):  # FileDataError, EmptyFileError
+        abort(415)
+    with doc:
+        if doc.needs_pass:
+            abort(415)
+        if not 0 <= page_index < len(doc):
+            abort(404)
+        page = doc[page_index]
+        clip = page.rect
+        if rects:
+            clip = pymupdf.Rect()
+            for rect in rects:
+                clip |= pymupdf.Rect(rect) * page.transformation_matrix
+            clip &= page.rect
+        if clip.is_empty:
+            abort(404)
+        zoom = min(width / clip.width, 4)
+        try:
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom),
+                                     clip=clip)
+        except RuntimeError:  # damaged page content
+            abort(415)
+        if rects:
+            data = pixmap.tobytes('png')
+        else:
+            data = pixmap.tobytes('jpeg', jpg_quality=JPEG_QUALITY)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _generate(name, render, *args):
+    """Create a derivative file unless it exists. Concurrent requests for
+    the same file wait for the first one instead of rendering it again.
+    Source files that can't be rendered are remembered (see _failed_path).
+    """
+    path = _path(name)
+    if os.path.exists(path):
+        return path
+    md5 = name.split('-', 1)[0]
+    if os.path.exists(_failed_path(md5)):
+        abort(415)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            t = metrics.start()
+            tmp = '{}.{}.{}'.format(path, os.getpid(), threading.get_ident())
+            try:
+                render(tmp, *args)
+                os.replace(tmp, path)
+            except UnsupportedMediaType:
+                open(_failed_path(md5), 'a').close()
+                raise
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            metrics.observe('zqda_derivative_seconds', t,
+                            kind=render.__name__.replace('_render_', ''))
+    return path
+
+
+def _thumbnail_format(item):
+    if _thumbnail_kind(item) == 'image' and \
+            item['contentType'] in ('image/png', 'image/gif', 'image/webp'):
+        return 'png'  # may have transparency
+    return 'jpg'
+
+
+def _thumbnail_name(item_key, item, width):
+    return '{}-{}.{}'.format(_md5(item_key, item), width,
+                             _thumbnail_format(item))
+
+
+def _crop_name(md5, position, width):
+    region = hashlib.md5(json.dumps(position).encode('utf-8')).hexdigest()
+    return '{}-{}-{}.png'.format(md5, region[:12], width)
+
+
+def _background(fn, *args):
+    """Run fn(*args) in the DERIVATIVE_WORKERS pool, if there is one."""
+    workers = app.config['DERIVATIVE_WORKERS']
+    if not workers:
+        return
+    with _pool_lock:
+        if not _pool:
+            _pool.append(concurrent.futures.ThreadPoolExecutor(workers))
+
+    def run():
+        with app.app_context():
+            try:
+                fn(*args)
+            except Exception:  # reported when the derivative is requested
+                pass
+    _pool[0].submit(run)
+
+
+def thumbnail_url(library_id, item_key, item, width=None):
+    """URL of a thumbnail of an image or PDF attachment no wider than
+    `width`, or None if there is no thumbnail for this kind of file. The
+    thumbnail is generated in the background if the file is stored."""
+    if _thumbnail_kind(item) is None or _exporting():
+        return None
+    width = _width(width)
+    try:
+        md5 = _md5(item_key, item)
+    except OSError:  # not downloaded yet, and no MD5 from Zotero
+        return None
+    if os.path.exists(_failed_path(md5)):
+        return None
+    if not os.path.exists(_path(_thumbnail_name(item_key, item, width))) and \
+            os.path.exists(_attachment_path(item_key, item)):
+        _background(_thumbnail, library_id, item_key, item, width)
+    return url_for('thumbnail', library_id=library_id, item_key=item_key,
+                   w=width, v=md5[:12])
+
+
+def thumbnail_srcset(library_id, item_key, item):
+    """`srcset` attribute value with a thumbnail for each allowed width."""
+    urls = []
+    for width in sorted(app.config['THUMBNAIL_WIDTHS']):
+        url = thumbnail_url(library_id, item_key, item, width)
+        if url is None:
+            return None
+        urls.append('{} {}w'.format(url, width))
+    return ', '.join(urls)
+
+
+def annotation_image_url(library_id, item_key, item, width=None):
+    """URL of the image of the PDF region marked by an image annotation,
+    or None if it can't be rendered or the current user may not download
+    the annotated file."""
+    if _position(item) is None or _pymupdf() is None or _exporting():
+        return None
+    attachment = _get_item(library_id, item.get('parentItem'))
+    if not attachment or not attachment.get('md5') or \
+            os.path.exists(_failed_path(attachment['md5'])) or \
+            not _download_authorized(library_id, attachment):
+        return None
+    return url_for('annotation_image', library_id=library_id,
+                   item_key=item_key, w=_width(width),
+                   v=attachment['md5'][:12])
+
+
+def _thumbnail(library_id, item_key, item, width):
+    source = _source(library_id, item_key, item)
+    name = _thumbnail_name(item_key, item, width)
+    if _thumbnail_kind(item) == 'pdf':
+        return _generate(name, _render_pdf, source, width)
+    return _generate(name, _render_image, source, width,
+                     _thumbnail_format(item))
+
+
+def _send(path, version):
+    """Send a derivative. Requests for the current version (`v`) are
+    cached by clients for good; others are revalidated."""
+    response = send_file(path, etag=os.path.basename(path), conditional=True)
+    if request.args.get('v') == version:
+        response.headers['Cache-Control'] = IMMUTABLE
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    if not app.config['LIBRARY'][request.view_args['library_id']].get(
+            'robots_index', False):
+        response.headers['X-Robots-Tag'] = 'noindex'
+    return response
+
+
+def _width_arg():
+    try:
+        return _width(int(request.args.get('w', 0)) or None)
+    except ValueError:
+        abort(400)
+
+
+@app.route('/thumb/<library_id>/<item_key>')
+def thumbnail(library_id, item_key):
+    """Download a reduced image of an image attachment or of the first page
+    of a PDF attachment, no wider than `w` pixels."""
+    if library_id not in app.config['LIBRARY']:
+        abort(404)
+    item = _get_item(library_id, item_key)
+    if not item or _thumbnail_kind(item) is None:
+        abort(404)
+    if not _download_authorized(library_id, item):
+        abort(401)
+    path = _thumbnail(library_id, item_key, item, _width_arg())
+    return _send(path, _md5(item_key, item)[:12])
+
+
+@app.route('/annotation_image/<library_id>/<item_key>')
+def annotation_image(library_id, item_key):
+    """Download the region of a PDF page marked by an image annotation, no
+    wider than `w` pixels."""
+    if library_id not in app.config['LIBRARY']:
+        abort(404)
+    item = _get_item(library_id, item_key)
+    position = item and _position(item)
+    if not position or _pymupdf() is None:
+        abort(404)
+    attachment = _get_item(library_id, item.get('parentItem'))
+    if not attachment or attachment.get('itemType') != 'attachment':
+        abort(404)
+    if not _download_authorized(library_id, attachment):
+        abort(401)
+    parent = item['parentItem']
+    md5 = _md5(parent, attachment)
+    width = _width_arg()
+    page_index, rects = position
+    source = _source(library_id, parent, attachment)
+    path = _generate(_crop_name(md5, position, width), _render_pdf,
+                     source, width, page_index, rects)
+    return _send(path, md5[:12])
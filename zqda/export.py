@@ -0,0 +1,285 @@
+import json
+import os
+import shutil
+import time
+from urllib.parse import unquote
+
+import click
+from flask import g, url_for
+
+from zqda import app
+from zqda import records
+from zqda.annotation_viewer import report_urls
+from zqda.core import (cache, _item_cache, _exists, _open_db, _get_tags,
+                       _attachment_path, _sync_items)
+
+# Static site export.
+#
+# Every page of a library (library root, collections, items, tag lists and
+# annotation reports) is rendered into OUTPUT/<url path>/index.html, and
+# downloadable attachments are copied to OUTPUT/raw/<library>/<key>, so
+# that a web server can serve the site without the application. A
+# generated nginx.conf contains the location blocks needed to serve the
+# pages and the attachments with the right content types.
+#
+# While a page is rendered, the items it shows (every _get_item call) are
+# recorded. The dependency map and the item versions at export time are
+# kept in OUTPUT/.export-<library>.json, and an incremental export only
+# re-renders the pages that show a changed item, plus the pages that a
+# changed item now appears on (its own page, its collections, parent and
+# tags). Pages are rendered by a pool of forked worker processes. They link
+# the original attachment files instead of thumbnails (zqda.derivatives),
+# which are not part of the export.
+
+CHUNK_SIZE = 50
+
+
+def _state_path(output, library_id):
+    return os.path.join(output, '.export-{}.json'.format(library_id))
+
+
+def _load_state(output, library_id):
+    try:
+        with open(_state_path(output, library_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'versions': {}, 'deps': {}, 'tags': []}
+
+
+def _page_file(output, url):
+    path = unquote(url).strip('/')
+    return os.path.join(output, path, 'index.html')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _render_pages(output, urls):
+    """Render pages to files. Returns {url: [item keys]} for the pages
+    that were written and a list of the pages that could not be."""
+    deps = {}
+    failed = []
+    for url in urls:
+        with app.test_request_context(url):
+            g._item_deps = set()
+            g._static_export = True  # no thumbnail URLs, see derivatives
+            try:
+                response = app.full_dispatch_request()
+            except Exception:
+                response = None
+            if response is None or response.status_code != 200:
+                failed.append(url)
+                continue
+            _write(_page_file(output, url), response.get_data())
+            deps[url] = sorted(g._item_deps)
+    return deps, failed
+
+
+def _versions(library_id):
+    """Current version of every stored item and collection."""
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
+        return {}
+    with _open_db(item_cache) as db:
+        return {k.decode('utf-8'): records.decode(db[k], 'version')
+                for k in db.keys()}
+
+
+def _items(library_id, keys):
+    item_cache = _item_cache(library_id)
+    with _open_db(item_cache) as db:
+        return {k: records.decode(db[k]) for k in keys}
+
+
+def _safe_tag(tag):
+    # tags that cannot be a path segment are not exported
+    return tag and '/' not in tag and tag not in ('.', '..')
+
+
+def _affected_pages(library_id, changed, deleted, state, tags):
+    """Pages to re-render for a set of changed and deleted item keys. The
+    pages of deleted items fail to render and are removed."""
+    pages = set()
+    for url, keys in state['deps'].items():
+        if changed.intersection(keys) or deleted.intersection(keys):
+            pages.add(url)
+    for key in deleted:
+        pages.add(url_for('html', library_id=library_id, item_key=key))
+    for key, data in _items(library_id, changed).items():
+        pages.add(url_for('html', library_id=library_id, item_key=key))
+        parents = list(data.get('collections', []))
+        for k in ('parentCollection', 'parentItem'):
+            if data.get(k):
+                parents.append(data[k])
+        if data['itemType'] == 'collection' and not data.get('parentCollection'):
+            pages.add(url_for('library_view', library_id=library_id))
+        for parent in parents:
+            pages.add(url_for('html', library_id=library_id, item_key=parent))
+        for tag in data.get('tags', []):
+            if _safe_tag(tag['tag']) and tag['tag'] in tags:
+                pages.add(url_for('tag_list', library_id=library_id,
+                                  tag_name=tag['tag']))
+                pages.add(url_for('show_annotations', library_id=library_id,
+                                  tag=tag['tag']))
+                pages.update(report_urls(library_id, tag['tag']))
+    if sorted(tags) != state['tags']:
+        pages.add(url_for('show_tags', library_id=library_id))
+        pages.add(url_for('show_annotations_tag_select', library_id=library_id))
+    return pages
+
+
+def _all_pages(library_id, versions, tags):
+    pages = {url_for('index'),
+             url_for('library_view', library_id=library_id),
+             url_for('show_tags', library_id=library_id),
+             url_for('show_annotations_tag_select', library_id=library_id)}
+    for key in versions:
+        pages.add(url_for('html', library_id=library_id, item_key=key))
+    for tag in tags:
+        if _safe_tag(tag):
+            pages.add(url_for('tag_list', library_id=library_id, tag_name=tag))
+            pages.add(url_for('show_annotations', library_id=library_id,
+                              tag=tag))
+            pages.update(report_urls(library_id, tag))
+    return pages
+
+
+def _copy_attachments(output, library_id, keys, types):
+    """Copy downloadable attachments; returns {url: content type}."""
+    allow = app.config['LIBRARY'][library_id].get('allow_downloads', False)
+    copied = {}
+    for key, data in _items(library_id, keys).items():
+        if data['itemType'] != 'attachment':
+            continue
+        if not allow and data.get('linkMode') != 'embedded_image':
+            continue
+        source = _attachment_path(key, data)
+        if not os.path.exists(source):
+            continue
+        url = url_for('blob', library_id=library_id, item_key=key)
+        target = os.path.join(output, url.strip('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, target)
+        content_type = data['contentType']
+        if content_type == 'text/html':
+            content_type = 'application/zip'
+        copied[url] = content_type
+    types.update(copied)
+    return copied
+
+
+def _write_nginx_conf(output, types, robots):
+    """Write location blocks for serving the export with nginx: pages are
+    index.html files, attachments need their content type."""
+    lines = ['# Generated by `flask --app zqda export-static`. Include in a',
+             '# server block whose root is this directory.',
+             'location / {',
+             '    try_files $uri/index.html $uri =404;',
+             '}',
+             '# fingerprinted assets (flask --app zqda build-assets)',
+             'location /static/dist/ {',
+             '    gzip_static on;',
+             '    add_header Cache-Control "public, max-age=31536000, immutable";',
+             '}']
+    for url in sorted(types):
+        lines.append('location = {} {{'.format(url))
+        lines.append('    types {{ }} default_type "{}";'.format(types[url]))
+        if not robots.get(url.split('/')[2], False):
+            lines.append('    add_header X-Robots-Tag noindex;')
+        lines.append('}')
+    _write(os.path.join(output, 'nginx.conf'),
+           ('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def export_library(library_id, output, full=False, workers=None):
+    """Export a library to `output`. Unless `full` is set, only the pages
+    affected by items changed since the previous export are rendered.
+    Returns a summary message."""
+    t = time.perf_counter()
+    output = os.path.abspath(output)
+    state = {'versions': {}, 'deps': {}, 'tags': []} if full else \
+        _load_state(output, library_id)
+    versions = _versions(library_id)
+    changed = {k for k, v in versions.items()
+               if state['versions'].get(k) != v}
+    deleted = set(state['versions']).difference(versions)
+
+    with app.test_request_context():
+        tags = list(_get_tags(library_id))
+        if full or not state['versions']:
+            pages = _all_pages(library_id, versions, tags)
+        else:
+            pages = _affected_pages(library_id, changed, deleted, state,
+                                    tags)
+        types_path = os.path.join(output, '.export-types.json')
+        try:
+            with open(types_path, 'r') as f:
+                types = json.load(f)
+        except (OSError, ValueError):
+            types = {}
+        attachments = _copy_attachments(output, library_id, changed, types)
+
+    # pages are rendered in forked processes, which share the warm caches
+    # of this one
+    pages = sorted(pages)
+    chunks = [pages[i:i + CHUNK_SIZE] for i in range(0, len(pages), CHUNK_SIZE)]
+    failed = []
+    if chunks:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            for deps, bad in pool.map(_render_pages, [output] * len(chunks),
+                                      chunks):
+                state['deps'].update(deps)
+                failed.extend(bad)
+    for url in failed:
+        # pages that no longer exist, e.g. a tag that is no longer used
+        state['deps'].pop(url, None)
+        try:
+            os.remove(_page_file(output, url))
+        except OSError:
+            pass
+
+    static = os.path.join(output, 'static')
+    shutil.copytree(app.static_folder, static, dirs_exist_ok=True)
+    robots = {k: v.get('robots_index', False)
+              for k, v in app.config['LIBRARY'].items()}
+    _write(types_path, json.dumps(types).encode('utf-8'))
+    _write_nginx_conf(output, types, robots)
+
+    state['versions'] = versions
+    state['tags'] = sorted(tags)
+    _write(_state_path(output, library_id), json.dumps(state).encode('utf-8'))
+    return 'Exported {} pages and {} attachments ({} changed items) in {:.1f} s.'.format(
+        len(pages) - len(failed), len(attachments), len(changed),
+        time.perf_counter() - t)
+
+
+@app.cli.command('export-static')
+@click.argument('library_ids', nargs=-1)
+@click.option('--output', default=None, metavar='DIR',
+              help='Output directory (default: STATIC_EXPORT_DIR).')
+@click.option('--full', is_flag=True,
+              help='Render every page, not only those affected by changes.')
+@click.option('--workers', type=int, default=None,
+              help='Number of rendering processes (default: CPU count).')
+@click.option('--sync', is_flag=True,
+              help='Synchronize the libraries before exporting.')
+def export_static(library_ids, output, full, workers, sync):
+    """Export libraries as a static site. Exports all configured libraries
+    if none are given."""
+    output = output or app.config.get('STATIC_EXPORT_DIR')
+    if not output:
+        raise click.UsageError('No --output directory or STATIC_EXPORT_DIR.')
+    for library_id in library_ids or app.config['LIBRARY']:
+        if sync:
+            click.echo('{}: {}'.format(library_id, _sync_items(library_id)))
+            cache.clear()
+        click.echo('{}: {}'.format(
+            library_id, export_library(library_id, output, full, workers)))
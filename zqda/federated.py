@@ -0,0 +1,290 @@
+import concurrent.futures
+
+from flask import request, url_for, render_template, jsonify, abort
+from markupsafe import Markup, escape
+
+from zqda import app
+from zqda import records
+from zqda import snapshot
+from zqda.derivatives import annotation_image_url
+from zqda.core import (cache, _get_tags, _get_library_data, _library_version,
+                       _item_cache, _exists, _open_db, _split, _a)
+
+# Queries across libraries.
+#
+# Projects that span several group libraries can compare their codes in a
+# single request: /federated/tags lists the tags of a set of libraries
+# (`libraries=<id>,<id>`, default: all configured libraries) with the
+# number of items and annotations per library, and
+# /federated/annotations lists the annotations with any of a set of tags
+# in all of them. Each library is queried in its own thread, from its
+# snapshot and a single open item database, and the results are merged
+# and ranked: tags used in more libraries (then by more items) first,
+# annotations matching more of the requested tags first. Merged results
+# are cached under the versions and page generations of the libraries, so
+# a sync or edit of any of them makes the next request query them again.
+# Both routes have a JSON version (/federated/tags.json,
+# /federated/annotations.json).
+
+MAX_WORKERS = 8
+
+
+def _libraries():
+    """Library IDs selected with the `libraries` parameter (comma-separated
+    or repeated), in the order of the configuration."""
+    configured = list(app.config['LIBRARY'])
+    selected = _split(','.join(request.args.getlist('libraries')))
+    if not selected:
+        return configured
+    for library_id in selected:
+        if library_id not in configured:
+            abort(404)
+    return [library_id for library_id in configured if library_id in selected]
+
+
+def _state(library_ids):
+    """Cache key part that changes when any of the libraries changes."""
+    return '+'.join('{}@{}.{}'.format(library_id, _library_version(library_id),
+                                      cache.get('pages:' + library_id))
+                    for library_id in library_ids)
+
+
+def _parallel(fn, library_ids, *args):
+    """Run fn(library_id, *args) for each library in a thread pool.
+    Returns {library_id: result}."""
+    def run(library_id):
+        with app.app_context():
+            return fn(library_id, *args)
+    workers = min(MAX_WORKERS, len(library_ids)) or 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return dict(zip(library_ids, pool.map(run, library_ids)))
+
+
+def _cached(kind, library_ids, args, fn):
+    key = 'federated:{}:{}:{}'.format(kind, _state(library_ids), args)
+    value = cache.get(key)
+    if value is None:
+        value = fn()
+        cache.set(key, value)
+    return value
+
+
+def _library_tags(library_id):
+    """{tag: (items, annotations)} for a library. Annotations are only
+    counted from the snapshot (None without one)."""
+    tags = _get_tags(library_id)
+    snap = snapshot.load(library_id)
+    if snap is None or not isinstance(tags, snapshot.Postings):
+        return {tag: (len(tags[tag]), None) for tag in tags}
+    annotation = snap.type_names.find('annotation')
+    counts = {}
+    for tag in tags:
+        ids = tags.ids_for(tag)
+        counts[tag] = (len(ids),
+                       sum(1 for i in ids if snap.types[i] == annotation))
+    return counts
+
+
+def merged_tags(library_ids):
+    """Tags of several libraries, ranked by the number of libraries using
+    them, then by the total number of items. Returns a list of
+    {'tag', 'items', 'annotations', 'libraries': {id: {'items',
+    'annotations'}}} dicts."""
+    def merge():
+        merged = {}
+        for library_id, tags in _parallel(_library_tags, library_ids).items():
+            for tag, (items, annotations) in tags.items():
+                entry = merged.setdefault(
+                    tag, {'tag': tag, 'items': 0, 'annotations': 0,
+                          'libraries': {}})
+                entry['items'] += items
+                entry['annotations'] += annotations or 0
+                entry['libraries'][library_id] = {'items': items,
+                                                  'annotations': annotations}
+        return sorted(merged.values(),
+                      key=lambda e: (-len(e['libraries']), -e['items'],
+                                     e['tag'].casefold()))
+    return _cached('tags', library_ids, '', merge)
+
+
+def _library_annotations(library_id, tags):
+    """Annotations of a library with any of `tags`, with the citation of
+    the document they belong to. Items are read from a single open item
+    database."""
+    index = _get_tags(library_id)
+    matched = {}
+    for tag in tags:
+        if tag in index:
+            for key in index[tag]:
+                matched[key] = matched.get(key, 0) + 1
+    item_cache = _item_cache(library_id)
+    if not matched or not _exists(item_cache):
+        return []
+
+    annotations = []
+    documents = {}
+    with _open_db(item_cache) as db:
+        def load(key, field='data'):
+            try:
+                return records.decode(db[key], field)
+            except KeyError:
+                return None
+
+        for key in sorted(matched):
+            data = load(key)
+            if not data or data.get('itemType') != 'annotation':
+                continue
+            parent = data.get('parentItem')  # the attachment
+            if parent not in documents:
+                attachment = load(parent) if parent else None
+                document = attachment and attachment.get('parentItem')
+                documents[parent] = (document, (document and load(document, 'bib'))
+                                     or (attachment or {}).get('title')
+                                     or 'No title')
+            document, title = documents[parent]
+            annotations.append({
+                'library': library_id,
+                'key': key,
+                'parentItem': parent,
+                'document': document,
+                'title': title,
+                'type': data.get('annotationType'),
+                'position': data.get('annotationPosition'),
+                'text': data.get('annotationText', ''),
+                'comment': data.get('annotationComment', ''),
+                'color': data.get('annotationColor'),
+                'pageLabel': data.get('annotationPageLabel', ''),
+                'dateModified': data.get('dateModified', ''),
+                'tags': [t['tag'] for t in data.get('tags', [])],
+                'matched': matched[key],
+            })
+    return annotations
+
+
+def merged_annotations(library_ids, tags):
+    """Annotations with any of `tags` in several libraries, ranked by the
+    number of the tags they have, then by the most recently modified."""
+    def merge():
+        merged = []
+        for annotations in _parallel(_library_annotations, library_ids,
+                                     tags).values():
+            merged.extend(annotations)
+        merged.sort(key=lambda a: a['dateModified'], reverse=True)
+        merged.sort(key=lambda a: a['matched'], reverse=True)
+        return merged
+    return _cached('annotations', library_ids,
+                   repr(sorted(set(tags))), merge)
+
+
+def _title(library_id):
+    return _get_library_data(library_id)['title']
+
+
+def _selection_form(endpoint, library_ids, tags=()):
+    """Checkboxes for choosing the libraries of a federated query."""
+    out = ['<form method="get" action="{}" class="mb-4">'.format(
+        url_for(endpoint))]
+    for tag in tags:
+        out.append('<input type="hidden" name="tag" value="{}">'.format(
+            escape(tag)))
+    for library_id in app.config['LIBRARY']:
+        out.append(
+            '<div class="form-check form-check-inline">'
+            '<input class="form-check-input" type="checkbox" id="lib-{id}" '
+            'name="libraries" value="{id}" {checked}>'
+            '<label class="form-check-label" for="lib-{id}">{title}</label>'
+            '</div>'.format(id=library_id, title=escape(_title(library_id)),
+                            checked='checked' if library_id in library_ids
+                            else ''))
+    out.append('<button type="submit" class="btn btn-primary btn-sm">'
+               'Compare</button></form>')
+    return ''.join(out)
+
+
+@app.route('/federated/tags')
+@app.route('/federated/tags.<format>')
+def federated_tags(format='html'):
+    """Compare the tags of several libraries (`libraries`, comma-separated;
+    default: all). Tags used in more libraries are listed first, with the
+    number of items and annotations in each library."""
+    library_ids = _libraries()
+    tags = merged_tags(library_ids)
+    if format == 'json':
+        return jsonify({'libraries': library_ids, 'tags': tags})
+    if format != 'html':
+        abort(404)
+
+    libraries = ','.join(library_ids)
+    out = [_selection_form('federated_tags', library_ids),
+           '<table class="table"><thead><tr><th>Tag</th>']
+    for library_id in library_ids:
+        out.append('<th>{}</th>'.format(escape(_title(library_id))))
+    out.append('</tr></thead><tbody>')
+    for entry in tags:
+        link = url_for('federated_annotations', libraries=libraries,
+                       tag=entry['tag'])
+        out.append('<tr><td>{}</td>'.format(_a(link, escape(entry['tag']))))
+        for library_id in library_ids:
+            counts = entry['libraries'].get(library_id)
+            if counts is None:
+                out.append('<td></td>')
+                continue
+            out.append('<td>{}</td>'.format(_a(
+                url_for('tag_list', library_id=library_id,
+                        tag_name=entry['tag']),
+                '{} items{}'.format(counts['items'],
+                                    '' if counts['annotations'] is None else
+                                    ', {} annotations'.format(
+                                        counts['annotations'])))))
+        out.append('</tr>')
+    out.append('</tbody></table>')
+    return render_template('base.html', content=Markup(''.join(out)),
+                           title='Tags in {} libraries'.format(len(library_ids)))
+
+
+@app.route('/federated/annotations')
+@app.route('/federated/annotations.<format>')
+def federated_annotations(format='html'):
+    """Show the annotations with any of the given tags (`tag`, repeated)
+    in several libraries (`libraries`, comma-separated; default: all).
+    Annotations with more of the tags are listed first."""
+    library_ids = _libraries()
+    tags = list(dict.fromkeys(t for t in request.args.getlist('tag') if t))
+    if not tags:
+        abort(400)
+    annotations = merged_annotations(library_ids, tags)
+    if format == 'json':
+        return jsonify({'libraries': library_ids, 'tags': tags,
+                        'annotations': annotations})
+    if format != 'html':
+        abort(404)
+
+    titles = {library_id: _title(library_id) for library_id in library_ids}
+    out = [_selection_form('federated_annotations', library_ids, tags),
+           '<ol>']
+    for a in annotations:
+        zotero_link = 'zotero://open-pdf/groups/{}/items/{}?page={}&annotation={}'.format(
+            a['library'], a['parentItem'], a['pageLabel'], a['key'])
+        out.append('<li>')
+        out.append('<p><span class="badge bg-secondary">{}</span></p>'.format(
+            escape(titles[a['library']])))
+        out.append('<p class="b"><a href="{}">{}</a></p>'.format(
+            zotero_link, a['title']))
+        image = annotation_image_url(a['library'], a['key'], {
+            'itemType': 'annotation', 'annotationType': a['type'],
+            'annotationPosition': a['position'],
+            'parentItem': a['parentItem']}, 640)
+        if image:
+            out.append('<p><img src="{}" class="img-fluid border" '
+                       'loading="lazy"></p>'.format(image))
+        out.append('<p>{}</p>'.format(escape(a['text'] or 'No text')))
+        out.append('<p><em>{}</em></p>'.format(escape(a['comment'])))
+        item_tags = ['<a class="btn btn-{} btn-sm" href="{}">{}</a>'.format(
+            'primary' if t in tags else 'secondary',
+            url_for('show_annotations', library_id=a['library'], tag=t),
+            escape(t)) for t in a['tags']]
+        out.append('<p>{}</p>'.format(' '.join(item_tags)))
+        out.append('</li>')
+    out.append('</ol>')
+    return render_template('base.html', content=Markup(' '.join(out)),
+                           title='Annotations - {}'.format(', '.join(tags)))
@@ -0,0 +1,351 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+import click
+
+from zqda import app
+from zqda import records
+from zqda.core import (_item_cache, _exists, _open_db, _sync_lock,
+                       _write_json, _attachment_path, _attachment_target,
+                       _lazy_attachments, _load_attachment)
+
+# Attachment integrity checks.
+#
+# `flask --app zqda verify-attachments` compares the stored attachment
+# files (data_path/<item key>/<file name>) with the item databases:
+#
+#   - each stored file is hashed and compared to the MD5 that Zotero
+#     reports for the attachment. Files are hashed by a pool of threads
+#     (hashlib releases the GIL, so hashing runs on all cores) and each
+#     file is read exactly once. Files that do not match are removed and,
+#     for libraries that download attachments during syncs, downloaded
+#     again; lazy libraries download them on the next request.
+#   - attachment directories that belong to no item of any configured
+#     library (e.g. of deleted items), stray files in attachment
+#     directories and leftovers of interrupted downloads are removed.
+#
+# Files are hashed and downloaded again without holding the sync locks, so
+# syncs and edits are not held up by a long verification; a file is only
+# removed if its item still has the MD5 it was checked against and the file
+# has not changed since. The shared sync locks of all libraries are only
+# held while the item databases are read and while unused directories are
+# removed (so that syncs don't add attachments in the meantime).
+#
+# The size, modification time and hash of verified files are remembered in
+# data_path/verified_<library>.json, so later runs only hash new or
+# changed files (--full hashes everything again). HTML snapshots are
+# stored as the zip file returned by the API, whose hash Zotero does not
+# report; they are only checked for existence.
+
+CHUNK_SIZE = 1 << 20
+# files and directories younger than this (in seconds) may belong to a
+# download or sync in progress and are never removed
+GRACE_PERIOD = 3600
+KEY_DIR = re.compile(r'^[A-Z0-9]{8}$')
+
+
+def _verified_path(library_id):
+    return os.path.join(app.data_path, 'verified_{}.json'.format(library_id))
+
+
+def _attachments(library_id):
+    """{item key: data} of the attachment items of a library that have a
+    stored file, read in a single pass over the item database. None if
+    the library has no item database."""
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
+        return None
+    attachments = {}
+    with _open_db(item_cache) as db:
+        for k in db.keys():
+            data = records.decode(db[k], 'data')
+            if data.get('itemType') != 'attachment' or \
+                    data.get('linkMode') in ('linked_file', 'linked_url') or \
+                    not data.get('filename'):
+                continue
+            attachments[k.decode('utf-8')] = {
+                'filename': data['filename'],
+                'contentType': data.get('contentType', ''),
+                'md5': data.get('md5'),
+            }
+    return attachments
+
+
+def _md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _expected(key, data):
+    """Names a stored file of an attachment may have."""
+    return {os.path.basename(_attachment_target(key, data)), data['filename']}
+
+
+def verify_library(library_id, attachments, jobs=None, full=False,
+                   dry_run=False, progress=None):
+    """Hash the stored files of a library and compare them to their MD5
+    values. Removes the files that do not match unless `dry_run` is set.
+    Returns the report for the library and the keys of the removed files.
+    """
+    known = {} if full else _load_verified(library_id)
+    report = {'attachments': len(attachments), 'files': 0, 'bytes': 0,
+              'missing': 0, 'hashed': 0, 'hashed_bytes': 0, 'bad': 0,
+              'unchecked': 0}
+    todo = []
+    verified = {}
+    for key, data in sorted(attachments.items()):
+        path = _attachment_path(key, data)
+        try:
+            st = os.stat(path)
+        except OSError:
+            report['missing'] += 1
+            continue
+        report['files'] += 1
+        report['bytes'] += st.st_size
+        if not data['md5'] or data['contentType'] == 'text/html':
+            report['unchecked'] += 1
+            continue
+        stamp = [st.st_size, st.st_mtime_ns, data['md5']]
+        rel = os.path.relpath(path, app.data_path)
+        if known.get(rel) == stamp:
+            verified[rel] = stamp
+            if progress:
+                progress.update(st.st_size)
+            continue
+        todo.append((key, data['md5'], path, rel, stamp))
+
+    bad = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = {pool.submit(_md5, path): (key, md5, path, rel, stamp)
+                   for key, md5, path, rel, stamp in todo}
+        for future in concurrent.futures.as_completed(futures):
+            key, md5, path, rel, stamp = futures[future]
+            report['hashed'] += 1
+            report['hashed_bytes'] += stamp[0]
+            if progress:
+                progress.update(stamp[0])
+            try:
+                digest = future.result()
+            except OSError:  # removed in the meantime
+                continue
+            if digest == md5:
+                verified[rel] = stamp
+            elif _remove_if_unchanged(library_id, key, md5, path, stamp,
+                                      dry_run):
+                bad.append(key)
+                report['bad'] += 1
+    if not dry_run:
+        _write_json(_verified_path(library_id), verified)
+    return report, bad
+
+
+def _current(library_id, key):
+    """The stored data of an item, or None if it no longer exists."""
+    with _open_db(_item_cache(library_id)) as db:
+        try:
+            return records.decode(db[key], 'data')
+        except KeyError:
+            return None
+
+
+def _remove_if_unchanged(library_id, key, md5, path, stamp, dry_run):
+    """Remove a file that did not match `md5`, unless a sync changed the
+    item or the file while it was hashed. Returns whether the file is
+    bad."""
+    with _sync_lock(library_id, shared=True):
+        data = _current(library_id, key)
+        if data is None or data.get('md5') != md5:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if [st.st_size, st.st_mtime_ns] != stamp[:2]:
+            return False
+        if not dry_run:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+    return True
+
+
+def _load_verified(library_id):
+    try:
+        with open(_verified_path(library_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def collect_garbage(attachments, dry_run=False):
+    """Remove attachment directories of unknown items and stray files in
+    attachment directories. `attachments` maps the item keys of all
+    configured libraries to their data. Returns the number of removed
+    directories and files and the bytes reclaimed."""
+    cutoff = time.time() - GRACE_PERIOD
+    dirs = files = reclaimed = 0
+    for entry in os.scandir(app.data_path):
+        if not entry.is_dir(follow_symlinks=False) or \
+                not KEY_DIR.match(entry.name):
+            continue
+        data = attachments.get(entry.name)
+        if data is None:
+            if entry.stat().st_mtime > cutoff:
+                continue
+            size = _size(entry.path)
+            if not dry_run:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            dirs += 1
+            reclaimed += size
+            continue
+        expected = _expected(entry.name, data)
+        for f in os.scandir(entry.path):
+            if f.name in expected or f.stat().st_mtime > cutoff:
+                continue
+            size = _size(f.path) if f.is_dir() else f.stat().st_size
+            if not dry_run:
+                if f.is_dir():
+                    shutil.rmtree(f.path, ignore_errors=True)
+                else:
+                    os.remove(f.path)
+            files += 1
+            reclaimed += size
+    return dirs, files, reclaimed
+
+
+def _redownload(library_id, attachments, keys):
+    from zqda.client import library_client
+    zot = library_client(library_id)
+    fetched = 0
+    for key in keys:
+        data = _current(library_id, key)
+        if data is None or data.get('md5') != attachments[key]['md5']:
+            continue  # changed by a sync, which downloads the new file
+        _load_attachment(zot, {'data': data})
+        fetched += os.path.exists(_attachment_path(key, data))
+    return fetched
+
+
+def _format_size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TB'
+    return '{:.1f} {}'.format(n, unit) if unit != 'B' else '{} B'.format(n)
+
+
+@app.cli.command('verify-attachments')
+@click.argument('library_ids', nargs=-1)
+@click.option('--jobs', type=int, default=os.cpu_count(),
+              help='Number of files hashed at the same time '
+              '(default: number of CPUs).')
+@click.option('--full', is_flag=True,
+              help='Hash all files, including those verified before.')
+@click.option('--dry-run', is_flag=True,
+              help='Only report, do not remove or download files.')
+@click.option('--json', 'json_path', default=None, metavar='FILE',
+              help='Also write the report to a JSON file.')
+def verify_attachments(library_ids, jobs, full, dry_run, json_path):
+    """Check the stored attachment files against the MD5 values reported by
+    Zotero, download files that do not match again, remove the files of
+    deleted items, and report the disk usage of each library. Checks all
+    configured libraries if none are given."""
+    t = time.perf_counter()
+    configured = list(app.config['LIBRARY'])
+    library_ids = library_ids or configured
+    for library_id in library_ids:
+        if library_id not in configured:
+            raise click.BadParameter('unknown library {}'.format(library_id))
+
+    def locked():
+        # keep syncs from changing the item databases while they are read
+        # and from adding attachments while directories are removed
+        locks = contextlib.ExitStack()
+        for library_id in configured:
+            locks.enter_context(_sync_lock(library_id, shared=True))
+        return locks
+
+    with locked():
+        libraries = {library_id: _attachments(library_id)
+                     for library_id in configured}
+    total = 0
+    for library_id in library_ids:
+        for key, data in (libraries[library_id] or {}).items():
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(_attachment_path(key, data))
+
+    report = {'libraries': {}}
+    with click.progressbar(length=total, label='Verifying',
+                           file=click.get_text_stream('stderr')) as bar:
+        for library_id in library_ids:
+            if libraries[library_id] is None:
+                continue
+            r, bad = verify_library(library_id, libraries[library_id],
+                                    jobs, full, dry_run, bar)
+            r['downloaded'] = 0
+            if bad and not dry_run and not _lazy_attachments(library_id):
+                r['downloaded'] = _redownload(
+                    library_id, libraries[library_id], bad)
+            report['libraries'][library_id] = r
+
+    with locked():
+        # read again: items may have been added or removed since
+        libraries = {library_id: _attachments(library_id)
+                     for library_id in configured}
+        if None in libraries.values():
+            # without all item databases, no directory is known to be unused
+            report['orphans'] = None
+        else:
+            everything = {}
+            for attachments in libraries.values():
+                everything.update(attachments)
+            dirs, files, reclaimed = collect_garbage(everything, dry_run)
+            report['orphans'] = {'directories': dirs, 'files': files,
+                                 'bytes': reclaimed}
+
+    click.echo('{:<10} {:>8} {:>8} {:>10} {:>8} {:>6} {:>10} {:>10}'.format(
+        'library', 'items', 'files', 'size', 'missing', 'bad', 'unchecked',
+        'hashed'))
+    for library_id, r in report['libraries'].items():
+        click.echo('{:<10} {:>8} {:>8} {:>10} {:>8} {:>6} {:>10} {:>10}'.format(
+            library_id, r['attachments'], r['files'], _format_size(r['bytes']),
+            r['missing'], r['bad'], r['unchecked'],
+            _format_size(r['hashed_bytes'])))
+        if r['downloaded']:
+            click.echo('{}: downloaded {} of {} bad files again.'.format(
+                library_id, r['downloaded'], r['bad']))
+    for library_id in library_ids:
+        if libraries[library_id] is None:
+            click.echo('{}: no item database.'.format(library_id))
+    orphans = report['orphans']
+    if orphans is None:
+        click.echo('Unused directories not checked: not all libraries are '
+                   'synchronized.')
+    else:
+        click.echo('{} {} unused directories and {} stray files ({}).'.format(
+            'Found' if dry_run else 'Removed', orphans['directories'],
+            orphans['files'], _format_size(orphans['bytes'])))
+    report['seconds'] = time.perf_counter() - t
+    click.echo('Done in {:.1f} s.'.format(report['seconds']))
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,294 @@
+import atexit
+import fcntl
+import json
+import os
+import threading
+import time
+
+from flask import g, request, make_response, abort
+
+from zqda import app
+
+# Instrumentation, exposed in the Prometheus text format at /metrics.
+#
+# Metrics are only collected when METRICS_DIR is set; otherwise every
+# function here returns after one dictionary lookup. Each process collects
+# counters, gauges and histograms in memory and periodically adds them to
+# the shared file METRICS_DIR/metrics.json under an exclusive lock
+# (METRICS_FLUSH_INTERVAL seconds, and at exit). This works for any number
+# of worker processes, including one process per request under CGI.
+#
+# Timing a block:
+#
+#     t = metrics.start()
+#     ...
+#     metrics.observe('zqda_..._seconds', t, label='value')
+#
+# start() returns None when metrics are disabled and observe() ignores it.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METRICS = {
+    'zqda_http_request_duration_seconds':
+        ('histogram', LATENCY_BUCKETS, 'Flask request latency per endpoint.'),
+    'zqda_http_requests_total':
+        ('counter', None, 'Flask requests per endpoint and status.'),
+    'zqda_dbm_opens_per_request':
+        ('histogram', COUNT_BUCKETS, 'Item database opens per request.'),
+    'zqda_get_item_calls_per_request':
+        ('histogram', COUNT_BUCKETS, 'Item lookups (_get_item) per request.'),
+    'zqda_dbm_opens_total':
+        ('counter', None, 'Item database opens.'),
+    'zqda_dbm_open_seconds_total':
+        ('counter', None, 'Time spent opening item databases.'),
+    'zqda_get_item_calls_total':
+        ('counter', None, 'Item lookups (_get_item).'),
+    'zqda_get_item_seconds_total':
+        ('counter', None, 'Time spent in item lookups (_get_item).'),
+    'zqda_index_lookups_total':
+        ('counter', None, 'Tag/collection/children index lookups by source.'),
+    'zqda_index_memoize_misses_total':
+        ('counter', None, 'Index lookups that had to scan the item database.'),
+    'zqda_single_flight_total':
+        ('counter', None, 'Single-flight memoized calls by outcome '
+                          '(hit, build, wait, stale).'),
+    'zqda_page_cache_total':
+        ('counter', None, 'Page cache lookups by outcome (hit, miss).'),
+    'zqda_zotero_api_request_duration_seconds':
+        ('histogram', LATENCY_BUCKETS, 'Zotero API request latency.'),
+    'zqda_zotero_api_requests_total':
+        ('counter', None, 'Zotero API requests by route and status.'),
+    'zqda_zotero_api_bytes_sent_total':
+        ('counter', None, 'Zotero API request body bytes.'),
+    'zqda_zotero_api_bytes_received_total':
+        ('counter', None, 'Zotero API response body bytes.'),
+    'zqda_sync_duration_seconds':
+        ('histogram', LATENCY_BUCKETS, 'Library sync duration.'),
+    'zqda_sync_items_total':
+        ('counter', None, 'Items stored by library syncs.'),
+    'zqda_sync_items_per_second':
+        ('gauge', None, 'Items per second of the last library sync.'),
+    'zqda_derivative_seconds':
+        ('histogram', LATENCY_BUCKETS, 'Thumbnail and annotation image '
+                                       'generation time by kind.'),
+}
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = [time.monotonic()]
+
+
+def enabled():
+    return bool(app.config.get('METRICS_DIR'))
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                     .replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to a counter."""
+    if not app.config.get('METRICS_DIR'):
+        return
+    key = _labels(labels)
+    with _lock:
+        series = _pending.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    if not app.config.get('METRICS_DIR'):
+        return
+    with _lock:
+        _pending.setdefault(name, {})[_labels(labels)] = value
+
+
+def observe_value(name, value, **labels):
+    """Add a value to a histogram."""
+    if not app.config.get('METRICS_DIR'):
+        return
+    buckets = METRICS[name][1]
+    key = _labels(labels)
+    with _lock:
+        series = _pending.setdefault(name, {})
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                h[i] += 1
+        h[-2] += value
+        h[-1] += 1
+
+
+def start():
+    """Start a timer; None when metrics are disabled."""
+    if app.config.get('METRICS_DIR'):
+        return time.perf_counter()
+    return None
+
+
+def observe(name, started, **labels):
+    """Record the time since `started` (from start()) in a histogram or, for
+    `_seconds_total` counters, add it to the counter."""
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    if METRICS[name][0] == 'histogram':
+        observe_value(name, seconds, **labels)
+    else:
+        inc(name, seconds, **labels)
+    return seconds
+
+
+def _request_count(name, value=1):
+    """Count an event for the current request, if there is one."""
+    try:
+        counts = g._metrics_counts
+    except (AttributeError, RuntimeError):  # no request context
+        return
+    counts[name] = counts.get(name, 0) + value
+
+
+def dbm_opened(started):
+    seconds = observe('zqda_dbm_open_seconds_total', started,
+                      endpoint=_endpoint())
+    if seconds is not None:
+        inc('zqda_dbm_opens_total', endpoint=_endpoint())
+        _request_count('zqda_dbm_opens_per_request')
+
+
+def item_loaded(started):
+    seconds = observe('zqda_get_item_seconds_total', started,
+                      endpoint=_endpoint())
+    if seconds is not None:
+        inc('zqda_get_item_calls_total', endpoint=_endpoint())
+        _request_count('zqda_get_item_calls_per_request')
+
+
+def _endpoint():
+    try:
+        return request.endpoint or 'none'
+    except RuntimeError:  # outside of a request, e.g. CLI commands
+        return 'cli'
+
+
+def _merge(stored, pending):
+    for name, series in pending.items():
+        kind = METRICS[name][0]
+        target = stored.setdefault(name, {})
+        for key, value in series.items():
+            if kind == 'histogram':
+                old = target.get(key)
+                target[key] = value if old is None else [
+                    a + b for a, b in zip(old, value)]
+            elif kind == 'counter':
+                target[key] = target.get(key, 0) + value
+            else:
+                target[key] = value
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def flush():
+    """Add the metrics collected by this process to the shared file."""
+    directory = app.config.get('METRICS_DIR')
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.monotonic()
+    if not directory or not pending:
+        return
+    directory = os.path.expanduser(directory)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'metrics.json')
+    with open(os.path.join(directory, 'metrics.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stored = _read(path)
+        _merge(stored, pending)
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp, path)
+
+
+atexit.register(flush)
+
+
+def render(stored):
+    """Render aggregated metrics in the Prometheus text format."""
+    out = []
+    for name in sorted(stored):
+        if name not in METRICS:
+            continue
+        kind, buckets, description = METRICS[name]
+        out.append('# HELP {} {}'.format(name, description))
+        out.append('# TYPE {} {}'.format(name, kind))
+        for key, value in sorted(stored[name].items()):
+            labels = '{{{}}}'.format(key) if key else ''
+            if kind != 'histogram':
+                out.append('{}{} {}'.format(name, labels, value))
+                continue
+            sep = ',' if key else ''
+            for bound, count in zip(buckets + ('+Inf',), value[:-2] + value[-1:]):
+                out.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                    name, key, sep, bound, count))
+            out.append('{}_sum{} {}'.format(name, labels, value[-2]))
+            out.append('{}_count{} {}'.format(name, labels, value[-1]))
+    return '\n'.join(out) + '\n'
+
+
+@app.before_request
+def _before_request():
+    if app.config.get('METRICS_DIR'):
+        g._metrics_start = time.perf_counter()
+        g._metrics_counts = {}
+
+
+@app.teardown_request
+def _teardown_request(exc=None):
+    started = g.pop('_metrics_start', None)
+    if started is None:
+        return
+    endpoint = _endpoint()
+    observe('zqda_http_request_duration_seconds', started, endpoint=endpoint)
+    counts = g.pop('_metrics_counts', {})
+    for name in ('zqda_dbm_opens_per_request',
+                 'zqda_get_item_calls_per_request'):
+        observe_value(name, counts.get(name, 0), endpoint=endpoint)
+    interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+    if time.monotonic() - _last_flush[0] >= interval:
+        flush()
+
+
+@app.after_request
+def _after_request(response):
+    if app.config.get('METRICS_DIR'):
+        inc('zqda_http_requests_total', endpoint=_endpoint(),
+            status=response.status_code)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Instrumentation in the Prometheus text format, aggregated over all
+    processes. Only available when METRICS_DIR is configured."""
+    directory = app.config.get('METRICS_DIR')
+    if not directory:
+        abort(404)
+    flush()
+    stored = _read(os.path.join(os.path.expanduser(directory), 'metrics.json'))
+    response = make_response(render(stored))
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
@@ -0,0 +1,179 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request, abort, send_file
+
+from zqda import app
+from zqda.core import _is_admin
+
+# Request profiling.
+#
+# Administrators (see ADMIN_KEYS) can profile a single request by adding
+# `?profile=1` or an `X-ZQDA-Profile: 1` header. The request thread is
+# sampled by a background thread and the stacks are stored in the folded
+# format used by flamegraph.pl, speedscope and similar tools, in
+# data_path/profiles/. The file name is returned in the X-ZQDA-Profile
+# response header and can be downloaded from /profiles/<name>. With
+# `profile=folded` the folded stacks are returned instead of the page.
+#
+# If SLOW_REQUEST_THRESHOLD (seconds) is set, every request is sampled at a
+# lower rate and requests that take longer are logged with a summary of
+# their profile to data_path/slow_requests.log (one JSON object per line).
+
+SUMMARY_FRAMES = 20
+
+
+class _Sampler(object):
+    """One daemon thread that samples the stacks of all registered threads.
+    A thread is only sampled while it is registered."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.thread = None
+
+    def start(self, interval):
+        profile = {'stacks': Counter(), 'interval': interval,
+                   'next': time.perf_counter()}
+        with self.lock:
+            self.profiles[threading.get_ident()] = profile
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return profile
+
+    def stop(self):
+        with self.lock:
+            return self.profiles.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                profiles = dict(self.profiles)
+            if not profiles:
+                time.sleep(0.05)
+                continue
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            for ident, profile in profiles.items():
+                if now < profile['next'] or ident not in frames:
+                    continue
+                profile['stacks'][_stack(frames[ident])] += 1
+                profile['next'] = now + profile['interval']
+            del frames
+            time.sleep(min(p['interval'] for p in profiles.values()))
+
+
+_sampler = _Sampler()
+
+
+def _label(code):
+    path = code.co_filename
+    return '{}/{}:{}'.format(os.path.basename(os.path.dirname(path)),
+                             os.path.basename(path), code.co_name)
+
+
+def _stack(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+def folded(stacks):
+    """Profile in the folded stack format, one `frame;frame;... count` line
+    per distinct stack."""
+    return ''.join('{} {}\n'.format(stack, n)
+                   for stack, n in sorted(stacks.items()))
+
+
+def summary(stacks, limit=SUMMARY_FRAMES):
+    """Where the samples went: the functions with the most samples at the
+    top of the stack ('self'), and the functions of this package with the
+    most samples anywhere on the stack ('zqda'). Each entry is
+    [label, samples]."""
+    own = Counter()
+    total = Counter()
+    for stack, n in stacks.items():
+        frames = stack.split(';')
+        own[frames[-1]] += n
+        for label in set(frames):
+            if label.startswith('zqda/'):
+                total[label] += n
+    return {'self': [list(i) for i in own.most_common(limit)],
+            'zqda': [list(i) for i in total.most_common(limit)]}
+
+
+def _profile_dir():
+    path = os.path.join(app.data_path, 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@app.before_request
+def _start_profile():
+    flag = request.args.get('profile') or request.headers.get('X-ZQDA-Profile')
+    if flag and _is_admin():
+        g._profile_flag = flag
+        g._profile = _sampler.start(app.config['PROFILE_INTERVAL'])
+    elif app.config.get('SLOW_REQUEST_THRESHOLD') is not None:
+        g._profile = _sampler.start(app.config['SLOW_REQUEST_INTERVAL'])
+    else:
+        return
+    g._profile_start = time.perf_counter()
+
+
+@app.after_request
+def _stop_profile(response):
+    profile = g.pop('_profile', None)
+    if profile is None:
+        return response
+    _sampler.stop()
+    seconds = time.perf_counter() - g.pop('_profile_start')
+    stacks = profile['stacks']
+    flag = g.pop('_profile_flag', None)
+
+    if flag:
+        name = '{}-{}-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                        request.endpoint, os.getpid())
+        with open(os.path.join(_profile_dir(), name), 'w') as f:
+            f.write(folded(stacks))
+        response.headers['X-ZQDA-Profile'] = name
+        if flag == 'folded':
+            response = app.response_class(folded(stacks), mimetype='text/plain')
+            response.headers['X-ZQDA-Profile'] = name
+
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD')
+    if threshold is not None and seconds >= threshold:
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'method': request.method, 'path': request.full_path,
+                 'endpoint': request.endpoint, 'status': response.status_code,
+                 'seconds': round(seconds, 4),
+                 'samples': sum(stacks.values()), 'top': summary(stacks)}
+        with open(os.path.join(app.data_path, 'slow_requests.log'), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    return response
+
+
+@app.teardown_request
+def _teardown_profile(exc=None):
+    # after_request is skipped when a view raises an unhandled exception
+    if g.pop('_profile', None) is not None:
+        _sampler.stop()
+
+
+@app.route('/profiles/<name>')
+def profile_file(name):
+    """Download a stored request profile (folded stacks). Only available
+    to administrators."""
+    if not _is_admin():
+        abort(403)
+    path = os.path.join(_profile_dir(), os.path.basename(name))
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='text/plain')
@@ -0,0 +1,87 @@
+import json
+import pickle
+import struct
+import zlib
+
+# Compact storage format for the item records kept in items_<library_id>.db.
+#
+# Only the `version`, `data` and `bib` parts of an API response are kept; the
+# `links`, `meta` and `library` envelopes are never used. A record is a fixed
+# header followed by the pickled `data` dict and the UTF-8 `bib` string, each
+# zlib-compressed if it is large enough to benefit. The header holds the item
+# version and the length of the data part, so either part (or the version)
+# can be decoded without touching the other.
+#
+# Records written by older versions are JSON text and are still readable.
+
+MAGIC = b'\x00Z'
+FORMAT = 1
+_HEADER = struct.Struct('>2sBBQI')  # magic, format, flags, version, len(data)
+
+DATA_COMPRESSED = 1
+BIB_COMPRESSED = 2
+
+# Decompression costs more than it saves for small records.
+COMPRESS_MIN_SIZE = 2048
+COMPRESS_LEVEL = 1
+
+
+def _pack(payload, flag):
+    if len(payload) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(compressed) < len(payload):
+            return compressed, flag
+    return payload, 0
+
+
+def encode(item):
+    """Encode an item (an API response with `data` and optionally `bib`
+    fields) as a compact record."""
+    data, data_flag = _pack(pickle.dumps(item['data'], protocol=4),
+                            DATA_COMPRESSED)
+    bib, bib_flag = _pack((item.get('bib') or '').encode('utf-8'),
+                          BIB_COMPRESSED)
+    version = item.get('version', item['data'].get('version', 0))
+    return _HEADER.pack(MAGIC, FORMAT, data_flag | bib_flag, version,
+                        len(data)) + data + bib
+
+
+def is_legacy(raw):
+    """Return True if `raw` is a JSON record written by older versions."""
+    return not raw[:2] == MAGIC
+
+
+def decode(raw, field='data'):
+    """Decode one field ('data', 'bib' or 'version') of a stored record.
+    Returns None if the record has no such field."""
+    if is_legacy(raw):
+        return json.loads(raw).get(field, None)
+    magic, fmt, flags, version, data_len = _HEADER.unpack_from(raw)
+    if field == 'version':
+        return version
+    start = _HEADER.size
+    if field == 'data':
+        payload = raw[start:start + data_len]
+        if flags & DATA_COMPRESSED:
+            payload = zlib.decompress(payload)
+        return pickle.loads(payload)
+    if field == 'bib':
+        payload = raw[start + data_len:]
+        if not payload:
+            return None
+        if flags & BIB_COMPRESSED:
+            payload = zlib.decompress(payload)
+        return payload.decode('utf-8')
+    return None
+
+
+def decode_item(raw):
+    """Decode a stored record into a dict with `key`, `version`, `data`
+    and `bib` fields, as returned by the Zotero API."""
+    if is_legacy(raw):
+        return json.loads(raw)
+    data = decode(raw, 'data')
+    return {'key': data['key'],
+            'version': decode(raw, 'version'),
+            'data': data,
+            'bib': decode(raw, 'bib')}
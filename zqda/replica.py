@@ -0,0 +1,353 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import click
+
+from zqda import app
+from zqda import records
+from zqda import snapshot
+from zqda.core import (cache, _item_cache, _exists, _open_db, _sync_lock,
+                       _library_version, _library_data_path, _write_json,
+                       _attachment_path, _invalidate_pages)
+
+# Replica snapshots.
+#
+# A sync node writes the stored data of its libraries to a snapshot
+# directory, from which read-only nodes are brought up to date without
+# talking to the Zotero API:
+#
+#   manifest.json                      libraries, versions and file list
+#   items/<library>/<from>-<to>.jsonl.gz
+#                                      items changed after version <from>
+#                                      (0: all items), one JSON object per
+#                                      line as returned by the Zotero API
+#   items/<library>/<from>-<to>.keys.gz
+#                                      all item keys at version <to>, to
+#                                      find deleted items
+#   files/<md5[:2]>/<md5>              attachment files by content hash
+#
+# Each export adds a delta to the chain of the previous one (or starts a
+# new chain with a full export), and files are never modified once
+# written, so the directory can be copied with rsync. The manifest is
+# written last and lists a checksum for each file; an import refuses
+# files that do not match, e.g. while a copy is still in progress. The
+# manifest is the file to copy last.
+#
+# Exports hold the library's sync lock (shared) and imports hold it
+# exclusively, so neither sees a half-finished sync.
+
+FORMAT = 1
+
+
+def _manifest_path(directory):
+    return os.path.join(directory, 'manifest.json')
+
+
+def _load_manifest(directory):
+    try:
+        with open(_manifest_path(directory), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {'format': FORMAT, 'libraries': {}}
+    if manifest.get('format') != FORMAT:
+        raise click.ClickException(
+            'Unsupported snapshot format in {}'.format(directory))
+    return manifest
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _blob_path(directory, md5):
+    return os.path.join(directory, 'files', md5[:2], md5)
+
+
+def _copy(source, target):
+    """Copy a file atomically, as a hard link if possible."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = '{}.{}'.format(target, os.getpid())
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+
+
+def _store_attachment(directory, key, data):
+    """Add the stored file of an attachment to the snapshot. Returns the
+    file entry for the item, or None if there is no file."""
+    if data.get('linkMode') in ('linked_file', 'linked_url') or \
+            not data.get('filename'):
+        return None
+    path = _attachment_path(key, data)
+    if not os.path.exists(path):
+        return None
+    md5 = _md5(path)
+    blob = _blob_path(directory, md5)
+    if not os.path.exists(blob):
+        _copy(path, blob)
+    return {'md5': md5, 'size': os.path.getsize(path),
+            'path': os.path.relpath(path, app.data_path)}
+
+
+class _GzipLines(object):
+    """Write lines to a gzip file without a timestamp, so that the same
+    content always gives the same file."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.tmp = '{}.{}'.format(path, os.getpid())
+        self.raw = open(self.tmp, 'wb')
+        self.gz = gzip.GzipFile(fileobj=self.raw, mode='wb', mtime=0)
+
+    def write(self, line):
+        self.gz.write(line.encode('utf-8') + b'\n')
+
+    def close(self):
+        self.gz.close()
+        self.raw.close()
+        os.replace(self.tmp, self.path)
+        return {'file': None, 'sha256': _sha256(self.path)}
+
+
+def _lines(directory, entry):
+    """Read the lines of a snapshot file, checking its checksum."""
+    path = os.path.join(directory, entry['file'])
+    if not os.path.exists(path) or _sha256(path) != entry['sha256']:
+        raise click.ClickException(
+            '{} is missing or incomplete'.format(entry['file']))
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def _referenced_blobs(directory, manifest):
+    md5s = set()
+    for entry in manifest['libraries'].values():
+        for step in [entry['full']] + entry['deltas']:
+            for line in _lines(directory, step['items']):
+                f = json.loads(line).get('file')
+                if f:
+                    md5s.add(f['md5'])
+    return md5s
+
+
+def _collect_garbage(directory, manifest):
+    """Remove files that are no longer referenced by the manifest."""
+    keep = set()
+    for entry in manifest['libraries'].values():
+        for step in [entry['full']] + entry['deltas']:
+            keep.add(step['items']['file'])
+            if step.get('keys'):
+                keep.add(step['keys']['file'])
+    items = os.path.join(directory, 'items')
+    for root, dirs, files in os.walk(items):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, directory) not in keep:
+                os.remove(path)
+    blobs = _referenced_blobs(directory, manifest)
+    for root, dirs, files in os.walk(os.path.join(directory, 'files')):
+        for name in files:
+            if name not in blobs:
+                os.remove(os.path.join(root, name))
+
+
+def export_snapshot(library_id, directory, full=False, attachments=True):
+    """Add the changes of a library since the last export to a snapshot
+    directory, or start a new chain with all items if `full` is set or
+    there is no previous export. Returns a summary message."""
+    t = time.perf_counter()
+    directory = os.path.abspath(directory)
+    manifest = _load_manifest(directory)
+    entry = manifest['libraries'].get(library_id)
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
+        return 'No item database.'
+
+    with _sync_lock(library_id, shared=True):
+        version = _library_version(library_id)
+        base = 0
+        if entry is not None and not full:
+            if entry['version'] == version:
+                return 'Snapshot is up to date (version {}).'.format(version)
+            if entry['version'] < version:
+                base = entry['version']
+        prefix = 'items/{}/{}-{}'.format(library_id, base, version)
+        items = _GzipLines(os.path.join(directory, prefix + '.jsonl.gz'))
+        keys = _GzipLines(os.path.join(directory, prefix + '.keys.gz'))
+        count = 0
+        files = 0
+        with _open_db(item_cache) as db:
+            for k in sorted(db.keys()):
+                raw = db[k]
+                key = k.decode('utf-8')
+                keys.write(key)
+                if base and records.decode(raw, 'version') <= base:
+                    continue
+                item = records.decode_item(raw)
+                if attachments and item['data'].get('itemType') == 'attachment':
+                    item['file'] = _store_attachment(directory, key,
+                                                     item['data'])
+                    files += item['file'] is not None
+                items.write(json.dumps(item, ensure_ascii=False))
+                count += 1
+        step = {'from': base, 'to': version, 'count': count,
+                'items': dict(items.close(), file=prefix + '.jsonl.gz'),
+                'keys': dict(keys.close(), file=prefix + '.keys.gz')}
+        try:
+            with open(_library_data_path(library_id), 'r') as f:
+                library = json.load(f)
+        except (OSError, ValueError):
+            library = None
+
+    if base == 0:
+        entry = {'full': step, 'deltas': []}
+    else:
+        entry['deltas'].append(step)
+    entry['version'] = version
+    entry['library'] = library
+    manifest['libraries'][library_id] = entry
+    manifest['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    _write_json(_manifest_path(directory), manifest)
+    if base == 0:
+        _collect_garbage(directory, manifest)
+    return '{} snapshot {}-{}: {} items, {} files ({:.1f} s).'.format(
+        'Full' if base == 0 else 'Delta', base, version, count, files,
+        time.perf_counter() - t)
+
+
+def _restore_attachment(directory, f):
+    target = os.path.join(app.data_path, f['path'])
+    if not os.path.abspath(target).startswith(
+            os.path.abspath(app.data_path) + os.sep):
+        return False
+    if os.path.exists(target) and os.path.getsize(target) == f['size']:
+        return False
+    blob = _blob_path(directory, f['md5'])
+    if not os.path.exists(blob):
+        return False
+    _copy(blob, target)
+    return True
+
+
+def _apply(directory, step, db):
+    """Store the items of a snapshot step in an open item database and
+    remove the items that no longer exist. Returns the counts of items
+    stored, items deleted and files restored."""
+    stored = files = 0
+    for line in _lines(directory, step['items']):
+        item = json.loads(line)
+        db[item['key']] = records.encode(item)
+        stored += 1
+        if item.get('file') and _restore_attachment(directory, item['file']):
+            files += 1
+    deleted = 0
+    if step['from']:
+        keys = set(_lines(directory, step['keys']))
+        for k in list(db.keys()):
+            if k.decode('utf-8') not in keys:
+                del db[k]
+                deleted += 1
+    return stored, deleted, files
+
+
+def import_snapshot(library_id, directory):
+    """Bring the stored data of a library up to date from a snapshot
+    directory: apply the deltas after the local version, or rebuild the
+    item database from the full snapshot. Returns a summary message."""
+    t = time.perf_counter()
+    directory = os.path.abspath(directory)
+    entry = _load_manifest(directory)['libraries'].get(library_id)
+    if entry is None:
+        return 'Not in the snapshot.'
+    item_cache = _item_cache(library_id)
+
+    with _sync_lock(library_id):
+        local = _library_version(library_id)
+        if local == entry['version'] and _exists(item_cache):
+            return 'Up to date (version {}).'.format(local)
+        reached = [entry['full']['to']] + [d['to'] for d in entry['deltas']]
+        if local in reached and _exists(item_cache):
+            steps = [d for d in entry['deltas'] if d['from'] >= local]
+            target = item_cache
+            flag = 'w'
+        else:
+            steps = [entry['full']] + entry['deltas']
+            target = item_cache + '.import'
+            flag = 'n'
+        totals = [0, 0, 0]
+        with _open_db(target, flag) as db:
+            for step in steps:
+                for i, n in enumerate(_apply(directory, step, db)):
+                    totals[i] += n
+        if target != item_cache:
+            for f in glob.glob(target + '*'):
+                os.replace(f, item_cache + f[len(target):])
+
+        jsn = os.path.join(app.data_path, 'versions.json')
+        try:
+            with open(jsn, 'r') as f:
+                versions = json.load(f)
+        except (OSError, ValueError):
+            versions = {}
+        versions[library_id] = entry['version']
+        _write_json(jsn, versions)
+        if entry.get('library'):
+            _write_json(_library_data_path(library_id), entry['library'])
+        snapshot.build(library_id, entry['version'])
+        _invalidate_pages(library_id)
+
+    return 'Imported version {} ({} steps): {} items stored, {} deleted, ' \
+        '{} files ({:.1f} s).'.format(entry['version'], len(steps), *totals,
+                                      time.perf_counter() - t)
+
+
+@app.cli.command('export-snapshot')
+@click.argument('library_ids', nargs=-1)
+@click.option('--output', default=None, metavar='DIR',
+              help='Snapshot directory (default: REPLICA_DIR).')
+@click.option('--full', is_flag=True,
+              help='Start a new snapshot chain with all items.')
+@click.option('--attachments/--no-attachments', default=True,
+              help='Include attachment files (default: yes).')
+def export_snapshot_command(library_ids, output, full, attachments):
+    """Write the stored data of libraries to a snapshot directory for read
+    replicas. Exports all configured libraries if none are given."""
+    output = output or app.config.get('REPLICA_DIR')
+    if not output:
+        raise click.UsageError('No --output directory or REPLICA_DIR.')
+    for library_id in library_ids or app.config['LIBRARY']:
+        click.echo('{}: {}'.format(
+            library_id, export_snapshot(library_id, output, full, attachments)))
+
+
+@app.cli.command('import-snapshot')
+@click.argument('directory')
+@click.argument('library_ids', nargs=-1)
+def import_snapshot_command(directory, library_ids):
+    """Update libraries from a snapshot directory written by
+    export-snapshot. Imports all configured libraries if none are given."""
+    for library_id in library_ids or app.config['LIBRARY']:
+        click.echo('{}: {}'.format(
+            library_id, import_snapshot(library_id, directory)))
+    cache.clear()
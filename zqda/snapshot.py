@@ -0,0 +1,282 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+from collections.abc import Mapping
+
+from zqda import app
+from zqda import records
+
+# Read-only columnar index of a library, written at the end of each sync to
+# snapshot_<library_id>.bin and memory-mapped by every worker process, so
+# that all processes share one copy of the pages instead of each building
+# its own tag/collection/children dicts.
+#
+# Item keys are interned as integer ids (their position in the sorted key
+# table). The file holds the key table, a type code and a parent id for each
+# item, and CSR-style postings (offsets + item ids) for tags, collections
+# and children, each keyed by a sorted string table. A lookup is a binary
+# search in a string table followed by an array slice.
+
+MAGIC = b'ZQSX'
+FORMAT = 1
+SECTIONS = ('keys', 'types', 'type_names', 'parents',
+            'tags', 'tag_postings', 'collections', 'collection_postings',
+            'parents_with_children', 'child_postings')
+_HEADER = struct.Struct('<4sBcxxQI')  # magic, format, byte order, version, count
+_SECTION = struct.Struct('<QQ')  # offset, length
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def snapshot_path(library_id):
+    return os.path.join(app.data_path, 'snapshot_{}.bin'.format(library_id))
+
+
+def _int_array(values):
+    """Pack a sequence of ints as native int32 values."""
+    return struct.pack('{}i'.format(len(values)), *values)
+
+
+def _string_table(strings):
+    """Encode sorted strings as (n + 1) int32 offsets followed by the
+    concatenated UTF-8 bytes."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+    return _int_array([len(encoded)]) + _int_array(offsets) + b''.join(encoded)
+
+
+def _postings(names, groups, index):
+    """Encode a CSR posting list: (n + 1) int32 offsets followed by the item
+    ids for each name in `names`."""
+    offsets = [0]
+    ids = []
+    for name in names:
+        ids.extend(index[k] for k in groups[name])
+        offsets.append(len(ids))
+    return _int_array(offsets) + _int_array(ids)
+
+
+def build(library_id, version=0):
+    """Scan the item database of a library and write its snapshot file.
+    The file is replaced atomically, so processes that have the previous
+    snapshot mapped keep a consistent view."""
+    from zqda.core import _item_cache, _exists, _open_db
+    item_cache = _item_cache(library_id)
+    if not _exists(item_cache):
+        return None
+
+    types = {}
+    parents = {}
+    tags = {}
+    collections = {'top': []}
+    children = {}
+    with _open_db(item_cache) as db:
+        for key in db.keys():
+            data = records.decode(db[key])
+            key = data['key']
+            item_type = data['itemType']
+            parent = data.get('parentItem', None)
+            types[key] = item_type
+            parents[key] = parent
+
+            item_collections = list(data.get('collections', []))
+            if data.get('parentCollection', None):
+                item_collections.append(data['parentCollection'])
+            if not item_collections and not parent and item_type == 'collection':
+                item_collections.append('top')
+            for c in item_collections:
+                collections.setdefault(c, []).append(key)
+
+            # ignore unfiled items
+            if data.get('collections', []) or parent:
+                for tag in data.get('tags', []):
+                    tags.setdefault(tag['tag'], []).append(key)
+
+            if parent:
+                children.setdefault(parent, []).append(key)
+
+    keys = sorted(types)
+    index = {k: i for i, k in enumerate(keys)}
+    type_names = sorted(set(types.values()))
+    type_index = {t: i for i, t in enumerate(type_names)}
+    tag_names = sorted(tags)
+    collection_names = sorted(collections)
+    parent_names = sorted(children)
+
+    sections = {
+        'keys': _string_table(keys),
+        'types': bytes(type_index[types[k]] for k in keys),
+        'type_names': _string_table(type_names),
+        'parents': _int_array([index.get(parents[k], -1) for k in keys]),
+        'tags': _string_table(tag_names),
+        'tag_postings': _postings(tag_names, tags, index),
+        'collections': _string_table(collection_names),
+        'collection_postings': _postings(collection_names, collections, index),
+        'parents_with_children': _string_table(parent_names),
+        'child_postings': _postings(parent_names, children, index),
+    }
+
+    path = snapshot_path(library_id)
+    tmp = '{}.{}'.format(path, os.getpid())
+    offset = _HEADER.size + _SECTION.size * len(SECTIONS)
+    directory = []
+    body = []
+    for name in SECTIONS:
+        data = sections[name]
+        pad = -offset % 8  # keep int32 arrays aligned
+        body.append(b'\0' * pad)
+        offset += pad
+        directory.append(_SECTION.pack(offset, len(data)))
+        body.append(data)
+        offset += len(data)
+    byteorder = b'<' if sys.byteorder == 'little' else b'>'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT, byteorder, version, len(keys)))
+        f.write(b''.join(directory))
+        f.write(b''.join(body))
+    os.replace(tmp, path)
+    return path
+
+
+class _Strings(object):
+    """Sorted string table stored in a memory-mapped buffer."""
+
+    def __init__(self, buf):
+        n = buf[:4].cast('i')[0]
+        self.offsets = buf[4:4 * (n + 2)].cast('i')
+        self.blob = buf[4 * (n + 2):]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def find(self, s):
+        """Return the position of `s` in the table, or -1."""
+        target = s.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.raw(lo) == target:
+            return lo
+        return -1
+
+
+class Postings(Mapping):
+    """Read-only mapping from a name (tag, collection key or parent item key)
+    to the list of item keys posted under it."""
+
+    def __init__(self, snapshot, names, postings, as_bytes=False):
+        self.snapshot = snapshot
+        self.names = names
+        n = len(names)
+        self.offsets = postings[:4 * (n + 1)].cast('i')
+        self.ids = postings[4 * (n + 1):].cast('i')
+        self.as_bytes = as_bytes
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (self.names[i] for i in range(len(self.names)))
+
+    def __contains__(self, name):
+        return self.names.find(name) >= 0
+
+    def ids_for(self, name):
+        """Return the item ids posted under `name` as an int array slice."""
+        i = self.names.find(name)
+        if i < 0:
+            raise KeyError(name)
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def count(self, name):
+        """Return the number of items posted under `name`."""
+        return len(self.ids_for(name))
+
+    def __getitem__(self, name):
+        keys = self.snapshot.keys
+        if self.as_bytes:
+            return [keys.raw(i) for i in self.ids_for(name)]
+        return [keys[i] for i in self.ids_for(name)]
+
+
+class Snapshot(object):
+    """Memory-mapped snapshot of a library."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mmap)
+        magic, fmt, byteorder, self.version, n = _HEADER.unpack_from(buf)
+        native = b'<' if sys.byteorder == 'little' else b'>'
+        if magic != MAGIC or fmt != FORMAT or byteorder != native:
+            raise ValueError('Incompatible snapshot file {}'.format(path))
+        sections = {}
+        for i, name in enumerate(SECTIONS):
+            offset, length = _SECTION.unpack_from(
+                buf, _HEADER.size + i * _SECTION.size)
+            sections[name] = buf[offset:offset + length]
+
+        self.keys = _Strings(sections['keys'])
+        self.types = sections['types']
+        self.type_names = _Strings(sections['type_names'])
+        self.parents = sections['parents'].cast('i')
+        self.tags = Postings(self, _Strings(sections['tags']),
+                             sections['tag_postings'])
+        # collection members are returned as dbm keys (bytes), as before
+        self.collections = Postings(self, _Strings(sections['collections']),
+                                    sections['collection_postings'],
+                                    as_bytes=True)
+        self.children = Postings(self,
+                                 _Strings(sections['parents_with_children']),
+                                 sections['child_postings'])
+
+    def item_type(self, key):
+        """Return the itemType of an item, or None if it is not present."""
+        i = self.keys.find(key)
+        if i < 0:
+            return None
+        return self.type_names[self.types[i]]
+
+    def parent(self, key):
+        """Return the parentItem key of an item, or None."""
+        i = self.keys.find(key)
+        if i < 0 or self.parents[i] < 0:
+            return None
+        return self.keys[self.parents[i]]
+
+
+def load(library_id):
+    """Return the current snapshot of a library, or None if there is none.
+    Snapshots are mapped once per process and re-mapped when the file on
+    disk has been replaced."""
+    path = snapshot_path(library_id)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _loaded.get(library_id)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with _lock:
+        try:
+            snap = Snapshot(path)
+        except (OSError, ValueError, struct.error):
+            return None
+        _loaded[library_id] = (stamp, snap)
+    return snap
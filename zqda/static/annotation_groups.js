@@ -0,0 +1,21 @@
+/*
+ * Annotation reports: the annotations of a document group are loaded from
+ * the group's own page when the group is first opened.
+ */
+$(function () {
+    $('details.annotation-group').on('toggle', function () {
+        var $group = $(this);
+        if (!this.open || $group.data('loaded')) {
+            return;
+        }
+        $group.data('loaded', true);
+        var $list = $group.find('.annotation-list');
+        $list.text('Loading…');
+        $list.load($group.data('url') + ' .annotation-list > *', function (response, status) {
+            if (status == 'error') {
+                $group.data('loaded', false);
+                $list.text('Could not load the annotations.');
+            }
+        });
+    });
+});
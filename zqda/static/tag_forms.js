@@ -0,0 +1,101 @@
+/*
+ * Tag forms (rename and cluster tags). Tags are loaded from a search
+ * endpoint as the user types, instead of rendering every tag of the
+ * library, and only the changed entries are submitted: renames as
+ * `old tag=new tag` fields, selected tags as `tag=on` fields.
+ */
+function zqdaTagForm(form, url, mode) {
+    var $form = $(form);
+    var $search = $form.find('.tag-search');
+    var $match = $form.find('.tag-match');
+    var $results = $form.find('.tag-results');
+    var $more = $form.find('.tag-more');
+    var $pending = $form.find('.tag-pending');
+    var changes = {};
+    var offset = 0;
+    var timer = null;
+    var request = null;
+
+    function changed() {
+        return Object.keys(changes).length;
+    }
+
+    function showPending() {
+        var n = changed();
+        var label = mode == 'rename' ? ' renamed' : ' selected';
+        $pending.text(n ? n + (n == 1 ? ' tag' : ' tags') + label : '');
+    }
+
+    function row(entry) {
+        var tag = entry.tag;
+        var $row = $('<div class="input-group mb-2"></div>');
+        var $count = $('<span class="input-group-text"></span>').text(entry.count);
+        if (mode == 'rename') {
+            var $input = $('<input type="text" class="form-control">');
+            $input.val(tag in changes ? changes[tag] : tag);
+            $input.on('input', function () {
+                if (this.value == tag) {
+                    delete changes[tag];
+                } else {
+                    changes[tag] = this.value;
+                }
+                showPending();
+            });
+            return $row.append($input, $count);
+        }
+        var $check = $('<input type="checkbox" class="form-check-input mt-0">');
+        $check.prop('checked', tag in changes);
+        $check.on('change', function () {
+            if (this.checked) {
+                changes[tag] = 'on';
+            } else {
+                delete changes[tag];
+            }
+            showPending();
+        });
+        var $label = $('<span class="form-control"></span>').text(tag);
+        return $row.append($('<div class="input-group-text"></div>').append($check),
+                           $label, $count);
+    }
+
+    function load(append) {
+        if (request) {
+            request.abort();
+        }
+        if (!append) {
+            offset = 0;
+        }
+        request = $.getJSON(url, {q: $search.val(), match: $match.val(), offset: offset},
+            function (data) {
+                if (!append) {
+                    $results.empty();
+                }
+                $.each(data.tags, function (i, entry) {
+                    $results.append(row(entry));
+                });
+                offset += data.tags.length;
+                $more.toggle(data.more);
+            });
+    }
+
+    $search.on('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () { load(false); }, 200);
+    });
+    $match.on('change', function () { load(false); });
+    $more.on('click', function () { load(true); });
+
+    $form.on('submit', function () {
+        $.each(changes, function (tag, value) {
+            $('<input type="hidden">').attr('name', tag).val(value).appendTo($form);
+        });
+        changes = {};
+    });
+    $(window).on('beforeunload', function () {
+        if (changed()) {
+            return 'You have unsaved changes.';
+        }
+    });
+
+    load(false);
+}
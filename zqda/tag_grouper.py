@@ -1,11 +1,11 @@
 import os
 import json
-from flask import render_template, url_for, request, redirect
+from flask import render_template, url_for, request, redirect, abort
 from markupsafe import Markup
-from pyzotero import zotero
 
 from zqda import app
 import zqda.core
+import zqda.tag_search
 
 
 HELP = """
@@ -24,9 +24,9 @@ HELP = """
 def _apply_category_tag(library_id, tags_group, target):
     """Apply a tag to all library items matching any of the tags in the list
     `tags_group`, then synchronize changes to the local database."""
+    from zqda.client import library_client
 
-    zot = zotero.Zotero(library_id, 'group',
-                        app.config['LIBRARY'][library_id]['api_key'])
+    zot = library_client(library_id)
     prefix = app.config['LIBRARY'][library_id].get('cluster_tag_prefix', '@')
     target = prefix + target.lstrip(prefix).upper()
 
@@ -39,13 +39,24 @@ def _apply_category_tag(library_id, tags_group, target):
     zqda.core._sync_items(library_id)
 
 
+def _tags_file(library_id):
+    return os.path.join(app.data_path, 'group_tags_{}.json'.format(library_id))
+
+
+def _tags_file_stamp(library_id):
+    try:
+        st = os.stat(_tags_file(library_id))
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
 def _get_filtered_tags(library_id, purge=False, remove=None):
     """Retrieve a list of tags that have not yet been applied to annotations
     that also have a thematic (cluster) tag associated with them."""
 
     tags = []
-    tagfile = 'group_tags_{}.json'.format(library_id)
-    jsn = os.path.join(app.data_path, tagfile)
+    jsn = _tags_file(library_id)
     prefix = app.config['LIBRARY'][library_id].get('group_tag_prefix', '@')
 
     if os.path.exists(jsn) and not purge:
@@ -109,22 +120,18 @@ def tag_grouper_form(library_id, purge=False, remove=None):
         remove = tags_group
     else:
         remove = None
-    tags = _get_filtered_tags(library_id, remove=remove, purge=purge)
+    _get_filtered_tags(library_id, remove=remove, purge=purge)
 
-    out.append('<form action="{}" method="post">'.format(
+    out.append('<form action="{}" id="zform" method="post">'.format(
         url_for('tag_grouper_form', library_id=library_id)))
     out.append('<div class="form-group mb-4">')
     out.append(
         '<p><input type="text" placeholder="Thematic tag name to apply" name="target" required="required" class="form-control" ></p>')
     out.append(
         '<input type="submit" value="submit" class="btn btn-primary mb-2" />')
-    for tag in sorted(tags):
-        out.append('<div class="form-check">')
-        out.append(
-            '<input type="checkbox" name="{tag}" class="form-check-input" >'.format(tag=tag))
-        out.append(
-            ' <label for="{tag}" class="form-check-label">{tag}</label>'.format(tag=tag))
-        out.append('</div>')
+    out.append(zqda.tag_search.form_controls(
+        'zform', url_for('tag_grouper_search', library_id=library_id),
+        'select'))
     out.append(
         '<input type="hidden" name="library_id" value="{}">'.format(library_id))
     out.append('</div>')
@@ -137,3 +144,13 @@ def tag_grouper_form(library_id, purge=False, remove=None):
                            title='Cluster tags',
                            logged_in=zqda.core._check_key(library_id)
                            )
+
+
+@app.route('/cluster_tags/<library_id>/search')
+def tag_grouper_search(library_id):
+    """Look up the tags listed in the cluster form (see `tag_search`)."""
+    if zqda.core._check_key(library_id) is False:
+        abort(403)
+    tags = zqda.tag_search.subset(library_id, 'cluster', _get_filtered_tags,
+                                  lambda: _tags_file_stamp(library_id))
+    return zqda.tag_search.search_response(library_id, only=tags)
@@ -0,0 +1,149 @@
+import bisect
+import threading
+
+from flask import request, jsonify, abort
+
+from zqda import app
+from zqda import snapshot
+from zqda.assets import asset_url
+import zqda.core
+
+# Tag lookup for the tag forms.
+#
+# The rename and cluster forms no longer list every tag of a library; they
+# ask /tag_search/<library_id> for the tags matching what the user types and
+# only render those. Lookups go through a per-process index of
+# (casefolded tag, tag, item count) tuples sorted by the casefolded tag, so
+# a prefix match is a binary search followed by a slice. The index is built
+# from the tag table of the library snapshot (or the memoized tag scan) and
+# rebuilt when the library version changes. Forms that only offer some of
+# the tags (the cluster form) keep that subset next to the index, under the
+# same key, instead of computing it for every lookup.
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+_indexes = {}
+_subsets = {}
+_lock = threading.Lock()
+
+
+def _index(library_id):
+    """Sorted (casefolded tag, tag, count) tuples for a library."""
+    version = zqda.core._library_version(library_id)
+    with _lock:
+        cached = _indexes.get(library_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    tags = zqda.core._get_tags(library_id)
+    if isinstance(tags, snapshot.Postings):
+        count = tags.count
+    else:
+        def count(tag):
+            return len(tags[tag])
+    entries = sorted((tag.casefold(), tag, count(tag)) for tag in tags)
+    with _lock:
+        _indexes[library_id] = (version, entries)
+    return entries
+
+
+def subset(library_id, name, build, stamp=None):
+    """The set of tags `build(library_id)`, cached per process under `name`
+    and rebuilt when the library version changes, or the value of
+    `stamp()` for subsets that also depend on other data (taken after the
+    build, which may write that data)."""
+    def key():
+        return (zqda.core._library_version(library_id),
+                stamp() if stamp else None)
+    with _lock:
+        cached = _subsets.get((library_id, name))
+    if cached is not None and cached[0] == key():
+        return cached[1]
+    tags = frozenset(build(library_id))
+    with _lock:
+        _subsets[(library_id, name)] = (key(), tags)
+    return tags
+
+
+def _matches(entries, query, match):
+    if match == 'prefix':
+        i = bisect.bisect_left(entries, (query,))
+        while i < len(entries) and entries[i][0].startswith(query):
+            yield entries[i]
+            i += 1
+    else:
+        for entry in entries:
+            if query in entry[0]:
+                yield entry
+
+
+def lookup(library_id, query='', match='prefix', limit=DEFAULT_LIMIT,
+           offset=0, only=None):
+    """Find the tags of a library that start with (match='prefix') or
+    contain (match='contains') `query`, ignoring case, in alphabetical
+    order. `only` restricts the result to a set of tags. Returns a list of
+    {'tag': ..., 'count': ...} dicts and whether there are more matches
+    after `limit`."""
+    found = []
+    skipped = 0
+    for folded, tag, count in _matches(_index(library_id),
+                                       query.casefold(), match):
+        if only is not None and tag not in only:
+            continue
+        if skipped < offset:
+            skipped += 1
+            continue
+        if len(found) == limit:
+            return found, True
+        found.append({'tag': tag, 'count': count})
+    return found, False
+
+
+def search_response(library_id, only=None):
+    """JSON response for a tag search with the `q`, `match`, `limit` and
+    `offset` request parameters."""
+    if library_id not in app.config['LIBRARY']:
+        abort(404)
+    args = request.args
+    match = args.get('match', 'prefix')
+    if match not in ('prefix', 'contains'):
+        abort(400)
+    try:
+        limit = min(int(args.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        offset = max(int(args.get('offset', 0)), 0)
+    except ValueError:
+        abort(400)
+    tags, more = lookup(library_id, args.get('q', ''), match, limit, offset,
+                        only)
+    return jsonify({'tags': tags, 'more': more})
+
+
+def form_controls(form_id, url, mode):
+    """HTML for the search box, results and script of a tag form. `mode`
+    is 'rename' (editable tag names) or 'select' (checkboxes)."""
+    return ''.join([
+        '<div class="input-group mb-3">',
+        '<input type="search" class="form-control tag-search" '
+        'placeholder="Search tags" autocomplete="off">',
+        '<select class="form-select flex-grow-0 w-auto tag-match">',
+        '<option value="prefix">starts with</option>',
+        '<option value="contains">contains</option>',
+        '</select></div>',
+        '<p class="text-muted tag-pending"></p>',
+        '<div class="tag-results"></div>',
+        '<button type="button" class="btn btn-link tag-more" '
+        'style="display: none">More tags</button>',
+        '<noscript><p>This form requires JavaScript.</p></noscript>',
+        '<script src="{}"></script>'.format(asset_url('tag_forms.js')),
+        '<script>zqdaTagForm("#{}", "{}", "{}")</script>'.format(
+            form_id, url, mode),
+    ])
+
+
+@app.route('/tag_search/<library_id>')
+def tag_search(library_id):
+    """Look up tags by prefix (or, with `match=contains`, by substring),
+    with the number of items for each tag, as JSON. The tag forms use this
+    to load the tags being edited. Parameters: `q`, `match`, `limit`
+    (default 50) and `offset`."""
+    return search_response(library_id)